@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Batch processing of photo directories outside Telegram
+
+Walks an input directory, processes every image with ImageProcessor and writes
+the results plus a JSON manifest to an output directory. Up to --concurrency
+photos are read and processed at once; decoding, resizing and encoding run in
+a process pool. Re-running with the same output directory and template skips
+photos whose result is already recorded in the manifest. A photo that fails,
+even with an I/O error, is recorded as failed without stopping the run.
+
+Usage:
+    python batch_process.py photos/ results/ --concurrency 8 --workers 4
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from image_processor import ImageProcessor
+from worker_pool import WorkerPool, JobTimeoutError
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff"}
+
+
+def find_images(input_dir):
+    """Relative paths of all images below ``input_dir``, sorted"""
+    found = []
+    for root, _, files in os.walk(input_dir):
+        for name in files:
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                found.append(os.path.relpath(os.path.join(root, name), input_dir))
+    return sorted(found)
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {"files": {}}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(path, manifest):
+    # Write to a temporary file first so an interrupted run never corrupts it
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(temp_path, path)
+
+
+def output_path_for(output_dir, relative_path, extension="jpg"):
+    base, _ = os.path.splitext(relative_path)
+    return os.path.join(output_dir, f"{base}.{extension}")
+
+
+def is_done(entry, output_dir, digest, template):
+    return (
+        entry is not None
+        and entry.get("status") == "done"
+        and entry.get("sha256") == digest
+        and entry.get("template") == template
+        and os.path.exists(os.path.join(output_dir, entry["output"]))
+    )
+
+
+async def process_directory(args):
+    processor = ImageProcessor()
+    processor.cpu_executor = ProcessPoolExecutor(max_workers=args.workers)
+    pool = WorkerPool(max_workers=args.concurrency, job_timeout=args.timeout)
+
+    manifest_path = args.manifest or os.path.join(args.output_dir, "manifest.json")
+    manifest = load_manifest(manifest_path)
+    files = manifest.setdefault("files", {})
+    # Entries from older manifests carry the run's template only at the top level
+    for entry in files.values():
+        entry.setdefault("template", manifest.get("template"))
+    manifest["template"] = args.template
+
+    images = find_images(args.input_dir)
+    counts = {"done": 0, "failed": 0, "skipped": 0}
+    print(f"📂 Found {len(images)} images in {args.input_dir}")
+
+    # Bounds the photos held in memory, not just the model calls
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def handle(relative_path):
+        async with slots:
+            entry = {"template": args.template}
+            started = time.monotonic()
+            try:
+                if not await process_file(relative_path, entry):
+                    return
+            except Exception as e:
+                entry.update(status="failed", error=str(e))
+            entry["seconds"] = round(time.monotonic() - started, 2)
+            if entry["status"] == "done":
+                counts["done"] += 1
+                print(f"✅ {relative_path} ({entry['seconds']}s)")
+            else:
+                counts["failed"] += 1
+                print(f"❌ {relative_path}: {entry['error']}")
+            files[relative_path] = entry
+            save_manifest(manifest_path, manifest)
+
+    async def process_file(relative_path, entry):
+        """Process one photo into ``entry``; returns False if it was already done"""
+        with open(os.path.join(args.input_dir, relative_path), "rb") as f:
+            image_data = f.read()
+        digest = hashlib.sha256(image_data).hexdigest()
+        entry["sha256"] = digest
+
+        if not args.force and is_done(files.get(relative_path), args.output_dir, digest, args.template):
+            counts["skipped"] += 1
+            return False
+
+        try:
+            result = await pool.run(processor.process_image, image_data, args.template)
+        except JobTimeoutError:
+            entry.update(status="failed", error=f"timed out after {args.timeout}s")
+            return True
+
+        if not result:
+            entry.update(status="failed", error="processing failed")
+            return True
+        output_path = output_path_for(args.output_dir, relative_path, processor.output_encoder.extension)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with open(output_path, "wb") as f:
+            f.write(result)
+        entry.update(status="done", output=os.path.relpath(output_path, args.output_dir), bytes=len(result))
+        return True
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    started = time.monotonic()
+    try:
+        await asyncio.gather(*(handle(path) for path in images))
+    finally:
+        save_manifest(manifest_path, manifest)
+        pool.shutdown()
+        processor.cpu_executor.shutdown()
+
+    elapsed = time.monotonic() - started
+    print("=" * 50)
+    print(
+        f"🎉 Done in {elapsed:.1f}s: {counts['done']} processed, "
+        f"{counts['skipped']} skipped, {counts['failed']} failed"
+    )
+    print(f"📄 Manifest: {manifest_path}")
+    return counts["failed"] == 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Process a directory of photos into DV lottery photos")
+    parser.add_argument("input_dir", help="Directory containing the photos to process")
+    parser.add_argument("output_dir", help="Directory for processed photos and the manifest")
+    parser.add_argument("--template", default="dv", help="Reference template name (default: dv)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Concurrent model calls (default: 4)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Processes for CPU work (default: CPU count)")
+    parser.add_argument("--timeout", type=float, default=300, help="Seconds allowed per photo (default: 300)")
+    parser.add_argument("--manifest", help="Manifest path (default: OUTPUT_DIR/manifest.json)")
+    parser.add_argument("--force", action="store_true", help="Reprocess photos already in the manifest")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not os.path.isdir(args.input_dir):
+        print(f"❌ Input directory not found: {args.input_dir}")
+        return False
+    return asyncio.run(process_directory(args))
+
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark of the photo pipeline with a local Gemini stand-in
+
+Drives DVPhotoBot.handle_photo / handle_document with synthetic Telegram
+updates at a configurable concurrency, with FakeGeminiClient in place of the
+real model. A request ends when its result (or an error) is delivered, not
+when the handler returns. Reports throughput, p50/p95/p99 latency per stage
+and peak RSS.
+
+Usage:
+    python benchmark.py --requests 200 --concurrency 50 --latency 2 --jitter 0.5
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
+import sys
+import time
+import types
+from collections import defaultdict
+from fake_gemini import FakeGeminiClient, synthetic_portrait
+from file_id_cache import FileIdCache
+from image_processor import ImageProcessor
+from job_store import JobStore
+from local_processor import LocalProcessor
+from metrics import REGISTRY, enable_memory_profiling
+from rate_limit import RateLimiter
+from result_cache import ResultCache
+from scheduler import FairScheduler
+from telegram_bot import DVPhotoBot
+from worker_pool import WorkerPool, default_max_workers
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of ``values``"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class StageRecorder:
+    """Collects wall-clock durations per pipeline stage"""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    def record(self, stage, seconds):
+        self.samples[stage].append(seconds)
+
+    def wrap(self, obj, attribute, stage):
+        """Replace ``obj.attribute`` with a version that records its duration"""
+        original = getattr(obj, attribute)
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - started)
+
+        setattr(obj, attribute, timed)
+
+    def summary(self):
+        return {
+            stage: {
+                "count": len(values),
+                "p50_ms": round(percentile(values, 0.50) * 1000, 1),
+                "p95_ms": round(percentile(values, 0.95) * 1000, 1),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 1),
+            }
+            for stage, values in sorted(self.samples.items())
+        }
+
+
+class FakeTelegram:
+    """Minimal stand-ins for the Telegram objects the handlers touch"""
+
+    def __init__(self, recorder, download_latency, upload_latency):
+        self.recorder = recorder
+        self.download_latency = download_latency
+        self.upload_latency = upload_latency
+        self.files = {}
+        self.bot = types.SimpleNamespace(
+            get_file=self.get_file,
+            send_document=self.send_document,
+            send_media_group=self.send_media_group,
+            edit_message_text=self.edit_message_text,
+            send_message=self.send_message,
+        )
+        self.outcomes = {}
+        self.finished = {}
+        self.albums = defaultdict(list)
+        # Request ids whose outcome a status message or reply settles
+        self.watchers = {}
+
+    async def get_file(self, file_id):
+        data = self.files[file_id]
+
+        async def download_as_bytearray():
+            started = time.perf_counter()
+            await asyncio.sleep(self.download_latency)
+            self.recorder.record("download", time.perf_counter() - started)
+            return bytearray(data)
+
+        return types.SimpleNamespace(file_id=file_id, file_size=len(data), download_as_bytearray=download_as_bytearray)
+
+    def finish(self, request_id, outcome):
+        if self.finished[request_id].is_set():
+            return
+        self.outcomes[request_id] = outcome
+        self.finished[request_id].set()
+
+    def record_failure(self, message_id, text):
+        if text.startswith(("❌", "🚦", "⏱")):
+            for request_id in self.watchers.get(message_id, [message_id]):
+                self.finish(request_id, "failed")
+
+    def record_delivery(self, message_id, count):
+        # An album reply settles its photos in order; the rest failed
+        pending = [r for r in self.watchers.get(message_id, [message_id]) if not self.finished[r].is_set()]
+        for number, request_id in enumerate(pending):
+            self.finish(request_id, "ok" if number < count else "failed")
+
+    async def upload(self):
+        started = time.perf_counter()
+        await asyncio.sleep(self.upload_latency)
+        self.recorder.record("upload", time.perf_counter() - started)
+
+    # Status messages and results are addressed by the id of the user's message,
+    # which is the request id; status messages reuse it
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self.record_failure(message_id, text)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        pass
+
+    async def send_document(self, chat_id=None, document=None, reply_to_message_id=None, **kwargs):
+        await self.upload()
+        self.record_delivery(reply_to_message_id, 1)
+        return types.SimpleNamespace(document=types.SimpleNamespace(file_id=f"out-{reply_to_message_id}"))
+
+    async def send_media_group(self, chat_id, media, reply_to_message_id=None, **kwargs):
+        await self.upload()
+        self.record_delivery(reply_to_message_id, len(media))
+        return [
+            types.SimpleNamespace(document=types.SimpleNamespace(file_id=f"out-{reply_to_message_id}-{number}"))
+            for number in range(len(media))
+        ]
+
+    def make_update(self, request_id, chat_id, image_data, kind, album=None):
+        file_id = f"file-{request_id}"
+        self.files[file_id] = image_data
+        self.outcomes[request_id] = "no_reply"
+        self.finished[request_id] = asyncio.Event()
+        if album is not None:
+            self.albums[album].append(request_id)
+
+        async def reply_text(text, **kwargs):
+            if text.startswith("⏳"):
+                self.finish(request_id, "rate_limited")
+            elif album is not None and text.startswith("🔄"):
+                # The album's single progress message answers for all its photos
+                self.watchers[request_id] = self.albums[album]
+            self.record_failure(request_id, text)
+            return types.SimpleNamespace(message_id=request_id)
+
+        message = types.SimpleNamespace(
+            message_id=request_id,
+            media_group_id=album,
+            photo=[types.SimpleNamespace(file_id=file_id, file_size=len(image_data))] if kind == "photo" else [],
+            document=types.SimpleNamespace(
+                file_id=file_id,
+                file_size=len(image_data),
+                mime_type="image/jpeg",
+                file_name=f"photo_{request_id}.jpg",
+            ) if kind == "document" else None,
+            reply_text=reply_text,
+        )
+        return types.SimpleNamespace(
+            update_id=request_id,
+            message=message,
+            effective_message=message,
+            effective_chat=types.SimpleNamespace(id=chat_id),
+            effective_user=types.SimpleNamespace(id=chat_id),
+        )
+
+
+def build_bot(args, recorder):
+    outputs = None
+    portrait = synthetic_portrait(seed=0)
+    local = LocalProcessor()
+    if local.available:
+        # A compliant model output, so the benchmark measures the happy path
+        outputs = [local.process(portrait).image]
+
+    client = FakeGeminiClient(
+        latency=args.latency,
+        jitter=args.jitter,
+        failure_rate=args.failure_rate,
+        capacity=args.capacity,
+        outputs=outputs,
+        seed=args.seed,
+    )
+    processor = ImageProcessor(client=client)
+    processor.local_processor = LocalProcessor(encoder=processor.output_encoder) if args.local_fastpath else None
+    processor.candidates = args.candidates
+
+    bot = DVPhotoBot(token="benchmark", image_processor=processor)
+    bot.worker_pool = WorkerPool(max_workers=args.workers, job_timeout=args.timeout)
+    bot.scheduler = FairScheduler(bot.worker_pool, max_depth=args.queue_depth)
+    bot.result_cache = ResultCache(disk_dir="")
+    bot.jobs = JobStore(path="", result_dir="")
+    # Start without known file_ids and never write the bot's real cache
+    bot.file_ids = FileIdCache(path="")
+    bot.rate_limiter = RateLimiter(
+        user_per_hour=args.user_per_hour,
+        global_per_minute=args.global_per_minute,
+        path="",
+    )
+    processor.resilience.rate_limiter = bot.rate_limiter
+
+    recorder.wrap(processor, "validate_image", "validate")
+    recorder.wrap(processor, "process_image", "process_image")
+    recorder.wrap(processor, "generate", "model")
+    recorder.wrap(processor, "resize_image", "resize")
+    if processor.compliance_checker is not None:
+        recorder.wrap(processor, "check_output", "compliance")
+    if processor.local_processor is not None:
+        recorder.wrap(processor.local_processor, "process", "local")
+    return bot, client, portrait
+
+
+async def run_benchmark(args):
+    recorder = StageRecorder()
+    bot, client, portrait = build_bot(args, recorder)
+    telegram = FakeTelegram(recorder, args.download_latency, args.upload_latency)
+    context = types.SimpleNamespace(bot=telegram.bot)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def send(request_id, chat_id, album):
+        kind = args.kind
+        if kind == "mixed":
+            kind = "photo" if request_id % 2 else "document"
+        # Trailing bytes keep inputs distinct so the result cache does not short-circuit
+        image_data = portrait if args.duplicates else portrait + request_id.to_bytes(4, "big")
+        update = telegram.make_update(request_id, chat_id, image_data, kind, album)
+        handler = bot.handle_photo if kind == "photo" else bot.handle_document
+        started = time.perf_counter()
+        await handler(update, context)
+        # The handler only acknowledges; wait for the delivery
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(telegram.finished[request_id].wait(), args.timeout + 30)
+        recorder.record("end_to_end", time.perf_counter() - started)
+
+    async def one(first, count):
+        # Photos of an album arrive as separate updates, all at once
+        album = f"album-{first}" if count > 1 else None
+        chat_id = (first // args.album_size) % args.users
+        async with semaphore:
+            await asyncio.gather(*(send(request_id, chat_id, album) for request_id in range(first, first + count)))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        one(first, min(args.album_size, args.requests - first))
+        for first in range(0, args.requests, args.album_size)
+    ))
+    elapsed = time.perf_counter() - started
+    await asyncio.gather(*bot.job_tasks)
+    await bot.scheduler.close()
+    bot.worker_pool.shutdown()
+
+    outcomes = defaultdict(int)
+    for outcome in telegram.outcomes.values():
+        outcomes[outcome] += 1
+    rss = peak_rss_mb()
+    return {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "album_size": args.album_size,
+        "workers": args.workers,
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(args.requests / elapsed, 2),
+        "outcomes": dict(outcomes),
+        "model_calls": client.calls,
+        "model_failures": client.failures,
+        "max_model_in_flight": client.max_in_flight,
+        "model_throttled": client.throttled,
+        "model_concurrency_limit": bot.image_processor.resilience.limiter.limit,
+        "cache": dict(bot.result_cache.stats),
+        "peak_rss_mb": round(rss, 1) if rss is not None else None,
+        "stages": recorder.summary(),
+        "stage_peak_bytes": REGISTRY.snapshot().get("stage_peak_bytes", {}),
+        "metrics": REGISTRY.snapshot(),
+    }
+
+
+def print_report(report):
+    print("=" * 64)
+    print(
+        f"Requests: {report['requests']}  Concurrency: {report['concurrency']}  "
+        f"Workers: {report['workers']}"
+    )
+    print(f"Elapsed: {report['elapsed_s']}s  Throughput: {report['throughput_rps']} req/s")
+    print(f"Outcomes: {report['outcomes']}")
+    print(
+        f"Model calls: {report['model_calls']} (failures: {report['model_failures']}, "
+        f"max in flight: {report['max_model_in_flight']}, throttled: {report['model_throttled']})"
+    )
+    print(f"Model concurrency limit at the end: {report['model_concurrency_limit']}")
+    print(f"Peak RSS: {report['peak_rss_mb']} MB")
+    print("-" * 64)
+    print(f"{'stage':<16}{'count':>8}{'p50 ms':>12}{'p95 ms':>12}{'p99 ms':>12}")
+    for stage, values in report["stages"].items():
+        print(f"{stage:<16}{values['count']:>8}{values['p50_ms']:>12}{values['p95_ms']:>12}{values['p99_ms']:>12}")
+    if report["stage_peak_bytes"]:
+        print("-" * 64)
+        print(f"{'stage':<16}{'count':>8}{'avg peak MB':>16}{'p95 peak MB':>16}")
+        for key, values in report["stage_peak_bytes"].items():
+            stage = key.split("=", 1)[-1]
+            avg_mb = values["avg"] / (1024 * 1024)
+            p95_mb = values["p95"] / (1024 * 1024)
+            print(f"{stage:<16}{values['count']:>8}{avg_mb:>16.1f}{p95_mb:>16.1f}")
+    print("=" * 64)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the photo pipeline with a fake Gemini client")
+    parser.add_argument("--requests", type=int, default=100, help="Total synthetic updates (default: 100)")
+    parser.add_argument("--concurrency", type=int, default=20, help="Updates in flight at once (default: 20)")
+    parser.add_argument("--users", type=int, default=10, help="Distinct chat ids (default: 10)")
+    parser.add_argument("--album-size", type=int, default=1,
+                        help="Photos sent together as one album (default: 1, no albums)")
+    parser.add_argument("--kind", choices=["photo", "document", "mixed"], default="photo")
+    parser.add_argument("--workers", type=int, default=default_max_workers(),
+                        help="Worker pool size (default: MAX_CONCURRENT_JOBS, else MODEL_CONCURRENCY_MAX)")
+    parser.add_argument("--queue-depth", type=int, default=1000, help="Scheduler queue depth (default: 1000)")
+    parser.add_argument("--timeout", type=float, default=120, help="Per-job timeout in seconds (default: 120)")
+    parser.add_argument("--latency", type=float, default=2.0, help="Mean fake model latency in seconds (default: 2.0)")
+    parser.add_argument("--jitter", type=float, default=0.5, help="Uniform latency jitter in seconds (default: 0.5)")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of failing model calls (default: 0)")
+    parser.add_argument("--capacity", type=int, default=None,
+                        help="Concurrent calls the fake model accepts before answering 429 (default: unlimited)")
+    parser.add_argument("--download-latency", type=float, default=0.05, help="Simulated Telegram download seconds")
+    parser.add_argument("--upload-latency", type=float, default=0.1, help="Simulated Telegram upload seconds")
+    parser.add_argument("--user-per-hour", type=float, default=0,
+                        help="Per-user rate limit in photos per hour (default: 0, disabled)")
+    parser.add_argument("--global-per-minute", type=float, default=0,
+                        help="Global rate limit in model requests per minute (default: 0, disabled)")
+    parser.add_argument("--candidates", type=int, default=1,
+                        help="Generations per attempt, the best one is kept (default: 1)")
+    parser.add_argument("--local-fastpath", action="store_true", help="Allow the local engine to skip the model")
+    parser.add_argument("--duplicates", action="store_true", help="Send identical bytes so the result cache applies")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed (default: 1)")
+    parser.add_argument("--json", help="Also write the report as JSON to this path")
+    parser.add_argument("--memory-profile", action="store_true",
+                        help="Record peak allocations per stage with tracemalloc (slow; use --concurrency 1)")
+    parser.add_argument("--verbose", action="store_true", help="Show the pipeline's own progress output")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.memory_profile:
+        enable_memory_profiling()
+    # ImageProcessor narrates every step with print(); keep the report readable
+    with contextlib.ExitStack() as stack:
+        if not args.verbose:
+            logging.getLogger().setLevel(logging.ERROR)
+            stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+            stack.enter_context(contextlib.redirect_stderr(io.StringIO()))
+        report = asyncio.run(run_benchmark(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return True
+
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,145 @@
+import logging
+import os
+import numpy as np
+from face_detection import FaceDetector
+from imaging import as_decoded
+
+logger = logging.getLogger(__name__)
+
+
+class ComplianceReport:
+    """Measurements of one output image and the checks it failed"""
+
+    def __init__(self, measurements, failures, score):
+        self.measurements = measurements
+        self.failures = failures
+        self.score = score
+
+    @property
+    def passed(self):
+        return not self.failures
+
+    def to_dict(self):
+        return {
+            "passed": self.passed,
+            "score": round(self.score, 3),
+            "failures": list(self.failures),
+            "measurements": {k: (round(v, 3) if isinstance(v, float) else v) for k, v in self.measurements.items()},
+        }
+
+    def __repr__(self):
+        return f"ComplianceReport(passed={self.passed}, score={self.score:.2f}, failures={self.failures})"
+
+
+class ComplianceChecker:
+    """
+    Fast local checks on a generated passport photo.
+
+    Measures border whiteness and uniformity, face position and head-to-frame
+    ratio, sharpness (variance of the Laplacian) and contrast using vectorised
+    NumPy operations on a 600 px-or-smaller copy, and runs a coarse face
+    detection on a 160 px copy, so a check costs a few ms.
+    Face checks are skipped when no face detector is available.
+    """
+
+    def __init__(self, detector=None, min_whiteness=None, max_border_std=None, min_sharpness=None, min_contrast=None):
+        self.detector = detector or FaceDetector()
+        self.min_whiteness = min_whiteness or float(os.environ.get("COMPLIANCE_MIN_WHITENESS", "225"))
+        self.max_border_std = max_border_std or float(os.environ.get("COMPLIANCE_MAX_BORDER_STD", "12"))
+        self.min_sharpness = min_sharpness or float(os.environ.get("COMPLIANCE_MIN_SHARPNESS", "40"))
+        self.min_contrast = min_contrast or float(os.environ.get("COMPLIANCE_MIN_CONTRAST", "35"))
+
+    def check(self, image, head_ratio=0.6, eye_line=0.38, head_tolerance=0.09, eye_tolerance=0.07, center_tolerance=0.08):
+        """
+        Check an encoded output image
+
+        Args:
+            image: DecodedImage or encoded image bytes
+            head_ratio: Target head height as a fraction of the frame height
+            eye_line: Target eye position as a fraction from the top
+            head_tolerance, eye_tolerance, center_tolerance: Allowed deviations
+
+        Returns:
+            ComplianceReport
+        """
+        pixels = as_decoded(image, 600).array(600, "L")
+        gray = pixels.astype(np.float32)
+        height, width = gray.shape
+
+        strip = max(2, height // 30)
+        # Top edge plus the upper half of both sides; the shoulders fill the rest
+        border = np.concatenate([
+            gray[:strip].ravel(),
+            gray[:height // 2, :strip].ravel(),
+            gray[:height // 2, -strip:].ravel(),
+        ])
+        whiteness = float(border.mean())
+        border_std = float(border.std())
+
+        laplacian = (
+            gray[:-2, 1:-1] + gray[2:, 1:-1] + gray[1:-1, :-2] + gray[1:-1, 2:] - 4.0 * gray[1:-1, 1:-1]
+        )
+        sharpness = float(laplacian.var())
+        contrast = float(gray.std())
+
+        measurements = {
+            "border_whiteness": whiteness,
+            "border_std": border_std,
+            "sharpness": sharpness,
+            "contrast": contrast,
+        }
+        failures = []
+        scores = [
+            min(1.0, max(0.0, (whiteness - 180.0) / (self.min_whiteness - 180.0))),
+            min(1.0, max(0.0, 2.0 - border_std / self.max_border_std)),
+            min(1.0, sharpness / self.min_sharpness),
+            min(1.0, contrast / self.min_contrast),
+        ]
+        if whiteness < self.min_whiteness:
+            failures.append("background_not_white")
+        if border_std > self.max_border_std:
+            failures.append("background_not_uniform")
+        if sharpness < self.min_sharpness:
+            failures.append("blurry")
+        if contrast < self.min_contrast:
+            failures.append("low_contrast")
+
+        if self.detector.available:
+            # Output faces are large, so a small copy and a big minimum size suffice
+            faces = self.detector.detect(
+                pixels,
+                max_side=160,
+                min_fraction=0.3,
+                scale_factor=1.2,
+            )
+            measurements["faces"] = len(faces)
+            if not faces:
+                failures.append("no_face")
+                scores.append(0.0)
+            else:
+                face = faces[0]
+                offset = abs(face.center_x / width - 0.5)
+                head = face.head_height / height
+                eyes = face.eye_y / height
+                measurements.update({
+                    "face_box": [int(face.x), int(face.y), int(face.width), int(face.height)],
+                    "center_offset": offset,
+                    "head_ratio": head,
+                    "eye_line": eyes,
+                })
+                if len(faces) > 1:
+                    failures.append("multiple_faces")
+                if offset > center_tolerance:
+                    failures.append("face_not_centered")
+                if abs(head - head_ratio) > head_tolerance:
+                    failures.append("head_too_small" if head < head_ratio else "head_too_large")
+                if abs(eyes - eye_line) > eye_tolerance:
+                    failures.append("eyes_misplaced")
+                scores.extend([
+                    max(0.0, 1.0 - offset / (2 * center_tolerance)),
+                    max(0.0, 1.0 - abs(head - head_ratio) / (2 * head_tolerance)),
+                    max(0.0, 1.0 - abs(eyes - eye_line) / (2 * eye_tolerance)),
+                    1.0 if len(faces) == 1 else 0.5,
+                ])
+
+        return ComplianceReport(measurements, failures, float(np.mean(scores)))
@@ -0,0 +1,109 @@
+import logging
+
+try:
+    import cv2
+except ImportError:  # pragma: no cover - OpenCV is optional
+    cv2 = None
+
+logger = logging.getLogger(__name__)
+
+
+class Face:
+    """
+    A detected face with estimated head geometry.
+
+    Haar cascades box the face from roughly the eyebrows to the chin. The top of
+    the head, the chin and the eye line are extrapolated from that box using
+    typical adult proportions.
+    """
+
+    def __init__(self, x, y, width, height, score):
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.score = score
+
+    @property
+    def center_x(self):
+        return self.x + self.width / 2
+
+    @property
+    def head_top(self):
+        return self.y - 0.27 * self.height
+
+    @property
+    def chin(self):
+        return self.y + 1.03 * self.height
+
+    @property
+    def head_height(self):
+        return self.chin - self.head_top
+
+    @property
+    def eye_y(self):
+        return self.y + 0.37 * self.height
+
+    def __repr__(self):
+        return f"Face(x={self.x}, y={self.y}, width={self.width}, height={self.height}, score={self.score:.1f})"
+
+
+class FaceDetector:
+    """CPU face detector built on OpenCV's bundled frontal face Haar cascade"""
+
+    def __init__(self, cascade_name="haarcascade_frontalface_default.xml", min_size=40):
+        self.min_size = min_size
+        self._cascade = None
+        if cv2 is None:
+            logger.info("OpenCV not installed; local face detection disabled")
+            return
+        cascade = cv2.CascadeClassifier(cv2.data.haarcascades + cascade_name)
+        if cascade.empty():
+            logger.warning(f"Could not load face cascade {cascade_name}")
+            return
+        self._cascade = cascade
+
+    @property
+    def available(self):
+        return self._cascade is not None
+
+    def detect(self, gray, max_side=480, min_fraction=None, scale_factor=1.1):
+        """
+        Find faces in a grayscale uint8 array
+
+        Args:
+            gray: 2-D uint8 array
+            max_side: Detection runs on a copy no larger than this
+            min_fraction: Smallest face to look for, as a fraction of the
+                shorter side; large minimums make detection much cheaper
+            scale_factor: Step between cascade scales; coarser is faster
+
+        Returns:
+            List of Face objects, largest first
+        """
+        if not self.available:
+            return []
+        # Detect on a bounded-size copy; cascades are slow on large frames
+        scale = min(1.0, max_side / max(gray.shape))
+        small = gray
+        if scale < 1.0:
+            small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        min_size = max(1, int(self.min_size * scale))
+        if min_fraction is not None:
+            min_size = max(min_size, int(min(small.shape) * min_fraction))
+        boxes, _, weights = self._cascade.detectMultiScale3(
+            small,
+            scaleFactor=scale_factor,
+            minNeighbors=5,
+            minSize=(min_size, min_size),
+            outputRejectLevels=True,
+        )
+        if len(boxes) == 0:
+            return []
+        # Weights come back as an (n, 1) array; take the scalars explicitly
+        faces = [
+            Face(float(x / scale), float(y / scale), float(w / scale), float(h / scale), float(weight))
+            for (x, y, w, h), weight in zip(boxes, weights.ravel())
+        ]
+        faces.sort(key=lambda face: face.width * face.height, reverse=True)
+        return faces
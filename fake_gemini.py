@@ -0,0 +1,170 @@
+"""
+Local stand-in for the Gemini client
+
+FakeGeminiClient mimics the parts of ``genai.Client`` that ImageProcessor uses
+(``models.generate_content_stream`` and ``caches.create``) with configurable
+latency, failure rate and output images, so the pipeline can be benchmarked
+and exercised without network access or API costs.
+"""
+
+import io
+import random
+import threading
+import time
+import types as _types
+from PIL import Image
+from google.genai import types
+from reference_templates import SAMPLE_IMAGE_PATH
+
+
+class FakeGeminiError(Exception):
+    """Simulated upstream failure"""
+
+    def __init__(self, message, code=500):
+        super().__init__(message)
+        self.code = code
+
+
+def synthetic_portrait(size=(1000, 1200), background=(236, 236, 236), seed=None):
+    """
+    A portrait built from the bundled sample photo on a plain background
+
+    Returns:
+        JPEG bytes
+    """
+    rng = random.Random(seed)
+    with Image.open(SAMPLE_IMAGE_PATH) as sample:
+        # The photo area of the sample, without the measurement annotations
+        person = sample.convert("RGB").crop((90, 195, 340, 447))
+    scale = 0.7 * size[0] / person.width
+    person = person.resize((int(person.width * scale), int(person.height * scale)), Image.Resampling.LANCZOS)
+    canvas = Image.new("RGB", size, background)
+    left = (size[0] - person.width) // 2 + rng.randint(-size[0] // 20, size[0] // 20)
+    canvas.paste(person, (left, size[1] - person.height))
+    output = io.BytesIO()
+    canvas.save(output, "JPEG", quality=90)
+    return output.getvalue()
+
+
+class _FakeModels:
+    def __init__(self, client):
+        self._client = client
+
+    def generate_content_stream(self, *, model, contents, config=None):
+        return self._client._generate(model, contents, config)
+
+
+class _FakeCaches:
+    def __init__(self, client):
+        self._client = client
+
+    def create(self, *, model, config=None):
+        if not self._client.support_caching:
+            raise FakeGeminiError("Cached content is not supported for this model", code=400)
+        with self._client._lock:
+            self._client.cache_creates += 1
+            name = f"cachedContents/fake-{self._client.cache_creates}"
+        return _types.SimpleNamespace(name=name)
+
+
+class FakeGeminiClient:
+    """
+    Scriptable fake of ``genai.Client`` for benchmarks and local testing
+
+    Args:
+        latency: Mean seconds per generation, or a callable
+            ``latency(call_number) -> seconds``
+        jitter: Uniform +/- jitter in seconds added to a numeric latency
+        failure_rate: Probability that a call raises FakeGeminiError
+        outputs: List of image bytes returned in rotation, or a callable
+            ``outputs(call_number, user_image_bytes) -> bytes``; by default the
+            user's own image is echoed back
+        errors: Optional callable ``errors(call_number) -> exception or None``
+            for scripted failures (e.g. a run of 429s)
+        capacity: Concurrent calls the fake upstream accepts, or a callable
+            ``capacity(call_number) -> int``; calls beyond it fail with 429
+            like an exhausted quota. None means unlimited
+        chunks: Number of empty chunks streamed before the image
+        support_caching: Whether ``caches.create`` succeeds
+        seed: Random seed for jitter and failures
+    """
+
+    def __init__(self, latency=2.0, jitter=0.0, failure_rate=0.0, outputs=None, errors=None,
+                 chunks=1, support_caching=False, capacity=None, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.outputs = outputs
+        self.errors = errors
+        self.chunks = chunks
+        self.support_caching = support_caching
+        self.capacity = capacity
+        self.models = _FakeModels(self)
+        self.caches = _FakeCaches(self)
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+        self.throttled = 0
+        self.cache_creates = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        # ids of the reference image buffers seen; one id means it was loaded once
+        self.reference_ids = set()
+
+    def _next_call(self):
+        with self._lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            call_number = self.calls
+            fail = self._random.random() < self.failure_rate
+            jitter = self._random.uniform(-self.jitter, self.jitter) if self.jitter else 0.0
+            capacity = self.capacity(call_number) if callable(self.capacity) else self.capacity
+            throttled = capacity is not None and self.in_flight > capacity
+            if throttled:
+                self.throttled += 1
+        return call_number, fail, jitter, throttled
+
+    def _generate(self, model, contents, config):
+        call_number, fail, jitter, throttled = self._next_call()
+        try:
+            parts = contents[0].parts
+            images = [part.inline_data.data for part in parts if part.inline_data is not None]
+            if len(images) > 1:
+                with self._lock:
+                    self.reference_ids.add(id(images[0]))
+            user_image = images[-1]
+
+            delay = self.latency(call_number) if callable(self.latency) else max(0.0, self.latency + jitter)
+            error = self.errors(call_number) if self.errors else None
+            if error is None and throttled:
+                error = FakeGeminiError("Resource exhausted (simulated quota)", code=429)
+            if error is None and fail:
+                error = FakeGeminiError("Simulated upstream error", code=503)
+            if error is not None:
+                # Failures usually come back faster than successes
+                time.sleep(delay / 4)
+                with self._lock:
+                    self.failures += 1
+                raise error
+
+            per_chunk = delay / (self.chunks + 1)
+            for _ in range(self.chunks):
+                time.sleep(per_chunk)
+                yield types.GenerateContentResponse(candidates=[types.Candidate(content=None)])
+            time.sleep(per_chunk)
+
+            if callable(self.outputs):
+                output = self.outputs(call_number, user_image)
+            elif self.outputs:
+                output = self.outputs[(call_number - 1) % len(self.outputs)]
+            else:
+                output = user_image
+            yield types.GenerateContentResponse(candidates=[types.Candidate(
+                content=types.Content(parts=[types.Part.from_bytes(data=output, mime_type="image/png")]),
+            )])
+        finally:
+            with self._lock:
+                self.in_flight -= 1
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class FileIdCache:
+    """
+    Telegram file_ids of files the bot has already uploaded.
+
+    Once Telegram has a file, sending its ``file_id`` again delivers it
+    without re-uploading the bytes. Entries are keyed by the SHA-256 of the
+    file contents (plus a kind prefix such as ``sample`` or ``result``), kept
+    in a bounded LRU and persisted as JSON so they survive restarts.
+
+    Changes only mark the cache dirty. After start(), a background thread
+    rewrites the JSON file every ``flush_interval`` seconds when something
+    changed, and stop() writes it one last time, so the event loop never
+    waits for the file. Several processes may share it; the last writer
+    wins, which only costs the others a re-upload.
+    """
+
+    def __init__(self, path=None, max_entries=None, flush_interval=None):
+        self.path = path if path is not None else os.environ.get("FILE_ID_CACHE_PATH", ".cache/file_ids.json")
+        self.max_entries = max_entries or int(os.environ.get("FILE_ID_CACHE_MAX_ENTRIES", "10000"))
+        if flush_interval is None:
+            flush_interval = float(os.environ.get("FILE_ID_CACHE_FLUSH_INTERVAL", "30"))
+        self.flush_interval = flush_interval
+        self._entries = OrderedDict()
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.load()
+
+    @staticmethod
+    def key_for(data, kind="result"):
+        return f"{kind}:{hashlib.sha256(data).hexdigest()}"
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable file_id cache {self.path}: {e}")
+            return
+        with self._lock:
+            self._entries = OrderedDict(list(entries.items())[-self.max_entries:])
+
+    def get(self, key):
+        with self._lock:
+            file_id = self._entries.get(key)
+            if file_id is not None:
+                self._entries.move_to_end(key)
+            return file_id
+
+    def put(self, key, file_id):
+        with self._lock:
+            if self._entries.get(key) == file_id:
+                return
+            self._entries[key] = file_id
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._dirty = True
+
+    def discard(self, key):
+        """Forget a file_id Telegram no longer accepts"""
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._dirty = True
+
+    def start(self):
+        """Write changes in the background every ``flush_interval`` seconds"""
+        if not self.path or self.flush_interval <= 0:
+            return self
+        self._thread = threading.Thread(target=self._run, name="file-id-cache", daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def stop(self):
+        """Stop the background writer and write any remaining changes"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def flush(self):
+        """Write the entries to ``path`` if they changed since the last write"""
+        with self._lock:
+            if not self.path or not self._dirty:
+                return
+            entries = dict(self._entries)
+            self._dirty = False
+        directory = os.path.dirname(self.path)
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(entries, f)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logger.warning(f"File_id cache write failed: {e}")
+            with self._lock:
+                self._dirty = True
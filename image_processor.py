@@ -1,194 +1,377 @@
-import base64
-import mimetypes
+import logging
 import os
-import io
-from PIL import Image
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from google import genai
 from google.genai import types
 from dotenv import load_dotenv
+from reference_templates import TemplateRegistry
+from imaging import DecodedImage, InvalidImageError, OutputEncoder, fit_output, normalize_for_upload
+from local_processor import LocalProcessor
+from face_detection import FaceDetector
+from compliance import ComplianceChecker
+from metrics import CANDIDATES, RETRIES, stage
+from rate_limit import RateLimitExceeded
+from resilience import ResilientCaller
 
 # Load environment variables
 load_dotenv('config.env')
 
+logger = logging.getLogger(__name__)
+
 class ImageProcessor:
-    def __init__(self):
-        self.client = genai.Client(
+    def __init__(self, client=None, templates=None, local_processor=None, compliance_checker=None,
+                 resilience=None):
+        self.client = client or genai.Client(
             api_key=os.environ.get("GEMINI_API_KEY"),
         )
         self.model = "gemini-2.5-flash-image-preview"
+        # Reference images and prompts are loaded once at startup
+        self.templates = templates or TemplateRegistry(self.client, self.model)
+        face_detector = FaceDetector()
+        # Every result, local or generated, is encoded to OUTPUT_FORMAT within OUTPUT_MAX_BYTES
+        self.output_encoder = OutputEncoder()
+        # Offline engine for easy photos; Gemini is only used when it is unsure
+        self.local_processor = local_processor
+        if self.local_processor is None and os.environ.get("LOCAL_FASTPATH", "0") == "1":
+            self.local_processor = LocalProcessor(detector=face_detector, encoder=self.output_encoder)
+        self.local_confidence_threshold = float(os.environ.get("LOCAL_CONFIDENCE_THRESHOLD", "0.8"))
+        # Every model output is checked; failing ones are retried a bounded number of times
+        self.compliance_checker = compliance_checker
+        if self.compliance_checker is None and os.environ.get("COMPLIANCE_CHECK", "1") == "1":
+            self.compliance_checker = ComplianceChecker(detector=face_detector)
+        self.max_attempts = max(1, int(os.environ.get("COMPLIANCE_MAX_ATTEMPTS", "2")))
+        # Best-of-N: generations run at once per attempt; the first to pass this score wins
+        self.candidates = max(1, int(os.environ.get("MODEL_CANDIDATES", "1")))
+        self.candidate_min_score = float(os.environ.get("MODEL_CANDIDATE_MIN_SCORE", "0"))
+        self._candidate_executor = None
+        # Timeouts, retries, hedging and the circuit breaker around model calls
+        self.resilience = resilience or ResilientCaller()
+        # User photos are decoded once at this size and shared by every step
+        self.decode_max_side = int(os.environ.get("DECODE_MAX_SIDE", "1600"))
+        # Optional process pool for decode/resize/encode steps (used by batch_process)
+        self.cpu_executor = None
         
-    def encode_image_to_base64(self, image_path):
-        """Convert image file to base64 string"""
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
-    
-    def save_binary_file(self, file_name, data):
-        """Save binary data to file"""
-        with open(file_name, "wb") as f:
-            f.write(data)
-        print(f"File saved to: {file_name}")
-    
-    def process_image(self, user_image_path, sample_image_path="./sample/image.png"):
+    def process_image(self, user_image, template="dv", cancel_event=None):
         """
-        Process user image using Gemini API with sample image as reference
+        Process user image using Gemini API with a reference template
         
         Args:
-            user_image_path: Path to the user's uploaded image
-            sample_image_path: Path to the sample image (default: ./image.png)
+            user_image: Raw bytes of the user's uploaded image, or the
+                DecodedImage returned by validate_image
+            template: Name of the reference template (default: dv)
+            cancel_event: Optional threading.Event; when set, streaming stops early
         
         Returns:
-            Path to the processed image or None if failed
+            Encoded bytes (OUTPUT_FORMAT) of the processed image at the template's size or None if failed
+        
+        Raises:
+            RateLimitExceeded: If the resilience layer charges a RateLimiter
+                and the model quota ran out before any result was made
         """
+        with stage("process_image"):
+            return self._process_image(user_image, template, cancel_event)
+    
+    def _process_image(self, user_image, template, cancel_event):
         try:
-            print(f"Processing image: {user_image_path}")
-            print(f"Using sample image: {sample_image_path}")
-            
-            # Check if sample image exists
-            if not os.path.exists(sample_image_path):
-                print(f"Sample image not found: {sample_image_path}")
+            decoded = user_image if isinstance(user_image, DecodedImage) else self.validate_image(user_image)
+            if decoded is None:
+                print("Invalid image")
                 return None
+            print(f"Processing image: {len(decoded.data)} bytes ({decoded.size[0]}x{decoded.size[1]} decoded)")
+            print(f"Using template: {template}")
             
-            # Encode both images to base64
-            sample_image_b64 = self.encode_image_to_base64(sample_image_path)
-            user_image_b64 = self.encode_image_to_base64(user_image_path)
-            print("Images encoded to base64 successfully")
-            
-            # Create the prompt for image correction
-            prompt = """
-            Given a user-uploaded photo, resize and correct it into a standard passport/ID photo format with:
-
-            White background (clean, uniform).
-            Face centered and scaled to fit the frame.
-            Image size: 600x600 pixels.
-            Proper brightness and contrast so the face is clearly visible.
-            Crop extra background while keeping the head and shoulders visible to the point as shown in the reference image no more.
-            Ensure the output is a sharp, high-quality image in JPEG or PNG format.
-
-            Use the first image as a reference sample and correct the second image accordingly.
-            """
+            reference = self.templates.get(template)
+            if not reference.available:
+                print(f"Sample image not found: {reference.sample_image_path}")
+                return None
             
-            # Prepare content with both images
-            contents = [
-                types.Content(
-                    role="user",
-                    parts=[
-                        types.Part.from_bytes(
-                            mime_type="image/png",
-                            data=base64.b64decode(sample_image_b64)
-                        ),
-                        types.Part.from_bytes(
-                            mime_type="image/jpeg",
-                            data=base64.b64decode(user_image_b64)
-                        ),
-                        types.Part.from_text(text=prompt),
-                    ],
-                ),
-            ]
+            # Try the local engine first; well-lit photos never need the model
+            local_result = None
+            if self.local_processor is not None and self.local_processor.available:
+                with stage("local"):
+                    local_result = self.local_processor.process(
+                        decoded,
+                        reference.output_size,
+                        reference.head_ratio,
+                        reference.eye_line,
+                    )
+                if local_result is not None:
+                    print(f"Local processing confidence: {local_result.confidence:.2f}")
+                    if local_result.confidence >= self.local_confidence_threshold:
+                        return local_result.image
             
-            # Configure generation
-            generate_content_config = types.GenerateContentConfig(
-                response_modalities=["IMAGE"],
+            # Orient, downscale and re-encode before upload to keep the request small
+            with stage("normalize"):
+                upload_image, upload_mime_type, upload_stats = self.run_cpu(normalize_for_upload, decoded)
+            print(
+                f"Prepared {upload_stats['format']} upload: {upload_stats['upload_bytes']} bytes "
+                f"(saved {upload_stats['saved_bytes']} bytes)"
             )
             
-            # Generate processed image
-            print("Sending request to Gemini API...")
-            file_index = 0
-            output_path = None
+            # Reuse the prebuilt reference prefix; only the user's image is new
+            contents, generate_content_config = self.templates.build_request(
+                template,
+                types.Part.from_bytes(mime_type=upload_mime_type, data=upload_image),
+            )
             
-            for chunk in self.client.models.generate_content_stream(
-                model=self.model,
-                contents=contents,
-                config=generate_content_config,
-            ):
-                if (
-                    chunk.candidates is None
-                    or chunk.candidates[0].content is None
-                    or chunk.candidates[0].content.parts is None
-                ):
-                    continue
-                    
-                if (chunk.candidates[0].content.parts[0].inline_data and 
-                    chunk.candidates[0].content.parts[0].inline_data.data):
-                    
-                    file_name = f"processed_image_{file_index}"
-                    file_index += 1
-                    inline_data = chunk.candidates[0].content.parts[0].inline_data
-                    data_buffer = inline_data.data
-                    file_extension = mimetypes.guess_extension(inline_data.mime_type)
-                    
-                    if file_extension is None:
-                        file_extension = ".png"
-                    
-                    output_path = f"{file_name}{file_extension}"
-                    self.save_binary_file(output_path, data_buffer)
-                    
-                    # Resize the processed image to 600x600 pixels
-                    resized_path = self.resize_image_to_600x600(output_path)
-                    if resized_path:
-                        # Remove the original file and use the resized one
-                        if os.path.exists(output_path):
-                            os.remove(output_path)
-                        output_path = resized_path
-                    
+            # One deadline covers every model call made for this photo
+            deadline = time.monotonic() + self.resilience.deadline
+            best_image, best_report = None, None
+            for attempt in range(1, self.max_attempts + 1):
+                if attempt > 1:
+                    RETRIES.inc(reason="compliance")
+                # Generate processed image, or several and keep the best
+                print(f"Sending request to Gemini API (attempt {attempt}/{self.max_attempts})...")
+                try:
+                    if self.candidates > 1 and self.compliance_checker is not None:
+                        output, report = self.generate_candidates(
+                            contents, generate_content_config, reference, cancel_event, deadline
+                        )
+                    else:
+                        output, report = self.generate_candidate(
+                            contents, generate_content_config, reference, cancel_event, deadline
+                        )
+                except RateLimitExceeded:
+                    # Out of quota: keep what we have, else let the caller tell the user
+                    if best_image is None and local_result is None:
+                        raise
+                    print("Gemini quota exhausted, keeping the best result so far")
+                    break
+                except Exception as e:
+                    print(f"Gemini request failed: {e}")
                     break
+                if cancel_event is not None and cancel_event.is_set():
+                    return None
+                if output is None:
+                    continue
+                if report is None:
+                    return output.data
+                
+                print(f"Compliance check: {report}")
+                if report.passed:
+                    return output.data
+                if best_report is None or report.score > best_report.score:
+                    best_image, best_report = output, report
             
-            return output_path
+            # Nothing passed: fall back to whichever candidate scored best
+            if local_result is not None:
+                if best_image is None:
+                    print("Gemini unavailable, using the local result")
+                    return local_result.image
+                if self.compliance_checker is not None:
+                    local_report = self.check_output(local_result.decoded or local_result.image, reference)
+                    print(f"Local fallback compliance check: {local_report}")
+                    if local_report.score > best_report.score:
+                        return local_result.image
+            return best_image.data if best_image is not None else None
             
+        except RateLimitExceeded:
+            raise
         except Exception as e:
             print(f"Error processing image: {str(e)}")
             import traceback
             traceback.print_exc()
             return None
     
-    def resize_image_to_600x600(self, image_path):
+    def generate(self, contents, generate_content_config, cancel_event=None, deadline=None):
         """
-        Resize image to exactly 600x600 pixels while maintaining aspect ratio
+        Run one Gemini generation and return the first image it streams back
+        
+        The call goes through ``self.resilience``: slow attempts are abandoned
+        or hedged and transient errors retried until ``deadline``.
+        
+        Returns:
+            Encoded image bytes or None if the model returned no image
+        
+        Raises:
+            CircuitOpenError: If recent calls failed too often
+            DeadlineExceededError: If the model did not answer in time
+            RateLimitExceeded: If the model quota is used up for too long
+        """
+        with stage("model"):
+            return self.resilience.call(
+                lambda abandon: self.stream_image(contents, generate_content_config, abandon),
+                cancel_event,
+                deadline,
+            )
+    
+    def generate_candidate(self, contents, generate_content_config, reference, cancel_event=None, deadline=None):
+        """
+        Generate one image, fit it to the template's output size and check it
         
-        Args:
-            image_path: Path to the image file to resize
-            
         Returns:
-            Path to the resized image or None if failed
+            (output, report): the resized DecodedImage (or None) and its
+            ComplianceReport (None when checks are disabled)
+        """
+        generated = self.generate(contents, generate_content_config, cancel_event, deadline)
+        if generated is None or (cancel_event is not None and cancel_event.is_set()):
+            return None, None
+        
+        # Resize the processed image to the template's output size
+        output = self.resize_image(generated, reference.output_size)
+        if output is None or self.compliance_checker is None:
+            return output, None
+        return output, self.check_output(output, reference)
+    
+    def generate_candidates(self, contents, generate_content_config, reference, cancel_event=None, deadline=None):
         """
+        Run ``self.candidates`` generations at once and return the best one
+        
+        Candidates are checked as they arrive. The first that passes with a
+        score of at least ``self.candidate_min_score`` is returned straight
+        away and the generations still streaming are cancelled; otherwise
+        the highest scoring candidate wins once all have finished. Cancelled
+        candidates are not recorded by the circuit breaker, so only real
+        answers count towards its failure rate.
+        
+        Returns:
+            (output, report) of the best candidate, or (None, None)
+        
+        Raises:
+            Exception: The last model error when no candidate produced an image
+        """
+        if self._candidate_executor is None:
+            self._candidate_executor = ThreadPoolExecutor(
+                max_workers=int(os.environ.get("MODEL_MAX_THREADS", "32")),
+                thread_name_prefix="candidate",
+            )
+        # Set once a winner is found or the job is cancelled; stops the other streams
+        stop = threading.Event()
+        pending = {
+            self._candidate_executor.submit(
+                self.generate_candidate, contents, generate_content_config, reference, stop, deadline
+            )
+            for _ in range(self.candidates)
+        }
+        best_output, best_report, error = None, None, None
         try:
-            with Image.open(image_path) as img:
-                # Convert to RGB if necessary (handles RGBA, P mode, etc.)
-                if img.mode != 'RGB':
-                    img = img.convert('RGB')
-                
-                # Resize to 600x600 using high-quality resampling
-                resized_img = img.resize((600, 600), Image.Resampling.LANCZOS)
-                
-                # Create new filename with _600x600 suffix
-                base_name, ext = os.path.splitext(image_path)
-                resized_path = f"{base_name}_600x600.png"
+            while pending:
+                if cancel_event is not None and cancel_event.is_set():
+                    return None, None
+                done, pending = wait(pending, timeout=0.25, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        output, report = future.result()
+                    except Exception as e:
+                        CANDIDATES.inc(outcome="failed")
+                        error = e
+                        continue
+                    if output is None:
+                        CANDIDATES.inc(outcome="failed")
+                        continue
+                    CANDIDATES.inc(outcome="scored")
+                    print(f"Candidate compliance check: {report}")
+                    if best_report is None or report.score > best_report.score:
+                        best_output, best_report = output, report
+                    if report.passed and report.score >= self.candidate_min_score:
+                        return output, report
+        finally:
+            stop.set()
+            if pending:
+                print(f"Cancelling {len(pending)} remaining candidates")
+                CANDIDATES.inc(len(pending), outcome="cancelled")
+        if best_output is None and error is not None:
+            raise error
+        return best_output, best_report
+    
+    def stream_image(self, contents, generate_content_config, cancel_event=None):
+        """
+        Stream one generation and return the first inline image, or None
+        
+        Runs on a model-call thread that may outlive its job when the attempt
+        is abandoned, so it logs instead of printing.
+        """
+        for chunk in self.client.models.generate_content_stream(
+            model=self.model,
+            contents=contents,
+            config=generate_content_config,
+        ):
+            if cancel_event is not None and cancel_event.is_set():
+                logger.debug("Model stream cancelled")
+                return None
+            
+            if (
+                chunk.candidates is None
+                or chunk.candidates[0].content is None
+                or chunk.candidates[0].content.parts is None
+            ):
+                continue
                 
-                # Save as PNG (lossless)
-                resized_img.save(resized_path, 'PNG')
+            if (chunk.candidates[0].content.parts[0].inline_data and 
+                chunk.candidates[0].content.parts[0].inline_data.data):
                 
-                print(f"Image resized to 600x600: {resized_path}")
-                return resized_path
+                inline_data = chunk.candidates[0].content.parts[0].inline_data
+                logger.debug(f"Received {inline_data.mime_type} image: {len(inline_data.data)} bytes")
+                return inline_data.data
+        
+        return None
+    
+    def check_output(self, image, reference):
+        """Run the compliance checker against a template's framing targets"""
+        with stage("compliance"):
+            return self.compliance_checker.check(
+                image,
+                head_ratio=reference.head_ratio,
+                eye_line=reference.eye_line,
+            )
+    
+    def run_cpu(self, func, *args):
+        """Run a CPU-bound image step inline, or in ``cpu_executor`` when one is set"""
+        if self.cpu_executor is None:
+            return func(*args)
+        return self.cpu_executor.submit(func, *args).result()
+    
+    def resize_image(self, image_data, size=(600, 600)):
+        """
+        Fit image into exactly the given size (600x600 pixels by default)
+        
+        The image is scaled without distortion and padded with white.
+        
+        Args:
+            image_data: Encoded image bytes
+            size: (width, height) of the output
+            
+        Returns:
+            DecodedImage of the result (encoded bytes in ``data``) or None if failed
+        """
+        try:
+            with stage("resize"):
+                output = self.run_cpu(fit_output, image_data, size, self.output_encoder)
+            print(f"Image resized to {size[0]}x{size[1]}: {len(output.data)} bytes")
+            return output
                 
         except Exception as e:
             print(f"Error resizing image: {str(e)}")
             return None
     
-    def validate_image(self, image_path):
-        """Validate if the uploaded file is a valid image"""
+    def validate_image(self, image_data):
+        """
+        Validate the uploaded bytes by decoding them
+        
+        Returns:
+            DecodedImage to pass on to process_image, or None if the bytes are
+            not a usable image
+        """
         try:
-            with Image.open(image_path) as img:
-                img.verify()
-            return True
-        except Exception:
-            return False
+            with stage("validate"):
+                return self.run_cpu(DecodedImage, image_data, self.decode_max_side)
+        except InvalidImageError as e:
+            print(f"Invalid image: {e}")
+            return None
 
 # Example usage
 if __name__ == "__main__":
     processor = ImageProcessor()
     
-    # Test with a sample image (you'll need to provide a test image)
-    # result = processor.process_image("test_user_image.jpg")
+    # Test with a sample image (you'll need to provide a test image);
+    # for whole directories of photos use batch_process.py instead
+    # with open("test_user_image.jpg", "rb") as f:
+    #     result = processor.process_image(f.read())
     # if result:
-    #     print(f"Image processed successfully: {result}")
+    #     with open("processed_image_600x600.png", "wb") as f:
+    #         f.write(result)
+    #     print("Image processed successfully: processed_image_600x600.png")
     # else:
     #     print("Image processing failed")
@@ -0,0 +1,339 @@
+import io
+import os
+import warnings
+import numpy as np
+from PIL import Image, ImageOps
+
+# Quality steps tried when a re-encoded upload is still above its byte budget
+UPLOAD_QUALITY_STEPS = (85, 75, 65, 55, 45)
+
+# Images with more pixels than this are rejected before decoding (decompression bombs)
+MAX_IMAGE_PIXELS = int(os.environ.get("MAX_IMAGE_PIXELS", str(50_000_000)))
+# Pillow's own bomb check covers code that opens images without DecodedImage;
+# its warning is redundant since oversized images are rejected with an error
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+warnings.filterwarnings("ignore", category=Image.DecompressionBombWarning)
+
+# Conventional file extensions for the output formats
+FORMAT_EXTENSIONS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp"}
+
+FORMAT_MIME_TYPES = {
+    "JPEG": "image/jpeg",
+    "PNG": "image/png",
+    "WEBP": "image/webp",
+    "GIF": "image/gif",
+    "BMP": "image/bmp",
+    "TIFF": "image/tiff",
+}
+
+# Formats the model accepts as inline images; anything else is re-encoded
+UPLOAD_FORMATS = {"JPEG", "PNG", "WEBP"}
+
+
+class InvalidImageError(ValueError):
+    """Raised when bytes cannot be decoded as a usable image"""
+
+
+class DecodedImage:
+    """
+    An encoded image decoded exactly once, upright and in RGB
+
+    Decoding doubles as validation: corrupt, truncated or oversized inputs
+    raise InvalidImageError. With ``max_side`` JPEGs are decoded at a reduced
+    scale and the result is shrunk to at most ``max_side``. Smaller copies and
+    NumPy views are derived on first use and cached, so validation, the local
+    engine, upload preparation and compliance checks share the same pixels.
+    """
+
+    def __init__(self, data, max_side=None, max_pixels=None):
+        self.data = data
+        try:
+            with Image.open(io.BytesIO(data)) as img:
+                self.format = img.format
+                self.source_size = img.size
+                # The header gives the dimensions; refuse before allocating pixels
+                _check_pixels(img, max_pixels)
+                self.orientation = img.getexif().get(0x0112, 1)
+                if max_side:
+                    # For JPEGs let the decoder scale down by 1/2, 1/4 or 1/8 while decoding
+                    img.draft("RGB", (max_side, max_side))
+                img.load()
+                img = flatten_to_rgb(ImageOps.exif_transpose(img))
+                if max_side:
+                    img = downscale(img, max_side)
+        except InvalidImageError:
+            raise
+        except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+            raise InvalidImageError(f"Cannot decode image: {e}") from e
+        self.image = img
+        self._views = {}
+
+    @classmethod
+    def from_image(cls, image, data=None, format="PNG"):
+        """Wrap an already decoded RGB image (and its encoding, if known)"""
+        decoded = cls.__new__(cls)
+        decoded.data = data
+        decoded.format = format
+        decoded.source_size = image.size
+        decoded.orientation = 1
+        decoded.image = image
+        decoded._views = {}
+        return decoded
+
+    @property
+    def size(self):
+        return self.image.size
+
+    def scaled(self, max_side=None):
+        """The image shrunk so its longest side is at most ``max_side``"""
+        if not max_side or max(self.image.size) <= max_side:
+            return self.image
+        key = ("scaled", max_side)
+        if key not in self._views:
+            self._views[key] = downscale(self.image, max_side)
+        return self._views[key]
+
+    def array(self, max_side=None, mode="RGB"):
+        """uint8 NumPy array of the (optionally shrunk) image in ``mode``"""
+        key = ("array", max_side, mode)
+        if key not in self._views:
+            img = self.scaled(max_side)
+            self._views[key] = np.asarray(img if mode == "RGB" else img.convert(mode))
+        return self._views[key]
+
+
+def _check_pixels(img, max_pixels=None):
+    max_pixels = max_pixels or MAX_IMAGE_PIXELS
+    if img.width * img.height > max_pixels:
+        raise InvalidImageError(f"Image too large: {img.width}x{img.height} pixels")
+
+
+def estimate_decode_bytes(data, max_side=None, max_pixels=None):
+    """
+    Estimate the memory needed to decode and process ``data``, from its header
+
+    Only the header is read. It accounts for the decoded pixels (JPEGs are
+    decoded at a reduced scale when ``max_side`` allows), the ``max_side``
+    working copy and its derived views, and the encoded bytes themselves.
+
+    Raises:
+        InvalidImageError: If the header cannot be read or has too many pixels
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            _check_pixels(img, max_pixels)
+            width, height = img.size
+            if max_side and img.format == "JPEG":
+                # draft() decodes at 1/2, 1/4 or 1/8 scale while staying above max_side
+                scale = 1
+                while scale < 8 and min(width, height) // (scale * 2) >= max_side:
+                    scale *= 2
+                width, height = -(-width // scale), -(-height // scale)
+            bands = max(3, len(img.getbands()))
+    except InvalidImageError:
+        raise
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+        raise InvalidImageError(f"Cannot read image header: {e}") from e
+    decoded = width * height * bands
+    # The RGB working copy plus its greyscale, array and upload views
+    working = min(width * height, (max_side or max(width, height)) ** 2) * 3 * 3
+    return len(data) + decoded + working
+
+
+def as_decoded(image, max_side=None):
+    """Return ``image`` if it is already a DecodedImage, else decode the bytes"""
+    if isinstance(image, DecodedImage):
+        return image
+    return DecodedImage(image, max_side)
+
+
+def flatten_to_rgb(img, background=(255, 255, 255)):
+    """Convert any mode to RGB, compositing transparency onto a white background"""
+    if img.mode == "RGB":
+        return img
+    if img.mode in ("RGBA", "LA", "P"):
+        img = img.convert("RGBA")
+        canvas = Image.new("RGB", img.size, background)
+        canvas.paste(img, mask=img.getchannel("A"))
+        return canvas
+    return img.convert("RGB")
+
+
+def downscale(img, max_side):
+    """
+    Shrink ``img`` so its longest side is at most ``max_side``
+
+    Large images are first shrunk by an integer factor with reduce(), which is
+    much cheaper than resampling the full image, and then resampled to the exact
+    size with LANCZOS.
+    """
+    longest = max(img.size)
+    if longest <= max_side:
+        return img
+    factor = longest // (max_side * 2)
+    if factor > 1:
+        img = img.reduce(factor)
+    scale = max_side / max(img.size)
+    size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+    return img.resize(size, Image.Resampling.LANCZOS)
+
+
+def fit_and_pad(img, size, background=(255, 255, 255)):
+    """
+    Scale ``img`` to fit inside ``size`` without distorting it and centre it
+    on a ``background`` canvas of exactly ``size``
+    """
+    scale = min(size[0] / img.width, size[1] / img.height)
+    fitted = (
+        max(1, min(size[0], round(img.width * scale))),
+        max(1, min(size[1], round(img.height * scale))),
+    )
+    if fitted != img.size:
+        # reducing_gap makes Pillow reduce() by an integer factor before LANCZOS
+        img = img.resize(fitted, Image.Resampling.LANCZOS, reducing_gap=2.0)
+    if fitted == tuple(size):
+        return img
+    canvas = Image.new("RGB", tuple(size), background)
+    canvas.paste(img, ((size[0] - fitted[0]) // 2, (size[1] - fitted[1]) // 2))
+    return canvas
+
+
+class OutputEncoder:
+    """
+    Encodes finished photos for delivery within a byte budget
+
+    For JPEG and WEBP the quality is binary-searched between ``min_quality``
+    and ``max_quality`` for the best quality that fits in ``max_bytes``; if
+    even ``min_quality`` is too big, the smallest encoding is returned. PNG is
+    lossless and only optimised. With ``strip_metadata`` no EXIF, ICC profile
+    or comments are written.
+
+    Args:
+        format: JPEG, PNG or WEBP (default: OUTPUT_FORMAT or JPEG)
+        max_bytes: Byte budget (default: OUTPUT_MAX_BYTES or 240 KB, the DV limit)
+        min_quality: Lowest quality tried (default: OUTPUT_MIN_QUALITY or 50)
+        max_quality: Highest quality tried (default: 95)
+        strip_metadata: Drop metadata (default: OUTPUT_STRIP_METADATA or on)
+    """
+
+    def __init__(self, format=None, max_bytes=None, min_quality=None, max_quality=95, strip_metadata=None):
+        self.format = (format or os.environ.get("OUTPUT_FORMAT", "JPEG")).upper().replace("JPG", "JPEG")
+        if self.format not in FORMAT_EXTENSIONS:
+            raise ValueError(f"Unsupported output format: {self.format}")
+        self.max_bytes = max_bytes or int(os.environ.get("OUTPUT_MAX_BYTES", str(240 * 1024)))
+        self.min_quality = min_quality or int(os.environ.get("OUTPUT_MIN_QUALITY", "50"))
+        self.max_quality = max(self.min_quality, max_quality)
+        if strip_metadata is None:
+            strip_metadata = os.environ.get("OUTPUT_STRIP_METADATA", "1") == "1"
+        self.strip_metadata = strip_metadata
+
+    @property
+    def extension(self):
+        return FORMAT_EXTENSIONS[self.format]
+
+    @property
+    def mime_type(self):
+        return FORMAT_MIME_TYPES[self.format]
+
+    def _save(self, img, **options):
+        if not self.strip_metadata:
+            for key in ("exif", "icc_profile", "dpi"):
+                if key in img.info:
+                    options[key] = img.info[key]
+        output = io.BytesIO()
+        img.save(output, self.format, **options)
+        return output.getvalue()
+
+    def encode(self, img):
+        """Encode an RGB image; returns the bytes"""
+        if self.format == "PNG":
+            return self._save(img, optimize=True)
+
+        low, high = self.min_quality, self.max_quality
+        best = None
+        smallest = None
+        while low <= high:
+            quality = (low + high) // 2
+            data = self._save(img, quality=quality, optimize=True)
+            if smallest is None or len(data) < len(smallest):
+                smallest = data
+            if len(data) <= self.max_bytes:
+                best = data
+                low = quality + 1
+            else:
+                high = quality - 1
+        return best if best is not None else smallest
+
+
+def fit_output(image, size, encoder=None):
+    """
+    Decode ``image`` once, fit-and-pad it to ``size`` and encode it
+
+    Returns:
+        DecodedImage of the result, with the encoded bytes in ``data``
+    """
+    encoder = encoder or OutputEncoder()
+    fitted = fit_and_pad(as_decoded(image).image, size)
+    return DecodedImage.from_image(fitted, encoder.encode(fitted), encoder.format)
+
+
+def normalize_for_upload(image, max_side=None, max_bytes=None):
+    """
+    Shrink a user photo before it is sent to the model
+
+    ``image`` is a DecodedImage, whose pixels are reused, or encoded bytes.
+    Applies EXIF orientation, detects the real format, downscales to
+    ``max_side`` and re-encodes as a JPEG within ``max_bytes``. Photos that are
+    already small, upright JPEGs are passed through untouched to avoid a
+    needless generation loss.
+
+    Returns:
+        (upload bytes, mime type, stats dict with original_bytes, upload_bytes,
+        saved_bytes and format)
+    """
+    max_side = max_side or int(os.environ.get("UPLOAD_MAX_SIDE", "1536"))
+    max_bytes = max_bytes or int(os.environ.get("UPLOAD_MAX_BYTES", str(1024 * 1024)))
+
+    decoded = as_decoded(image, max_side)
+    image_data = decoded.data
+    source_format = decoded.format
+    orientation = decoded.orientation
+
+    if (
+        source_format == "JPEG"
+        and orientation == 1
+        and max(decoded.source_size) <= max_side
+        and len(image_data) <= max_bytes
+    ):
+        return image_data, "image/jpeg", _upload_stats(image_data, image_data, source_format)
+
+    img = decoded.scaled(max_side)
+    upload = None
+    for quality in UPLOAD_QUALITY_STEPS:
+        output = io.BytesIO()
+        img.save(output, "JPEG", quality=quality, optimize=True)
+        upload = output.getvalue()
+        if len(upload) <= max_bytes:
+            break
+
+    # Never send something bigger than what the user gave us, as long as the
+    # original itself is within the limits and in a format the model accepts
+    if (
+        len(upload) >= len(image_data)
+        and orientation == 1
+        and source_format in UPLOAD_FORMATS
+        and max(decoded.source_size) <= max_side
+        and len(image_data) <= max_bytes
+    ):
+        return image_data, FORMAT_MIME_TYPES[source_format], _upload_stats(image_data, image_data, source_format)
+
+    return upload, "image/jpeg", _upload_stats(image_data, upload, source_format)
+
+
+def _upload_stats(original, upload, source_format):
+    return {
+        "format": source_format,
+        "original_bytes": len(original),
+        "upload_bytes": len(upload),
+        "saved_bytes": len(original) - len(upload),
+    }
@@ -0,0 +1,185 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# received -> processing -> done -> delivered, or failed at any point
+RECEIVED = "received"
+PROCESSING = "processing"
+DONE = "done"
+DELIVERED = "delivered"
+FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER,
+    status_message_id INTEGER,
+    file_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    template TEXT NOT NULL,
+    album TEXT,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result_path TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+"""
+
+# Columns added after the first release, with their definitions
+_MIGRATIONS = {
+    "album": "ALTER TABLE jobs ADD COLUMN album TEXT",
+}
+
+
+class Job:
+    """One row of the job journal"""
+
+    def __init__(self, row):
+        for key in row.keys():
+            setattr(self, key, row[key])
+
+    def __repr__(self):
+        return f"Job(id={self.id}, chat_id={self.chat_id}, status={self.status}, attempts={self.attempts})"
+
+
+class JobStore:
+    """
+    Durable journal of photo jobs in SQLite.
+
+    Every received photo gets a row with its Telegram file_id and the chat to
+    answer. The row moves through received, processing and done (result file
+    written) to delivered, or to failed. After a restart, unfinished jobs
+    are processed again. Finished but undelivered results are sent without
+    being recomputed.
+
+    Photos sent as an album share the Telegram media group id in ``album``
+    and are delivered together.
+
+    Results are kept as files in ``result_dir`` until delivered. Several
+    processes may share the database (WAL mode with a busy timeout).
+    """
+
+    def __init__(self, path=None, result_dir=None, retention=None):
+        self.path = path if path is not None else os.environ.get("JOB_STORE_PATH", ".cache/jobs.sqlite3")
+        # An empty path keeps the journal in memory (no crash recovery)
+        self.path = self.path or ":memory:"
+        if result_dir is None:
+            result_dir = os.environ.get("JOB_RESULT_DIR", ".cache/job_results")
+        self.result_dir = result_dir
+        self.retention = retention or float(os.environ.get("JOB_STORE_RETENTION", str(7 * 24 * 3600)))
+
+        if self.path != ":memory:" and os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if self.result_dir:
+            os.makedirs(self.result_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        if self.path != ":memory:":
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        columns = {row["name"] for row in self._db.execute("PRAGMA table_info(jobs)")}
+        for column, statement in _MIGRATIONS.items():
+            if column not in columns:
+                self._db.execute(statement)
+        # Results of in-memory journals cannot outlive the process anyway
+        self._memory_results = {}
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params)
+
+    def create(self, chat_id, file_id, kind="photo", template="dv", message_id=None, status_message_id=None,
+               album=None):
+        """Record a newly received photo; returns the job id"""
+        now = time.time()
+        cursor = self._execute(
+            "INSERT INTO jobs (chat_id, message_id, status_message_id, file_id, kind, template, album, status, "
+            "created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (chat_id, message_id, status_message_id, file_id, kind, template, album, RECEIVED, now, now),
+        )
+        return cursor.lastrowid
+
+    def get(self, job_id):
+        row = self._execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return Job(row) if row is not None else None
+
+    def update(self, job_id, **fields):
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        self._execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+    def start(self, job_id):
+        """Mark a job as processing and count the attempt; returns the attempt number"""
+        self._execute(
+            "UPDATE jobs SET status = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?",
+            (PROCESSING, time.time(), job_id),
+        )
+        return self.get(job_id).attempts
+
+    def fail(self, job_id, error):
+        self.update(job_id, status=FAILED, error=error)
+
+    def save_result(self, job_id, data, extension="jpg"):
+        """Keep the result until it is delivered and mark the job done"""
+        if not self.result_dir:
+            self._memory_results[job_id] = data
+            self.update(job_id, status=DONE, result_path=None)
+            return
+        path = os.path.join(self.result_dir, f"{job_id}.{extension}")
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        self.update(job_id, status=DONE, result_path=path)
+
+    def load_result(self, job):
+        """The stored result bytes of a done job, or None if they are gone"""
+        if job.result_path is None:
+            return self._memory_results.get(job.id)
+        try:
+            with open(job.result_path, "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def mark_delivered(self, job_id):
+        job = self.get(job_id)
+        self._memory_results.pop(job_id, None)
+        if job is not None and job.result_path:
+            try:
+                os.remove(job.result_path)
+            except OSError:
+                pass
+        self.update(job_id, status=DELIVERED, result_path=None)
+
+    def pending(self):
+        """Jobs that were not delivered or failed, oldest first"""
+        rows = self._execute(
+            "SELECT * FROM jobs WHERE status IN (?, ?, ?) ORDER BY id",
+            (RECEIVED, PROCESSING, DONE),
+        ).fetchall()
+        return [Job(row) for row in rows]
+
+    def purge(self):
+        """Delete delivered and failed jobs older than the retention period"""
+        cutoff = time.time() - self.retention
+        cursor = self._execute(
+            "DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?",
+            (DELIVERED, FAILED, cutoff),
+        )
+        return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,154 @@
+import logging
+import os
+import numpy as np
+from PIL import Image
+from face_detection import FaceDetector, cv2
+from imaging import DecodedImage, OutputEncoder, as_decoded
+
+logger = logging.getLogger(__name__)
+
+
+class LocalResult:
+    """Output of the local engine with its self-assessed confidence"""
+
+    def __init__(self, image, confidence, factors, decoded=None):
+        self.image = image
+        self.confidence = confidence
+        self.factors = factors
+        # The result's pixels, so checking it needs no decode
+        self.decoded = decoded
+
+    def __repr__(self):
+        return f"LocalResult(confidence={self.confidence:.2f}, factors={self.factors})"
+
+
+class LocalProcessor:
+    """
+    Offline passport photo engine: face detection, crop and background whitening.
+
+    The crop is placed so the head fills ``head_ratio`` of the frame height and
+    the eye line sits ``eye_line`` of the way down from the top. Background
+    pixels are found by colour distance from the border colour and kept only if
+    connected to the border, then blended to white. Every result carries a
+    confidence in [0, 1]; callers decide whether it is good enough to skip the
+    remote model.
+    """
+
+    def __init__(self, detector=None, working_side=1200, background_threshold=None, encoder=None):
+        self.detector = detector or FaceDetector()
+        self.encoder = encoder or OutputEncoder()
+        self.working_side = working_side
+        self.background_threshold = background_threshold or float(
+            os.environ.get("LOCAL_BACKGROUND_THRESHOLD", "40")
+        )
+
+    @property
+    def available(self):
+        return self.detector.available
+
+    def process(self, image, output_size=(600, 600), head_ratio=0.6, eye_line=0.38):
+        """
+        Produce a passport photo locally
+
+        Args:
+            image: DecodedImage or encoded bytes of the user's photo
+            output_size: (width, height) of the result
+            head_ratio: Target head height as a fraction of the frame height
+            eye_line: Target eye position as a fraction from the top
+
+        Returns:
+            LocalResult, or None when no face was found
+        """
+        if not self.available:
+            return None
+
+        pixels = as_decoded(image, self.working_side).array(self.working_side)
+        gray = cv2.cvtColor(pixels, cv2.COLOR_RGB2GRAY)
+        faces = self.detector.detect(gray)
+        if not faces:
+            return None
+        face = faces[0]
+
+        # Crop box with the output aspect ratio around the estimated head
+        aspect = output_size[0] / output_size[1]
+        crop_height = face.head_height / head_ratio
+        crop_width = crop_height * aspect
+        top = face.eye_y - eye_line * crop_height
+        left = face.center_x - crop_width / 2
+        box = tuple(int(round(v)) for v in (left, top, left + crop_width, top + crop_height))
+
+        crop, inside_fraction = self._crop_with_padding(pixels, box)
+        whitened, background_fraction, border_std = self._whiten_background(crop)
+
+        result = Image.fromarray(whitened).resize(output_size, Image.Resampling.LANCZOS)
+        encoded = self.encoder.encode(result)
+
+        factors = {
+            "single_face": 1.0 if len(faces) == 1 else 0.3,
+            "detection": min(1.0, face.score / 5.0),
+            "resolution": min(1.0, face.width / 100.0),
+            "framing": max(0.0, 1.0 - 3.0 * (1.0 - inside_fraction)),
+            "background_uniformity": float(np.clip((30.0 - border_std) / 20.0, 0.0, 1.0)),
+            "background_coverage": float(np.clip((background_fraction - 0.5) / 0.4, 0.0, 1.0)),
+        }
+        confidence = float(np.prod(list(factors.values())))
+        return LocalResult(encoded, confidence, factors, DecodedImage.from_image(result, encoded, self.encoder.format))
+
+    @staticmethod
+    def _crop_with_padding(pixels, box):
+        """Crop ``box`` from ``pixels``, padding with white where it leaves the image"""
+        left, top, right, bottom = box
+        height, width = pixels.shape[:2]
+        canvas = np.full((bottom - top, right - left, 3), 255, dtype=np.uint8)
+
+        src_left, src_top = max(left, 0), max(top, 0)
+        src_right, src_bottom = min(right, width), min(bottom, height)
+        if src_right <= src_left or src_bottom <= src_top:
+            return canvas, 0.0
+
+        canvas[src_top - top:src_bottom - top, src_left - left:src_right - left] = (
+            pixels[src_top:src_bottom, src_left:src_right]
+        )
+        inside = (src_right - src_left) * (src_bottom - src_top)
+        return canvas, inside / canvas.shape[0] / canvas.shape[1]
+
+    def _whiten_background(self, crop):
+        """
+        Replace the background connected to the crop border with white
+
+        Returns:
+            (whitened uint8 array, fraction of border pixels classed as
+            background, robust colour spread along the sampled borders)
+        """
+        pixels = crop.astype(np.float32)
+        strip = max(2, crop.shape[0] // 40)
+        # Shoulders fill the lower edges, so sample the top and the upper half of the sides
+        half = crop.shape[0] // 2
+
+        def border_of(values):
+            return np.concatenate([
+                values[:strip].reshape(-1, *values.shape[2:]),
+                values[:half, :strip].reshape(-1, *values.shape[2:]),
+                values[:half, -strip:].reshape(-1, *values.shape[2:]),
+            ])
+
+        border = border_of(pixels)
+        background_colour = np.median(border, axis=0)
+        # Median absolute deviation, so thin lines or stray hair do not dominate
+        border_std = float(1.4826 * np.median(np.abs(border - background_colour), axis=0).mean())
+
+        distance = np.linalg.norm(pixels - background_colour, axis=2)
+        candidate = (distance < self.background_threshold).astype(np.uint8)
+
+        # Keep only candidate regions touching the sampled borders
+        count, labels = cv2.connectedComponents(candidate, connectivity=4)
+        edge_labels = np.unique(border_of(labels))
+        edge_labels = edge_labels[edge_labels != 0]
+        mask = np.isin(labels, edge_labels)
+
+        # Soft edge: fully white deep in the background, fading out near the subject
+        alpha = np.clip(1.5 - distance / self.background_threshold, 0.0, 1.0) * mask
+        alpha = cv2.GaussianBlur(alpha.astype(np.float32), (5, 5), 0)[..., None]
+        whitened = pixels * (1.0 - alpha) + 255.0 * alpha
+
+        return whitened.clip(0, 255).astype(np.uint8), float(border_of(mask).mean()), border_std
@@ -0,0 +1,70 @@
+import asyncio
+import contextlib
+import logging
+import os
+from metrics import MEMORY_RESERVED
+
+logger = logging.getLogger(__name__)
+
+_MB = 1024 * 1024
+
+
+class MemoryBudgetExceeded(Exception):
+    """Raised when a single job would need more memory than one job may use"""
+
+    def __init__(self, needed, limit):
+        self.needed = needed
+        self.limit = limit
+        super().__init__(f"Job needs about {needed // _MB} MB, the limit is {limit // _MB} MB")
+
+
+class MemoryBudget:
+    """
+    Accounts for the memory held by photo jobs in this process
+
+    Each job reserves its estimated footprint (see imaging.estimate_decode_bytes)
+    before its image is decoded and keeps it until it finishes. A job that
+    would need more than ``job_limit`` is refused; otherwise it waits until
+    the reservations of all jobs fit in ``total``. Large photos then queue
+    behind each other instead of pushing the process out of memory.
+
+    Args:
+        total: Bytes all jobs may reserve together (default: MEMORY_BUDGET_MB or 1024 MB)
+        job_limit: Bytes one job may reserve (default: JOB_MEMORY_LIMIT_MB or 256 MB)
+    """
+
+    def __init__(self, total=None, job_limit=None):
+        self.total = total or int(os.environ.get("MEMORY_BUDGET_MB", "1024")) * _MB
+        self.job_limit = min(self.total, job_limit or int(os.environ.get("JOB_MEMORY_LIMIT_MB", "256")) * _MB)
+        self._reserved = 0
+        self._condition = None
+
+    @property
+    def reserved(self):
+        return self._reserved
+
+    def check(self, needed):
+        """
+        Raises:
+            MemoryBudgetExceeded: If one job may not use ``needed`` bytes
+        """
+        if needed > self.job_limit:
+            raise MemoryBudgetExceeded(needed, self.job_limit)
+
+    @contextlib.asynccontextmanager
+    async def reserve(self, needed):
+        """Hold ``needed`` bytes of the budget for the duration of the block"""
+        self.check(needed)
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._reserved + needed <= self.total)
+            self._reserved += needed
+            MEMORY_RESERVED.set(self._reserved)
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._reserved -= needed
+                MEMORY_RESERVED.set(self._reserved)
+                self._condition.notify_all()
@@ -0,0 +1,363 @@
+"""
+Lightweight in-process metrics
+
+Counters, gauges and histograms with optional labels, exposed in the
+Prometheus text format over HTTP and as periodic structured log lines.
+Recording a sample is a dict lookup and an addition under a lock, cheap enough
+to leave on in production. Optionally (MEMORY_PROFILE=1) every pipeline stage
+also records its peak Python allocations through tracemalloc.
+"""
+
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+MEMORY_BUCKETS = tuple(mb * 1024 * 1024 for mb in (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _snapshot_key(key):
+    return ",".join(f"{name}={value}" for name, value in key) or "total"
+
+
+def _format_labels(key, extra=None):
+    items = list(key) + (list(extra.items()) if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in items) + "}"
+
+
+class Counter:
+    """Monotonically increasing value per label set"""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(_label_key(labels), 0)
+
+    def render(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(key)} {value}" for key, value in items]
+
+    def snapshot(self):
+        with self._lock:
+            return {_snapshot_key(key): value for key, value in self._values.items()}
+
+
+class Gauge(Counter):
+    """Value that can go up and down"""
+
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram:
+    """Cumulative-bucket histogram per label set"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def quantile(self, fraction, **labels):
+        """Estimate a quantile as the upper bound of the bucket it falls in"""
+        with self._lock:
+            series = self._series.get(_label_key(labels))
+            if series is None or series[2] == 0:
+                return None
+            counts, _, total = series[0][:], series[1], series[2]
+        target = fraction * total
+        running = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            running += count
+            if running >= target:
+                return bound
+        return float("inf")
+
+    def render(self):
+        lines = []
+        with self._lock:
+            items = [(key, (counts[:], total, count)) for key, (counts, total, count) in self._series.items()]
+        for key, (counts, total, count) in items:
+            running = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                running += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(key, {'le': bound})} {running}")
+            lines.append(f"{self.name}_bucket{_format_labels(key, {'le': '+Inf'})} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+    def snapshot(self):
+        with self._lock:
+            keys = list(self._series)
+            totals = {key: (self._series[key][1], self._series[key][2]) for key in keys}
+        result = {}
+        for key in keys:
+            total, count = totals[key]
+            labels = dict(key)
+            result[_snapshot_key(key)] = {
+                "count": count,
+                "avg": round(total / count, 4) if count else 0,
+                "p95": self.quantile(0.95, **labels),
+            }
+        return result
+
+
+class MetricsRegistry:
+    """Named collection of metrics; metrics are created on first use"""
+
+    def __init__(self, prefix="dvbot_"):
+        self.prefix = prefix
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help_text, **kwargs):
+        full_name = self.prefix + name
+        with self._lock:
+            metric = self._metrics.get(full_name)
+            if metric is None:
+                metric = self._metrics[full_name] = cls(full_name, help_text, **kwargs)
+            return metric
+
+    def counter(self, name, help_text=""):
+        return self._get(Counter, name, help_text)
+
+    def gauge(self, name, help_text=""):
+        return self._get(Gauge, name, help_text)
+
+    def histogram(self, name, help_text="", buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help_text, buckets=buckets)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name[len(self.prefix):]: metric.snapshot() for metric in metrics}
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram("stage_seconds", "Time spent in each pipeline stage")
+JOBS = REGISTRY.counter("jobs_total", "Finished photo jobs by outcome")
+RETRIES = REGISTRY.counter(
+    "model_retries_total", "Model calls repeated after a failed or non-compliant attempt, by reason"
+)
+# Export every reason from the start so the series keep the same labels
+for _reason in ("error", "compliance"):
+    RETRIES.inc(0, reason=_reason)
+MODEL_ERRORS = REGISTRY.counter("model_errors_total", "Failed model call attempts by error type")
+HEDGES = REGISTRY.counter("model_hedges_total", "Hedged second requests sent for slow model calls")
+CANDIDATES = REGISTRY.counter("model_candidates_total", "Best-of-N generations by outcome (scored, failed, cancelled)")
+CIRCUIT_OPEN = REGISTRY.gauge("model_circuit_open", "1 while the model circuit breaker is open")
+CACHE_HITS = REGISTRY.counter("cache_hits_total", "Result cache hits by tier")
+CACHE_MISSES = REGISTRY.counter("cache_misses_total", "Result cache misses")
+IN_FLIGHT = REGISTRY.gauge("jobs_in_flight", "Photo jobs currently being handled")
+QUEUE_DEPTH = REGISTRY.gauge("queue_depth", "Jobs waiting in the scheduler queue")
+RATE_LIMITED = REGISTRY.counter("rate_limited_total", "Photos refused by a rate limit, by scope")
+MODEL_CONCURRENCY_LIMIT = REGISTRY.gauge("model_concurrency_limit", "Current adaptive limit on concurrent model calls")
+MODEL_CALLS_IN_FLIGHT = REGISTRY.gauge("model_calls_in_flight", "Model calls currently running")
+MODEL_CONCURRENCY_CHANGES = REGISTRY.counter(
+    "model_concurrency_changes_total", "Adaptive concurrency limit changes by direction and reason"
+)
+MEMORY_RESERVED = REGISTRY.gauge("memory_reserved_bytes", "Estimated memory reserved by running photo jobs")
+STAGE_PEAK_BYTES = REGISTRY.histogram(
+    "stage_peak_bytes", "Peak traced allocations during each pipeline stage (MEMORY_PROFILE=1)", MEMORY_BUCKETS
+)
+
+
+class MemoryProfiler:
+    """
+    Peak Python allocations per pipeline stage, measured with tracemalloc
+
+    Each stage records how far traced memory rose above its level when the
+    stage started. tracemalloc sees the whole process, so while several jobs
+    run at once a stage's peak includes what other threads allocated
+    meanwhile; profile one job at a time for exact numbers. Pillow's pixel
+    buffers are allocated outside Python and are not traced, NumPy arrays
+    are. Tracing slows allocation-heavy code down considerably, so it is
+    meant for benchmarks and debugging rather than production.
+    """
+
+    def __init__(self):
+        self._active = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        return self
+
+    def _advance(self):
+        # Credit the peak since the last stage boundary to every open stage
+        peak = tracemalloc.get_traced_memory()[1]
+        for entry in self._active.values():
+            entry[1] = max(entry[1], peak)
+        tracemalloc.reset_peak()
+
+    @contextmanager
+    def measure(self, name):
+        token = object()
+        with self._lock:
+            self._advance()
+            current = tracemalloc.get_traced_memory()[0]
+            self._active[token] = [current, current]
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._advance()
+                started, peak = self._active.pop(token)
+            STAGE_PEAK_BYTES.observe(max(0, peak - started), stage=name)
+
+
+_memory_profiler = None
+
+
+def enable_memory_profiling():
+    """Start recording peak allocations per stage; returns the profiler"""
+    global _memory_profiler
+    if _memory_profiler is None:
+        _memory_profiler = MemoryProfiler().start()
+    return _memory_profiler
+
+
+def stage(name):
+    """Context manager recording the duration (and, when profiling, peak memory) of a pipeline stage"""
+    if _memory_profiler is None:
+        return STAGE_SECONDS.time(stage=name)
+    return _profiled_stage(name)
+
+
+@contextmanager
+def _profiled_stage(name):
+    with STAGE_SECONDS.time(stage=name), _memory_profiler.measure(name):
+        yield
+
+
+if os.environ.get("MEMORY_PROFILE", "0") == "1":
+    enable_memory_profiling()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are frequent; keep them out of the bot log
+        pass
+
+
+def start_http_server(port=None, host="0.0.0.0", registry=REGISTRY):
+    """
+    Serve ``/metrics`` in a background thread
+
+    Returns:
+        The server (call ``shutdown()`` to stop it), or None when no port is set
+    """
+    port = port if port is not None else int(os.environ.get("METRICS_PORT", "0"))
+    if not port:
+        return None
+    handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info(f"Metrics available on http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+class LogReporter:
+    """Logs a JSON snapshot of all metrics every ``interval`` seconds"""
+
+    def __init__(self, interval=None, registry=REGISTRY):
+        self.interval = interval if interval is not None else float(os.environ.get("METRICS_LOG_INTERVAL", "60"))
+        self.registry = registry
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.interval <= 0:
+            return self
+        self._thread = threading.Thread(target=self._run, name="metrics-log", daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            logger.info(f"metrics {json.dumps(self.registry.snapshot(), sort_keys=True)}")
+
+    def stop(self):
+        self._stop.set()
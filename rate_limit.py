@@ -0,0 +1,254 @@
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from metrics import RATE_LIMITED, stage
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a request is over its rate limit"""
+
+    def __init__(self, scope, retry_after):
+        self.scope = scope
+        # Whole seconds, rounded up, so "try again in N seconds" is never too early
+        self.retry_after = max(1, math.ceil(retry_after))
+        super().__init__(f"{scope} rate limit exceeded, retry after {self.retry_after}s")
+
+
+class TokenBucket:
+    """
+    Holds up to ``capacity`` tokens, refilled at ``rate`` tokens per second
+
+    Timestamps are wall-clock seconds so a saved bucket stays meaningful after
+    a restart.
+    """
+
+    def __init__(self, rate, capacity, tokens=None, updated_at=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity if tokens is None else tokens
+        self.updated_at = updated_at or time.time()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait(self, now=None):
+        """Seconds until a token is available"""
+        self._refill(now or time.time())
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def reserve(self, max_wait=0.0, now=None):
+        """
+        Take one token, borrowing against future refills for up to ``max_wait`` seconds
+
+        Returns:
+            (granted, seconds): when granted, the seconds to wait before the
+            token may be used; otherwise the seconds until a retry succeeds
+        """
+        wait = self.wait(now)
+        if wait > max_wait:
+            return False, wait - max_wait
+        self.tokens -= 1
+        return True, wait
+
+    def refund(self):
+        """Return a token that was taken but not used"""
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def is_full(self, now=None):
+        self._refill(now or time.time())
+        return self.tokens >= self.capacity
+
+
+class RateLimiter:
+    """
+    Token bucket rate limits per user and for the bot as a whole
+
+    Each user may send ``user_burst`` photos at once and ``user_per_hour``
+    photos per hour after that; extra photos are refused right away with the
+    time until the next one is allowed. The global bucket matches the Gemini
+    quota: every model request takes a token, retries, extra candidates and
+    hedges included. Requests wait for a token for up to ``global_max_wait``
+    seconds, so short bursts are smoothed out instead of turning into 429s.
+    Only when the backlog is longer than that are new jobs refused.
+
+    State lives in memory. With ``path`` it is saved as JSON on shutdown and
+    loaded on start, so a restart does not reset the limits.
+
+    Args:
+        user_per_hour: Sustained photos per user and hour, 0 disables (default: RATE_LIMIT_USER_PER_HOUR or 20)
+        user_burst: Photos a user may send at once (default: RATE_LIMIT_USER_BURST or 5)
+        global_per_minute: Sustained model requests per minute, 0 disables (default: RATE_LIMIT_GLOBAL_PER_MINUTE or 60)
+        global_burst: Model requests that may start at once (default: RATE_LIMIT_GLOBAL_BURST or 10)
+        global_max_wait: Longest wait for a global token (default: RATE_LIMIT_GLOBAL_MAX_WAIT or 120)
+        path: JSON state file, empty for memory only (default: RATE_LIMIT_STATE_PATH or memory only)
+        max_users: User buckets kept; the least recently used are dropped
+    """
+
+    def __init__(self, user_per_hour=None, user_burst=None, global_per_minute=None, global_burst=None,
+                 global_max_wait=None, path=None, max_users=100000):
+        if user_per_hour is None:
+            user_per_hour = float(os.environ.get("RATE_LIMIT_USER_PER_HOUR", "20"))
+        if global_per_minute is None:
+            global_per_minute = float(os.environ.get("RATE_LIMIT_GLOBAL_PER_MINUTE", "60"))
+        self.user_rate = user_per_hour / 3600
+        self.user_burst = user_burst or int(os.environ.get("RATE_LIMIT_USER_BURST", "5"))
+        self.global_rate = global_per_minute / 60
+        self.global_burst = global_burst or int(os.environ.get("RATE_LIMIT_GLOBAL_BURST", "10"))
+        if global_max_wait is None:
+            global_max_wait = float(os.environ.get("RATE_LIMIT_GLOBAL_MAX_WAIT", "120"))
+        self.global_max_wait = global_max_wait
+        self.path = path if path is not None else os.environ.get("RATE_LIMIT_STATE_PATH", "")
+        self.max_users = max_users
+
+        self._users = OrderedDict()
+        self._global = TokenBucket(self.global_rate, self.global_burst) if self.global_rate > 0 else None
+        self._lock = threading.Lock()
+        self.load()
+
+    def split(self, shares, index):
+        """
+        Keep ``1/shares`` of the global budget for worker process ``index``
+
+        Each worker saves its state to its own file next to ``path``.
+        """
+        if shares <= 1:
+            return
+        with self._lock:
+            self.global_rate /= shares
+            self.global_burst = max(1, self.global_burst // shares)
+            self._global = TokenBucket(self.global_rate, self.global_burst) if self.global_rate > 0 else None
+            self._users.clear()
+        if self.path:
+            self.path = f"{self.path}.{index}"
+            self.load()
+
+    def check_user(self, user_id):
+        """
+        Take a token from the user's bucket
+
+        Raises:
+            RateLimitExceeded: If the user has no tokens left
+        """
+        if self.user_rate <= 0:
+            return
+        with self._lock:
+            bucket = self._users.get(user_id)
+            if bucket is None:
+                bucket = self._users[user_id] = TokenBucket(self.user_rate, self.user_burst)
+                while len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+            self._users.move_to_end(user_id)
+            granted, seconds = bucket.reserve()
+        if not granted:
+            RATE_LIMITED.inc(scope="user")
+            raise RateLimitExceeded("user", seconds)
+
+    def check_global(self):
+        """
+        Seconds until the global budget allows another model request, without taking it
+
+        Raises:
+            RateLimitExceeded: If the wait would exceed ``global_max_wait``
+        """
+        if self._global is None:
+            return 0.0
+        with self._lock:
+            seconds = self._global.wait()
+        if seconds > self.global_max_wait:
+            RATE_LIMITED.inc(scope="global")
+            raise RateLimitExceeded("global", seconds - self.global_max_wait)
+        return seconds
+
+    def acquire_global(self, max_wait=None, cancel_event=None):
+        """
+        Take a global token for one model request, waiting in the calling thread
+
+        Called from the threads that make model calls, so every request,
+        retry and hedge is charged.
+
+        Args:
+            max_wait: Longest wait in seconds, at most ``global_max_wait``
+                (default: ``global_max_wait``)
+            cancel_event: Optional threading.Event; when it is set during the
+                wait the token is given back
+
+        Returns:
+            True once the token may be used, False if cancelled while waiting
+
+        Raises:
+            RateLimitExceeded: If the wait would exceed ``max_wait``
+        """
+        if self._global is None:
+            return True
+        max_wait = self.global_max_wait if max_wait is None else max(0.0, min(max_wait, self.global_max_wait))
+        with self._lock:
+            granted, seconds = self._global.reserve(max_wait)
+        if not granted:
+            RATE_LIMITED.inc(scope="global")
+            raise RateLimitExceeded("global", seconds)
+        if seconds <= 0:
+            return True
+        with stage("rate_limit_wait"):
+            if cancel_event is None:
+                time.sleep(seconds)
+            elif cancel_event.wait(seconds):
+                self.refund_global()
+                return False
+        return True
+
+    def refund_global(self):
+        """Give back a global token for a request that was never sent"""
+        if self._global is None:
+            return
+        with self._lock:
+            self._global.refund()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable rate limit state {self.path}: {e}")
+            return
+        with self._lock:
+            if self._global is not None and state.get("global"):
+                tokens, updated_at = state["global"]
+                self._global = TokenBucket(self.global_rate, self.global_burst, min(tokens, self.global_burst), updated_at)
+            if self.user_rate > 0:
+                for user_id, (tokens, updated_at) in list(state.get("users", {}).items())[-self.max_users:]:
+                    self._users[int(user_id)] = TokenBucket(
+                        self.user_rate, self.user_burst, min(tokens, self.user_burst), updated_at
+                    )
+
+    def save(self):
+        """Write the buckets that are not full; full ones are the default anyway"""
+        if not self.path:
+            return
+        with self._lock:
+            state = {
+                "global": [self._global.tokens, self._global.updated_at] if self._global is not None else None,
+                "users": {
+                    str(user_id): [bucket.tokens, bucket.updated_at]
+                    for user_id, bucket in self._users.items()
+                    if not bucket.is_full()
+                },
+            }
+        directory = os.path.dirname(self.path)
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(state, f)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Rate limit state write failed: {e}")
@@ -0,0 +1,188 @@
+import logging
+import os
+import threading
+import time
+from google.genai import types
+
+logger = logging.getLogger(__name__)
+
+# Resolved next to this file so tools run from other directories find the samples
+SAMPLE_IMAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sample", "image.png")
+
+PROMPT_TEMPLATE = """
+Given a user-uploaded photo, resize and correct it into a standard {description} format with:
+
+White background (clean, uniform).
+Face centered and scaled to fit the frame.
+Image size: {width}x{height} pixels.
+Proper brightness and contrast so the face is clearly visible.
+Crop extra background while keeping the head and shoulders visible to the point as shown in the reference image no more.
+Ensure the output is a sharp, high-quality image in JPEG or PNG format.
+
+Use the first image as a reference sample and correct the second image accordingly.
+"""
+
+# head_ratio is the head height (chin to top of hair) as a fraction of the frame
+# height and eye_line the eye position as a fraction from the top
+DEFAULT_TEMPLATES = {
+    "dv": {
+        "sample_image_path": SAMPLE_IMAGE_PATH,
+        "output_size": (600, 600),
+        "description": "DV lottery passport/ID photo",
+        "head_ratio": 0.6,
+        "eye_line": 0.38,
+    },
+    "us_passport": {
+        "sample_image_path": SAMPLE_IMAGE_PATH,
+        "output_size": (600, 600),
+        "description": "US passport 2x2 inch photo",
+        "head_ratio": 0.6,
+        "eye_line": 0.38,
+    },
+    "schengen": {
+        "sample_image_path": SAMPLE_IMAGE_PATH,
+        "output_size": (413, 531),
+        "description": "Schengen visa 35x45 mm photo",
+        "head_ratio": 0.75,
+        "eye_line": 0.4,
+    },
+}
+
+
+class ReferenceTemplate:
+    """A named reference image with its prompt and generation config, built once"""
+
+    def __init__(self, name, sample_image_path, output_size, description, head_ratio=0.6, eye_line=0.38):
+        self.name = name
+        self.sample_image_path = sample_image_path
+        self.output_size = output_size
+        self.description = description
+        self.head_ratio = head_ratio
+        self.eye_line = eye_line
+        self.prompt = PROMPT_TEMPLATE.format(
+            description=description,
+            width=output_size[0],
+            height=output_size[1],
+        )
+        self.sample_image = None
+        self.reference_part = None
+        self.prompt_part = types.Part.from_text(text=self.prompt)
+        self.config = types.GenerateContentConfig(response_modalities=["IMAGE"])
+        # Name and expiry of the Gemini context cache holding the prefix, if any
+        self.cached_content = None
+        self.cache_expires_at = 0.0
+
+    @property
+    def available(self):
+        return self.reference_part is not None
+
+
+class TemplateRegistry:
+    """
+    Loads reference images once and keeps ready-made request prefixes.
+
+    Each distinct sample file is read from disk a single time, however many
+    templates share it. When context caching is enabled (GEMINI_CONTEXT_CACHE=1)
+    the reference image and prompt are uploaded once as Gemini cached content
+    and requests only carry the user's image; if the API refuses to cache the
+    prefix the registry falls back to sending it inline.
+    """
+
+    def __init__(self, client, model, templates=None, use_context_cache=None, cache_ttl=None):
+        self.client = client
+        self.model = model
+        if use_context_cache is None:
+            use_context_cache = os.environ.get("GEMINI_CONTEXT_CACHE", "0") == "1"
+        self.use_context_cache = use_context_cache
+        self.cache_ttl = cache_ttl or int(os.environ.get("GEMINI_CONTEXT_CACHE_TTL", "3600"))
+        self.templates = {}
+        self.load_count = 0
+        self._lock = threading.Lock()
+        for name, settings in (templates or DEFAULT_TEMPLATES).items():
+            self.templates[name] = ReferenceTemplate(name, **settings)
+        self.load()
+
+    def load(self):
+        """Read every sample image once and build the reference parts"""
+        loaded = {}
+        for template in self.templates.values():
+            path = template.sample_image_path
+            if path not in loaded:
+                if not os.path.exists(path):
+                    logger.warning(f"Sample image not found for template '{template.name}': {path}")
+                    loaded[path] = None
+                    continue
+                with open(path, "rb") as sample_file:
+                    data = sample_file.read()
+                self.load_count += 1
+                loaded[path] = (data, types.Part.from_bytes(mime_type="image/png", data=data))
+            if loaded[path] is not None:
+                template.sample_image, template.reference_part = loaded[path]
+
+    def get(self, name):
+        """Return the template called ``name``"""
+        try:
+            return self.templates[name]
+        except KeyError:
+            raise KeyError(f"Unknown template '{name}'. Available: {', '.join(self.templates)}")
+
+    def build_request(self, name, user_part):
+        """
+        Build the contents and config for one generation request
+
+        Args:
+            name: Template name
+            user_part: types.Part holding the user's image
+
+        Returns:
+            (contents, config) ready for generate_content_stream
+        """
+        template = self.get(name)
+        if not template.available:
+            raise FileNotFoundError(f"Sample image not found: {template.sample_image_path}")
+
+        if self.use_context_cache and self._ensure_cached(template):
+            contents = [types.Content(role="user", parts=[user_part])]
+            config = types.GenerateContentConfig(
+                response_modalities=["IMAGE"],
+                cached_content=template.cached_content,
+            )
+            return contents, config
+
+        contents = [
+            types.Content(
+                role="user",
+                parts=[template.reference_part, user_part, template.prompt_part],
+            ),
+        ]
+        return contents, template.config
+
+    def _ensure_cached(self, template):
+        # Refresh a little before expiry so in-flight requests never race it
+        if template.cached_content and time.monotonic() < template.cache_expires_at - 60:
+            return True
+        with self._lock:
+            if template.cached_content and time.monotonic() < template.cache_expires_at - 60:
+                return True
+            try:
+                cache = self.client.caches.create(
+                    model=self.model,
+                    config=types.CreateCachedContentConfig(
+                        contents=[
+                            types.Content(
+                                role="user",
+                                parts=[template.reference_part, template.prompt_part],
+                            ),
+                        ],
+                        display_name=f"reference-{template.name}",
+                        ttl=f"{self.cache_ttl}s",
+                    ),
+                )
+            except Exception as e:
+                logger.warning(f"Context caching unavailable for '{template.name}', sending prefix inline: {e}")
+                self.use_context_cache = False
+                return False
+            template.cached_content = cache.name
+            template.cache_expires_at = time.monotonic() + self.cache_ttl
+            logger.info(f"Cached reference prefix for '{template.name}' as {cache.name}")
+            return True
@@ -0,0 +1,529 @@
+"""
+Resilience layer for model calls
+
+ResilientCaller runs a blocking call (one Gemini generation) with a
+per-attempt timeout and an overall deadline, retries transient failures with
+jittered exponential backoff, optionally hedges a slow attempt with a second
+one, and fails fast through a CircuitBreaker while the upstream is unhealthy.
+An AdaptiveLimiter bounds the number of concurrent calls and adjusts the
+bound to how the upstream is coping.
+"""
+
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import requests
+from metrics import (
+    CIRCUIT_OPEN,
+    HEDGES,
+    MODEL_CALLS_IN_FLIGHT,
+    MODEL_CONCURRENCY_CHANGES,
+    MODEL_CONCURRENCY_LIMIT,
+    MODEL_ERRORS,
+    RETRIES,
+)
+from rate_limit import RateLimitExceeded
+
+logger = logging.getLogger(__name__)
+
+# HTTP status codes worth retrying
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+# Status codes meaning the upstream has more work than it can take
+OVERLOAD_STATUS_CODES = {429, 503}
+
+# How often a waiting caller checks the job's cancel event
+_POLL_SECONDS = 0.25
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the model while the circuit breaker is open"""
+
+
+class DeadlineExceededError(Exception):
+    """Raised when the model did not answer within the attempt timeout or deadline"""
+
+
+class _CallerDeadlineError(DeadlineExceededError):
+    """The caller's deadline ran out before the model could be slow; not an upstream failure"""
+
+
+def is_transient(error):
+    """Whether a failed model call is worth retrying"""
+    if isinstance(error, (DeadlineExceededError, TimeoutError, ConnectionError)):
+        return True
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    return getattr(error, "code", None) in TRANSIENT_STATUS_CODES
+
+
+def overload_reason(error):
+    """Why ``error`` means the upstream is overloaded, or None if it does not"""
+    if isinstance(error, (DeadlineExceededError, TimeoutError, requests.exceptions.Timeout)):
+        return "timeout"
+    code = getattr(error, "code", None)
+    if code in OVERLOAD_STATUS_CODES:
+        return str(code)
+    return None
+
+
+class AdaptiveLimiter:
+    """
+    AIMD limit on concurrent model calls
+
+    Every successful call made while the limit was in use raises the limit by
+    ``1 / limit``, i.e. by one per limit's worth of calls. A 429 or 503, a
+    timeout, or a latency above ``latency_spike`` times the usual latency
+    multiplies the limit by ``backoff``. After a decrease further decreases are
+    ignored for about one call duration, so one burst of errors from calls
+    that were already running counts once.
+
+    Args:
+        initial: Starting limit (default: MODEL_CONCURRENCY_INITIAL or 4)
+        min_limit: Lowest limit (default: MODEL_CONCURRENCY_MIN or 1)
+        max_limit: Highest limit (default: MODEL_CONCURRENCY_MAX or 32)
+        backoff: Factor applied on overload (default: MODEL_CONCURRENCY_BACKOFF or 0.5)
+        latency_spike: Latency, as a multiple of the smoothed latency, treated
+            as overload (default: MODEL_LATENCY_SPIKE or 2.5)
+        adaptive: Adjust the limit; when off it stays at ``initial``
+            (default: MODEL_CONCURRENCY_ADAPTIVE or on)
+    """
+
+    def __init__(self, initial=None, min_limit=None, max_limit=None, backoff=None, latency_spike=None,
+                 adaptive=None, smoothing=0.1):
+        self.min_limit = min_limit or int(os.environ.get("MODEL_CONCURRENCY_MIN", "1"))
+        self.max_limit = max(self.min_limit, max_limit or int(os.environ.get("MODEL_CONCURRENCY_MAX", "32")))
+        initial = initial or int(os.environ.get("MODEL_CONCURRENCY_INITIAL", "4"))
+        self.backoff = backoff or float(os.environ.get("MODEL_CONCURRENCY_BACKOFF", "0.5"))
+        self.latency_spike = latency_spike or float(os.environ.get("MODEL_LATENCY_SPIKE", "2.5"))
+        if adaptive is None:
+            adaptive = os.environ.get("MODEL_CONCURRENCY_ADAPTIVE", "1") == "1"
+        self.adaptive = adaptive
+        self.smoothing = smoothing
+
+        self._limit = float(min(self.max_limit, max(self.min_limit, initial)))
+        self._in_flight = 0
+        self._baseline = None
+        self._last_decrease = None
+        self._condition = threading.Condition()
+        MODEL_CONCURRENCY_LIMIT.set(self.limit)
+
+    @property
+    def limit(self):
+        """Current number of calls allowed at once"""
+        return int(self._limit)
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def acquire(self, timeout=None, cancel_event=None):
+        """
+        Wait for a free slot; returns False on timeout or cancellation
+
+        Every successful acquire must be followed by one release().
+        """
+        end = time.monotonic() + timeout if timeout is not None else None
+        with self._condition:
+            while self._in_flight >= self.limit:
+                if cancel_event is not None and cancel_event.is_set():
+                    return False
+                wait = _POLL_SECONDS
+                if end is not None:
+                    remaining = end - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    wait = min(wait, remaining)
+                self._condition.wait(wait)
+            self._in_flight += 1
+            MODEL_CALLS_IN_FLIGHT.set(self._in_flight)
+            return True
+
+    def release(self):
+        with self._condition:
+            self._in_flight -= 1
+            MODEL_CALLS_IN_FLIGHT.set(self._in_flight)
+            self._condition.notify()
+
+    def on_success(self, seconds):
+        """Record a successful call that took ``seconds``"""
+        with self._condition:
+            if self._baseline is not None and seconds > self.latency_spike * self._baseline:
+                self._decrease("latency")
+                # Let the baseline follow a lasting slowdown, slowly
+                self._baseline += self.smoothing * (seconds - self._baseline) / 2
+                return
+            if self._baseline is None:
+                self._baseline = seconds
+            else:
+                self._baseline += self.smoothing * (seconds - self._baseline)
+            # Only grow while the limit is actually what holds calls back;
+            # this call has already given its slot back
+            if self.adaptive and self._in_flight + 1 >= self.limit and self._limit < self.max_limit:
+                previous = self.limit
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+                if self.limit != previous:
+                    logger.info(f"Model concurrency limit raised to {self.limit}")
+                    MODEL_CONCURRENCY_CHANGES.inc(direction="increase", reason="healthy")
+                    MODEL_CONCURRENCY_LIMIT.set(self.limit)
+                    self._condition.notify_all()
+
+    def on_overload(self, reason):
+        """Record a call that failed because the upstream is overloaded"""
+        with self._condition:
+            self._decrease(reason)
+
+    def _decrease(self, reason):
+        if not self.adaptive:
+            return
+        now = time.monotonic()
+        cooldown = max(1.0, self._baseline or 0.0)
+        if self._last_decrease is not None and now - self._last_decrease < cooldown:
+            return
+        self._last_decrease = now
+        previous = self.limit
+        self._limit = max(float(self.min_limit), self._limit * self.backoff)
+        logger.warning(f"Model concurrency limit lowered from {previous} to {self.limit} ({reason})")
+        MODEL_CONCURRENCY_CHANGES.inc(direction="decrease", reason=reason)
+        MODEL_CONCURRENCY_LIMIT.set(self.limit)
+
+
+class CircuitBreaker:
+    """
+    Tracks the outcome of recent model calls and opens when too many fail
+
+    The breaker opens when at least ``min_calls`` of the last ``window``
+    calls were recorded and the failure share reaches ``failure_rate``. While
+    open every call is refused for ``cooldown`` seconds; after that a single
+    trial call is let through and its outcome closes or re-opens the breaker.
+    """
+
+    def __init__(self, failure_rate=None, window=None, min_calls=None, cooldown=None):
+        self.failure_rate = failure_rate or float(os.environ.get("CIRCUIT_FAILURE_RATE", "0.5"))
+        self.window = window or int(os.environ.get("CIRCUIT_WINDOW", "20"))
+        self.min_calls = min_calls or int(os.environ.get("CIRCUIT_MIN_CALLS", "10"))
+        self.cooldown = cooldown or float(os.environ.get("CIRCUIT_COOLDOWN", "30"))
+        self._outcomes = deque(maxlen=self.window)
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._trial_thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.cooldown:
+                return "half_open"
+            return "open"
+
+    def allow(self):
+        """Whether a call may go upstream now"""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.cooldown or self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            self._trial_thread = threading.get_ident()
+            return True
+
+    def release(self):
+        """Give up this thread's trial call, if any, without recording an outcome"""
+        with self._lock:
+            if self._trial_thread == threading.get_ident():
+                self._trial_in_flight = False
+                self._trial_thread = None
+
+    def record(self, success):
+        with self._lock:
+            if self._opened_at is not None:
+                if not self._trial_in_flight:
+                    # Result of a call started before the breaker opened
+                    return
+                self._trial_in_flight = False
+                self._trial_thread = None
+                if success:
+                    logger.info("Circuit breaker closed")
+                    self._opened_at = None
+                    self._outcomes.clear()
+                    CIRCUIT_OPEN.set(0)
+                else:
+                    self._opened_at = time.monotonic()
+                return
+
+            self._outcomes.append(success)
+            failures = self._outcomes.count(False)
+            if len(self._outcomes) >= self.min_calls and failures / len(self._outcomes) >= self.failure_rate:
+                logger.warning(f"Circuit breaker opened: {failures}/{len(self._outcomes)} recent model calls failed")
+                self._opened_at = time.monotonic()
+                CIRCUIT_OPEN.set(1)
+
+
+class LatencyTracker:
+    """Recent successful call durations, used to decide when to hedge"""
+
+    def __init__(self, size=200, min_samples=20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, fraction):
+        """The ``fraction`` percentile, or None until enough samples were seen"""
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def _release_once(limiter):
+    """A callable releasing one limiter slot the first time it is called"""
+    lock = threading.Lock()
+    released = []
+
+    def release():
+        with lock:
+            if released:
+                return
+            released.append(True)
+        limiter.release()
+    return release
+
+
+class ResilientCaller:
+    """
+    Runs ``func(cancel_event)`` with timeouts, retries, hedging and a breaker
+
+    Each attempt first waits for a token from ``rate_limiter`` and a slot
+    from ``limiter``; hedges are only sent when both are free right away.
+
+    Args:
+        breaker: CircuitBreaker shared by all calls to the same upstream
+        limiter: AdaptiveLimiter for the number of concurrent attempts
+        attempt_timeout: Seconds one attempt may take before it is abandoned
+        deadline: Default seconds for the whole call, retries included
+        max_retries: Retries after the first attempt for transient errors
+        backoff_base: Delay before the first retry; doubles every retry
+        backoff_max: Upper bound for a single retry delay
+        hedge: Start a second attempt when the first is slower than the p95
+        hedge_min_samples: Successful calls observed before hedging kicks in
+        max_threads: Threads available for attempts across all jobs
+        min_attempt: Seconds of the deadline an attempt needs to be worth
+            starting (default: MODEL_MIN_ATTEMPT_SECONDS or 2)
+        rate_limiter: Optional RateLimiter whose global bucket every request
+            takes a token from, retries and hedges included
+    """
+
+    def __init__(self, breaker=None, attempt_timeout=None, deadline=None, max_retries=None,
+                 backoff_base=None, backoff_max=None, hedge=None, hedge_min_samples=None, max_threads=None,
+                 limiter=None, min_attempt=None, rate_limiter=None):
+        self.breaker = breaker or CircuitBreaker()
+        self.limiter = limiter or AdaptiveLimiter()
+        self.attempt_timeout = attempt_timeout or float(os.environ.get("MODEL_ATTEMPT_TIMEOUT", "60"))
+        self.deadline = deadline or float(os.environ.get("MODEL_DEADLINE", "110"))
+        if min_attempt is None:
+            min_attempt = float(os.environ.get("MODEL_MIN_ATTEMPT_SECONDS", "2"))
+        self.min_attempt = min_attempt
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries if max_retries is not None else int(os.environ.get("MODEL_MAX_RETRIES", "2"))
+        self.backoff_base = backoff_base if backoff_base is not None else float(os.environ.get("MODEL_BACKOFF_BASE", "1"))
+        self.backoff_max = backoff_max or float(os.environ.get("MODEL_BACKOFF_MAX", "10"))
+        self.hedge = hedge if hedge is not None else os.environ.get("MODEL_HEDGE", "1") == "1"
+        self.latency = LatencyTracker(
+            min_samples=hedge_min_samples or int(os.environ.get("MODEL_HEDGE_MIN_SAMPLES", "20"))
+        )
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_threads or int(os.environ.get("MODEL_MAX_THREADS", "32")),
+            thread_name_prefix="model-call",
+        )
+        self._random = random.Random()
+
+    def backoff(self, retry):
+        """Full-jitter exponential backoff for the given retry number (1-based)"""
+        ceiling = min(self.backoff_max, self.backoff_base * (2 ** (retry - 1)))
+        return self._random.uniform(0, ceiling)
+
+    def call(self, func, cancel_event=None, deadline=None):
+        """
+        Call ``func`` until it succeeds, fails permanently or time runs out
+
+        Args:
+            func: Blocking callable taking a threading.Event that is set when
+                the attempt is abandoned
+            cancel_event: Optional threading.Event cancelling the whole call
+            deadline: Absolute ``time.monotonic()`` deadline; defaults to
+                now plus ``self.deadline``
+
+        Running out of the caller's own deadline says nothing about the
+        upstream: too little time left to start an attempt, or an attempt cut
+        short by the deadline before its own timeout, raises
+        DeadlineExceededError without touching the breaker or the limit.
+
+        Raises:
+            CircuitOpenError: If the breaker refuses the call
+            RateLimitExceeded: If the model quota has no token before the
+                deadline or within the rate limiter's longest wait
+            DeadlineExceededError: If no attempt finished in time, or no
+                concurrency slot became free in time
+            Exception: The last error when retries are exhausted or it is
+                not transient
+        """
+        deadline = deadline or time.monotonic() + self.deadline
+        retry = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining < self.min_attempt:
+                raise DeadlineExceededError(f"Only {max(0.0, remaining):.1f}s left before the deadline")
+            # Every request spends the model quota, retries included
+            if self.rate_limiter is not None:
+                if not self.rate_limiter.acquire_global(remaining - self.min_attempt, cancel_event):
+                    return None
+                remaining = deadline - time.monotonic()
+            # Waiting for a slot is our own queueing, not an upstream failure
+            if not self.limiter.acquire(remaining, cancel_event):
+                self._refund_quota()
+                if cancel_event is not None and cancel_event.is_set():
+                    return None
+                raise DeadlineExceededError("No free model concurrency slot before the deadline")
+            if not self.breaker.allow():
+                self.limiter.release()
+                self._refund_quota()
+                raise CircuitOpenError("Model temporarily unavailable (circuit breaker open)")
+            try:
+                result = self._attempt(func, cancel_event, deadline)
+            except _CallerDeadlineError:
+                self.breaker.release()
+                raise
+            except Exception as e:
+                if cancel_event is not None and cancel_event.is_set():
+                    # Our own cancellation says nothing about the upstream
+                    self.breaker.release()
+                    return None
+                self.breaker.record(False)
+                MODEL_ERRORS.inc(kind=type(e).__name__)
+                reason = overload_reason(e)
+                if reason is not None:
+                    self.limiter.on_overload(reason)
+                retry += 1
+                delay = self.backoff(retry)
+                if (
+                    not is_transient(e)
+                    or retry > self.max_retries
+                    or time.monotonic() + delay + self.min_attempt > deadline
+                    or (cancel_event is not None and cancel_event.is_set())
+                ):
+                    raise
+                logger.warning(f"Model call failed ({e}); retry {retry}/{self.max_retries} in {delay:.1f}s")
+                RETRIES.inc(reason="error")
+                if cancel_event is not None and cancel_event.wait(delay):
+                    return None
+                if cancel_event is None:
+                    time.sleep(delay)
+                continue
+            if cancel_event is not None and cancel_event.is_set():
+                self.breaker.release()
+                return None
+            self.breaker.record(True)
+            return result
+
+    def _attempt(self, func, cancel_event, deadline):
+        """
+        One attempt, possibly hedged; returns the first successful result
+
+        The caller holds a limiter slot for the first request. Every request
+        gives its slot back when its thread finishes or when it is abandoned,
+        whichever comes first. The abandon event is only seen between
+        streamed chunks, so a hung stream keeps its thread until the
+        connection fails, but not its slot.
+        """
+        started = time.monotonic()
+        attempt_deadline = min(deadline, started + self.attempt_timeout)
+        hedge_after = self.latency.percentile(0.95) if self.hedge else None
+
+        running = {}
+
+        def launch():
+            abandon = threading.Event()
+            release = _release_once(self.limiter)
+            future = self._executor.submit(self._timed, func, abandon)
+            future.add_done_callback(lambda _: release())
+            running[future] = (abandon, release)
+
+        launch()
+        error = None
+        try:
+            while running:
+                now = time.monotonic()
+                if now >= attempt_deadline:
+                    if attempt_deadline < started + self.attempt_timeout:
+                        raise _CallerDeadlineError(f"Deadline reached {now - started:.1f}s into the model call")
+                    raise DeadlineExceededError(f"No model response after {now - started:.1f}s")
+                if cancel_event is not None and cancel_event.is_set():
+                    return None
+
+                wake = min(attempt_deadline, now + _POLL_SECONDS)
+                if hedge_after is not None and len(running) == 1 and error is None:
+                    wake = min(wake, started + hedge_after)
+                done, _ = wait(list(running), timeout=max(0.0, wake - now), return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    running.pop(future)
+                    try:
+                        result, seconds = future.result()
+                    except Exception as e:
+                        error = e
+                        continue
+                    self.latency.record(seconds)
+                    self.limiter.on_success(seconds)
+                    return result
+
+                if (
+                    hedge_after is not None
+                    and len(running) == 1
+                    and error is None
+                    and time.monotonic() - started >= hedge_after
+                ):
+                    # A hedge adds load, so it never waits for capacity or quota
+                    if self.limiter.acquire(timeout=0):
+                        if self._take_quota_now():
+                            logger.info(f"Model call slower than p95 ({hedge_after:.1f}s), sending a hedged request")
+                            HEDGES.inc()
+                            launch()
+                        else:
+                            self.limiter.release()
+                    hedge_after = None
+            raise error
+        finally:
+            # Stop whatever is still streaming; the loser of a hedge included
+            for abandon, release in running.values():
+                abandon.set()
+                release()
+
+    def _take_quota_now(self):
+        """Take a model quota token if one is free right away"""
+        if self.rate_limiter is None:
+            return True
+        try:
+            return self.rate_limiter.acquire_global(0)
+        except RateLimitExceeded:
+            return False
+
+    def _refund_quota(self):
+        """Give back the quota token of a request that was never sent"""
+        if self.rate_limiter is not None:
+            self.rate_limiter.refund_global()
+
+    def _timed(self, func, abandon):
+        started = time.monotonic()
+        result = func(abandon)
+        return result, time.monotonic() - started
@@ -0,0 +1,240 @@
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from PIL import Image
+from metrics import CACHE_HITS, CACHE_MISSES
+
+logger = logging.getLogger(__name__)
+
+
+def perceptual_hash(image_data, hash_size=8):
+    """64-bit difference hash (dHash) of an encoded image, or None if it cannot be decoded"""
+    try:
+        with Image.open(io.BytesIO(image_data)) as img:
+            # Let the JPEG decoder skip most of the work; we only need a thumbnail
+            img.draft("L", (hash_size * 16, hash_size * 16))
+            small = img.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.BILINEAR)
+            pixels = list(small.getdata())
+    except Exception:
+        return None
+
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+class ResultCache:
+    """
+    Content-addressed cache of processed images.
+
+    Results are keyed by the SHA-256 of the exact input bytes and the template
+    name. A size-bounded LRU holds recent results in memory; an optional disk
+    tier keeps them for ``disk_ttl`` seconds across restarts. With
+    ``near_duplicates`` enabled, a perceptual hash also matches re-encoded or
+    slightly altered copies of a photo already in the memory tier.
+
+    Concurrent requests for the same key are coalesced: only the first one
+    computes the result and the others await it. If that first request is
+    cancelled, a waiting one computes the result instead.
+
+    The disk tier stores users' processed photos, so it is off unless
+    ``disk_dir`` (RESULT_CACHE_DIR) is set.
+    """
+
+    def __init__(self, max_bytes=None, disk_dir=None, disk_ttl=None, near_duplicates=None, max_distance=4):
+        self.max_bytes = max_bytes or int(os.environ.get("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+        self.disk_dir = disk_dir if disk_dir is not None else os.environ.get("RESULT_CACHE_DIR", "")
+        self.disk_ttl = disk_ttl or float(os.environ.get("RESULT_CACHE_TTL", str(7 * 24 * 3600)))
+        if near_duplicates is None:
+            near_duplicates = os.environ.get("RESULT_CACHE_NEAR_DUPLICATES", "0") == "1"
+        self.near_duplicates = near_duplicates
+        self.max_distance = max_distance
+
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._phashes = {}
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self.stats = {
+            "hits": 0,
+            "disk_hits": 0,
+            "near_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "coalesced": 0,
+        }
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    @staticmethod
+    def key_for(image_data, template="dv"):
+        digest = hashlib.sha256(image_data)
+        digest.update(template.encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key, phash=None):
+        """Look up a result in memory, then on disk, then by perceptual hash"""
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                self.stats["hits"] += 1
+                CACHE_HITS.inc(tier="memory")
+                return value
+
+        value = self._read_disk(key)
+        if value is not None:
+            self._store_memory(key, value, phash)
+            with self._lock:
+                self.stats["disk_hits"] += 1
+                CACHE_HITS.inc(tier="disk")
+            return value
+
+        if phash is not None:
+            with self._lock:
+                for other_key, (other_hash, template) in self._phashes.items():
+                    if template == phash[1] and bin(other_hash ^ phash[0]).count("1") <= self.max_distance:
+                        value = self._memory.get(other_key)
+                        if value is not None:
+                            self._memory.move_to_end(other_key)
+                            self.stats["near_hits"] += 1
+                            CACHE_HITS.inc(tier="near")
+                            return value
+
+        with self._lock:
+            self.stats["misses"] += 1
+            CACHE_MISSES.inc()
+        return None
+
+    def put(self, key, value, phash=None):
+        """Store a result in both tiers"""
+        self._store_memory(key, value, phash)
+        self._write_disk(key, value)
+
+    async def get_or_compute(self, image_data, template, compute):
+        """
+        Return the cached result for ``image_data`` or await ``compute()`` once
+
+        Args:
+            image_data: Raw input image bytes
+            template: Template name the result was produced with
+            compute: Zero-argument coroutine function producing the result
+
+        Returns:
+            The result bytes, or whatever ``compute()`` returned if it was empty
+        """
+        key = self.key_for(image_data, template)
+
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            with self._lock:
+                self.stats["coalesced"] += 1
+                CACHE_HITS.inc(tier="coalesced")
+        while in_flight is not None:
+            try:
+                return await asyncio.shield(in_flight)
+            except asyncio.CancelledError:
+                task = asyncio.current_task()
+                if not in_flight.cancelled() or getattr(task, "cancelling", lambda: 0)():
+                    # This request itself was cancelled
+                    raise
+            # The request computing the result was cancelled; take over from it
+            in_flight = self._in_flight.get(key)
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            phash = None
+            if self.near_duplicates:
+                value = await asyncio.to_thread(perceptual_hash, image_data)
+                if value is not None:
+                    phash = (value, template)
+
+            result = await asyncio.to_thread(self.get, key, phash)
+            if result is None:
+                result = await compute()
+                if result:
+                    await asyncio.to_thread(self.put, key, result, phash)
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved when nobody else was waiting
+            future.exception()
+            raise
+        finally:
+            del self._in_flight[key]
+
+    def _store_memory(self, key, value, phash):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return
+            self._memory[key] = value
+            self._memory_bytes += len(value)
+            if phash is not None:
+                self._phashes[key] = phash
+            while self._memory_bytes > self.max_bytes and len(self._memory) > 1:
+                old_key, old_value = self._memory.popitem(last=False)
+                self._memory_bytes -= len(old_value)
+                self._phashes.pop(old_key, None)
+                self.stats["evictions"] += 1
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.bin")
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.disk_ttl:
+                os.remove(path)
+                return None
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning(f"Result cache read failed for {key}: {e}")
+            return None
+
+    def _write_disk(self, key, value):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, "wb") as f:
+                f.write(value)
+            # Atomic rename so readers never see a partial file
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.warning(f"Result cache write failed for {key}: {e}")
+
+    def purge_expired(self):
+        """Delete disk entries older than the TTL; returns the number removed"""
+        if not self.disk_dir:
+            return 0
+        removed = 0
+        now = time.time()
+        for entry in os.scandir(self.disk_dir):
+            try:
+                if now - entry.stat().st_mtime > self.disk_ttl:
+                    os.remove(entry.path)
+                    removed += 1
+            except OSError:
+                continue
+        return removed
@@ -0,0 +1,194 @@
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from metrics import QUEUE_DEPTH, STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Raised when the scheduler queue has reached its maximum depth"""
+
+
+class _Job:
+    def __init__(self, chat_id, func, args, kwargs, on_position):
+        self.chat_id = chat_id
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.on_position = on_position
+        self.future = asyncio.get_running_loop().create_future()
+        self.position = None
+        self.queued_at = time.perf_counter()
+        # Keeps position updates for this job in the order they were issued
+        self.report_lock = asyncio.Lock()
+
+
+class FairScheduler:
+    """
+    Admission control in front of the worker pool.
+
+    Jobs wait in one queue per chat and are dispatched round-robin across
+    chats, so a user sending many photos cannot starve everyone else. The total
+    number of waiting jobs is bounded by ``max_depth``; beyond that new jobs are
+    rejected immediately with QueueFullError.
+
+    Waiting jobs are told their queue position and an ETA through their
+    ``on_position(position, eta_seconds)`` callback whenever it changes.
+    Position 0 means the job has started running.
+    """
+
+    def __init__(self, worker_pool, max_depth=None, initial_job_seconds=20.0):
+        self.worker_pool = worker_pool
+        self.max_depth = max_depth or int(os.environ.get("MAX_QUEUE_DEPTH", "100"))
+        self._queues = OrderedDict()
+        self._pending = 0
+        self._job_available = None
+        self._dispatchers = []
+        # Exponential moving average of job run time, used for ETAs
+        self._avg_job_seconds = initial_job_seconds
+
+    @property
+    def depth(self):
+        """Number of jobs waiting to be dispatched"""
+        return self._pending
+
+    def is_full(self):
+        return self._pending >= self.max_depth
+
+    def ensure_capacity(self):
+        """Raise QueueFullError if a new job would be rejected"""
+        if self.is_full():
+            raise QueueFullError(f"Queue is full ({self.max_depth} jobs waiting)")
+
+    async def submit(self, chat_id, func, *args, on_position=None, **kwargs):
+        """
+        Queue ``func(*args, **kwargs)`` for ``chat_id`` and wait for its result
+
+        Raises:
+            QueueFullError: If the queue is already at its maximum depth
+        """
+        self.ensure_capacity()
+        self._start_dispatchers()
+
+        job = _Job(chat_id, func, args, kwargs, on_position)
+        self._queues.setdefault(chat_id, deque()).append(job)
+        self._pending += 1
+        self._job_available.set()
+        self._notify_positions()
+
+        try:
+            return await asyncio.shield(job.future)
+        except asyncio.CancelledError:
+            if self._remove(job):
+                self._notify_positions()
+            else:
+                job.future.cancel()
+            raise
+
+    def _start_dispatchers(self):
+        if self._dispatchers:
+            return
+        self._job_available = asyncio.Event()
+        for _ in range(self.worker_pool.max_workers):
+            self._dispatchers.append(asyncio.create_task(self._dispatch_loop()))
+
+    def _remove(self, job):
+        queue = self._queues.get(job.chat_id)
+        if queue is None or job not in queue:
+            return False
+        queue.remove(job)
+        if not queue:
+            del self._queues[job.chat_id]
+        self._pending -= 1
+        return True
+
+    def _pop_next(self):
+        # Take the head of the first chat's queue, then rotate that chat to
+        # the back so every chat gets one turn per round
+        chat_id, queue = next(iter(self._queues.items()))
+        job = queue.popleft()
+        if queue:
+            self._queues.move_to_end(chat_id)
+        else:
+            del self._queues[chat_id]
+        self._pending -= 1
+        return job
+
+    def _dispatch_order(self):
+        """Waiting jobs in the order they will be dispatched"""
+        queues = [list(queue) for queue in self._queues.values()]
+        order = []
+        depth = 0
+        while len(order) < self._pending:
+            for queue in queues:
+                if depth < len(queue):
+                    order.append(queue[depth])
+            depth += 1
+        return order
+
+    def estimate_wait(self, position):
+        """Seconds until the job at ``position`` is expected to finish"""
+        rounds = math.ceil(position / self.worker_pool.max_workers) + 1
+        return int(rounds * self._avg_job_seconds)
+
+    def _notify_positions(self):
+        QUEUE_DEPTH.set(self._pending)
+        for position, job in enumerate(self._dispatch_order(), start=1):
+            if job.position != position:
+                job.position = position
+                self._report(job, position, self.estimate_wait(position))
+
+    def _report(self, job, position, eta):
+        if job.on_position is None:
+            return
+
+        async def _call():
+            async with job.report_lock:
+                try:
+                    await job.on_position(position, eta)
+                except Exception as e:
+                    logger.debug(f"Queue position callback failed: {e}")
+
+        asyncio.create_task(_call())
+
+    async def _dispatch_loop(self):
+        while True:
+            while not self._queues:
+                self._job_available.clear()
+                await self._job_available.wait()
+
+            job = self._pop_next()
+            if job.future.cancelled():
+                continue
+            self._notify_positions()
+            STAGE_SECONDS.observe(time.perf_counter() - job.queued_at, stage="queue_wait")
+            job.position = 0
+            self._report(job, 0, int(self._avg_job_seconds))
+
+            started = time.monotonic()
+            try:
+                result = await self.worker_pool.run(job.func, *job.args, **job.kwargs)
+            except asyncio.CancelledError:
+                if not job.future.done():
+                    job.future.cancel()
+                raise
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                if not job.future.done():
+                    job.future.set_result(result)
+            finally:
+                elapsed = time.monotonic() - started
+                self._avg_job_seconds = 0.8 * self._avg_job_seconds + 0.2 * elapsed
+
+    async def close(self):
+        """Stop the dispatcher tasks"""
+        for task in self._dispatchers:
+            task.cancel()
+        await asyncio.gather(*self._dispatchers, return_exceptions=True)
+        self._dispatchers = []
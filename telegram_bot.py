@@ -1,10 +1,22 @@
+import math
 import os
+import time
+import asyncio
 import logging
-import tempfile
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram import InputMediaDocument, Update
+from telegram.error import BadRequest
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, MessageHandler, filters, ContextTypes
 from dotenv import load_dotenv
 from image_processor import ImageProcessor
+from worker_pool import WorkerPool, JobTimeoutError
+from scheduler import FairScheduler, QueueFullError
+from result_cache import ResultCache
+from file_id_cache import FileIdCache
+from job_store import DONE, JobStore
+from rate_limit import RateLimiter, RateLimitExceeded
+from memory_budget import MemoryBudget, MemoryBudgetExceeded
+from imaging import InvalidImageError, estimate_decode_bytes
+from metrics import IN_FLIGHT, JOBS, LogReporter, stage, start_http_server
 
 # Load environment variables
 load_dotenv('config.env')
@@ -16,14 +28,115 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Telegram accepts at most this many files in one media group
+MAX_MEDIA_GROUP_SIZE = 10
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Process updates concurrently across chats but one at a time per chat
+
+    Each chat's updates are handled in the order they arrived. Photo
+    handlers only journal the job and return, so a chat waits for little
+    more than one acknowledgement at a time. Updates waiting for their chat
+    do not take one of the ``max_concurrent_updates`` slots.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._chats = {}
+
+    async def process_update(self, update, coroutine):
+        chat = getattr(update, "effective_chat", None)
+        if chat is None:
+            await super().process_update(update, coroutine)
+            return
+        lock, waiting = self._chats.get(chat.id, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self._chats[chat.id] = (lock, waiting + 1)
+        try:
+            async with lock:
+                await super().process_update(update, coroutine)
+        finally:
+            lock, waiting = self._chats[chat.id]
+            if waiting == 1:
+                del self._chats[chat.id]
+            else:
+                self._chats[chat.id] = (lock, waiting - 1)
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+class ResumingApplication(Application):
+    """
+    Application that calls ``post_start(application)`` once it is running
+
+    post_init runs before start(). Tasks created with create_task before
+    then are not awaited by stop(), so post_shutdown would close the worker
+    pool under them. Work started from post_start is awaited like any other
+    task. This holds whether start() is called by run_polling or by hand, as
+    webhook workers do.
+    """
+
+    __slots__ = ("post_start",)
+
+    def __init__(self, *, post_start=None, **kwargs):
+        super().__init__(**kwargs)
+        self.post_start = post_start
+
+    async def start(self):
+        await super().start()
+        if self.post_start is not None:
+            await self.post_start(self)
+
+
 class DVPhotoBot:
-    def __init__(self):
-        self.token = os.environ.get("TELEGRAM_BOT_TOKEN")
+    def __init__(self, token=None, image_processor=None):
+        self.token = token or os.environ.get("TELEGRAM_BOT_TOKEN")
         if not self.token:
             raise ValueError("TELEGRAM_BOT_TOKEN not found in environment variables")
         
-        self.image_processor = ImageProcessor()
-        
+        self.image_processor = image_processor or ImageProcessor()
+        self.worker_pool = WorkerPool()
+        self.scheduler = FairScheduler(self.worker_pool)
+        # Every model call runs inside a job, so fewer workers cap the adaptive limit
+        max_limit = self.image_processor.resilience.limiter.max_limit
+        if self.worker_pool.max_workers < max_limit:
+            logger.warning(
+                f"MAX_CONCURRENT_JOBS={self.worker_pool.max_workers} keeps the model concurrency limit "
+                f"from growing to MODEL_CONCURRENCY_MAX={max_limit}"
+            )
+        self.result_cache = ResultCache()
+        # Token buckets per user and for the Gemini quota
+        self.rate_limiter = RateLimiter()
+        # Every Gemini request takes a global token, retries and hedges included
+        self.image_processor.resilience.rate_limiter = self.rate_limiter
+        # Bounds on what one upload may cost before and after it is decoded
+        self.max_upload_bytes = int(os.environ.get("MAX_UPLOAD_MB", "10")) * 1024 * 1024
+        self.memory_budget = MemoryBudget()
+        # Files Telegram already has are re-sent by file_id instead of bytes
+        self.file_ids = FileIdCache()
+        # Journal of received photos; unfinished jobs are resumed after a restart
+        self.jobs = JobStore()
+        self.job_tasks = set()
+        # Albums still receiving photos, by (chat id, media group id)
+        self.albums = {}
+        self.album_wait = float(os.environ.get("ALBUM_WAIT_SECONDS", "1.0"))
+        self.max_job_attempts = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+        self.job_resume_max_age = float(os.environ.get("JOB_RESUME_MAX_AGE", str(24 * 3600)))
+        # Webhook workers only resume the jobs of chats routed to them
+        self.owns_chat = lambda chat_id: True
+        self.metrics_server = None
+        self.metrics_port = None
+        self.metrics_reporter = None
+    
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Send a message when the command /start is issued."""
         welcome_message = """
@@ -97,13 +210,17 @@ Ready to process your photos!
     async def sample_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Send sample image"""
         try:
-            sample_image_path = "./image.png"
-            if os.path.exists(sample_image_path):
-                with open(sample_image_path, 'rb') as sample_file:
-                    await update.message.reply_photo(
-                        photo=sample_file,
+            reference = self.image_processor.templates.get("dv")
+            if reference.available:
+                await self.reply_with_file_id(
+                    FileIdCache.key_for(reference.sample_image, "sample"),
+                    reference.sample_image,
+                    lambda photo: update.message.reply_photo(
+                        photo=photo,
                         caption="📸 Sample DV Lottery Photo\n\nThis is an example of how your photo should look after processing:\n• White background\n• Face centered and properly scaled\n• 600x600 pixels\n• Clear and professional appearance"
-                    )
+                    ),
+                    lambda message: message.photo[-1].file_id,
+                )
             else:
                 await update.message.reply_text("❌ Sample image not found. Please contact the administrator.")
         except Exception as e:
@@ -145,120 +262,560 @@ Send me your photo and I'll process it to meet these requirements!
         """
         await update.message.reply_text(requirements_message)
     
+    async def reply_with_file_id(self, key, data, send, file_id_of):
+        """
+        Send a file by its cached Telegram file_id, uploading ``data`` only once
+        
+        Args:
+            key: FileIdCache key of the file
+            data: File bytes, uploaded when no usable file_id is cached
+            send: Coroutine function taking the file_id or bytes and returning the sent Message
+            file_id_of: Function extracting the file_id from the sent Message
+        """
+        file_id = self.file_ids.get(key)
+        if file_id is not None:
+            try:
+                return await send(file_id)
+            except BadRequest as e:
+                logger.warning(f"Cached file_id rejected, uploading again: {e}")
+                self.file_ids.discard(key)
+        message = await send(data)
+        self.file_ids.put(key, file_id_of(message))
+        return message
+    
+    def cache_template(self, template):
+        """Result cache namespace; results encoded for another format or byte budget are not reused"""
+        encoder = self.image_processor.output_encoder
+        return f"{template}.{encoder.extension}.{encoder.max_bytes}"
+    
+    def result_filename(self, template, number=None):
+        """File name of a finished photo, with the template's output size and the encoder's extension"""
+        width, height = self.image_processor.templates.get(template).output_size
+        suffix = f"_{number}" if number is not None else ""
+        return f"dv_lottery_photo_{width}x{height}{suffix}.{self.image_processor.output_encoder.extension}"
+    
+    def result_caption(self, processed_image, template="dv"):
+        """Caption for a finished photo, describing the actual encoded file"""
+        encoder = self.image_processor.output_encoder
+        width, height = self.image_processor.templates.get(template).output_size
+        return (
+            "🎯 Your DV lottery photo is ready!\n\nThis photo meets all DV lottery requirements:\n"
+            f"• White background\n• Proper dimensions ({width}x{height})\n• Centered face\n"
+            f"• Optimal brightness and contrast\n• {encoder.format} format, {len(processed_image) // 1024} KB"
+        )
+    
+    async def send_result(self, bot, chat_id, processed_image, reply_to=None, template="dv"):
+        """Send a finished photo as a document, by file_id when Telegram already has it"""
+        return await self.reply_with_file_id(
+            FileIdCache.key_for(processed_image),
+            processed_image,
+            lambda document: bot.send_document(
+                chat_id=chat_id,
+                document=document,
+                filename=self.result_filename(template),
+                caption=self.result_caption(processed_image, template),
+                reply_to_message_id=reply_to,
+                allow_sending_without_reply=True,
+            ),
+            lambda sent: sent.document.file_id,
+        )
+    
+    async def notify(self, bot, job, text):
+        """Show ``text`` in the job's status message, or send it if there is none"""
+        try:
+            if job.status_message_id is not None:
+                await bot.edit_message_text(text, chat_id=job.chat_id, message_id=job.status_message_id)
+            else:
+                await bot.send_message(job.chat_id, text)
+        except BadRequest as e:
+            # The status message was deleted or already shows this text
+            logger.debug(f"Could not update the status of job {job.id}: {e}")
+    
+    def queue_position_reporter(self, bot, job):
+        """Build a callback that keeps the status message updated with the queue position"""
+        async def report(position, eta):
+            if position == 0:
+                text = f"🔄 Processing your {job.kind}... Please wait!"
+            else:
+                text = f"🔄 Processing your {job.kind}... You are #{position} in the queue (about {eta} seconds)."
+            await self.notify(bot, job, text)
+        return report
+    
     async def handle_photo(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle incoming photos"""
-        try:
-            # Send processing message
-            processing_msg = await update.message.reply_text("🔄 Processing your photo... Please wait!")
-            
-            # Get the highest quality photo
-            photo = update.message.photo[-1]
-            
-            # Download the photo
-            file = await context.bot.get_file(photo.file_id)
-            
-            # Create temporary file
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as temp_file:
-                await file.download_to_drive(temp_file.name)
-                temp_path = temp_file.name
-            
-            try:
-                # Validate image
-                if not self.image_processor.validate_image(temp_path):
-                    await processing_msg.edit_text("❌ Invalid image format. Please send a valid photo.")
-                    return
-                
-                # Process the image
-                processed_path = self.image_processor.process_image(temp_path)
-                
-                if processed_path and os.path.exists(processed_path):
-                    # Send the processed image as a file
-                    with open(processed_path, 'rb') as processed_file:
-                        await processing_msg.edit_text("✅ Photo processed successfully!")
-                        await update.message.reply_document(
-                            document=processed_file,
-                            filename="dv_lottery_photo_600x600.png",
-                            caption="🎯 Your DV lottery photo is ready!\n\nThis photo meets all DV lottery requirements:\n• White background\n• Proper dimensions (600x600)\n• Centered face\n• Optimal brightness and contrast\n• Lossless PNG format"
-                        )
-                    
-                    # Clean up processed file
-                    os.unlink(processed_path)
-                else:
-                    await processing_msg.edit_text("❌ Failed to process image. Please try again with a different photo.")
-            
-            finally:
-                # Clean up temporary file
-                if os.path.exists(temp_path):
-                    os.unlink(temp_path)
-                    
-        except Exception as e:
-            logger.error(f"Error processing photo: {str(e)}")
-            await update.message.reply_text("❌ An error occurred while processing your photo. Please try again.")
+        # Get the highest quality photo
+        photo = update.message.photo[-1]
+        await self.accept_job(update, context, photo.file_id, "photo", photo.file_size)
     
     async def handle_document(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle document uploads (images sent as files)"""
+        document = update.message.document
+        
+        # Check if it's an image
+        if not document.mime_type or not document.mime_type.startswith('image/'):
+            await update.message.reply_text("❌ Please send an image file (JPG, PNG, etc.)")
+            return
+        await self.accept_job(update, context, document.file_id, "image", document.file_size)
+    
+    async def accept_job(self, update, context, file_id, noun, file_size=None):
+        """
+        Acknowledge an incoming photo, journal it and process it in the background
+
+        The handler returns as soon as the job is recorded. run_job delivers
+        the result later, and a restart resumes it if it is interrupted.
+        Photos of an album are collected and handled together by run_album.
+        """
         try:
-            document = update.message.document
-            
-            # Check if it's an image
-            if not document.mime_type or not document.mime_type.startswith('image/'):
-                await update.message.reply_text("❌ Please send an image file (JPG, PNG, etc.)")
+            # Telegram reports the size up front; oversized files are never downloaded
+            if file_size and file_size > self.max_upload_bytes:
+                JOBS.inc(outcome="too_large")
+                await update.message.reply_text(
+                    f"❌ This file is too large ({file_size / (1024 * 1024):.1f} MB). "
+                    f"Please send a {noun} smaller than {self.max_upload_bytes // (1024 * 1024)} MB."
+                )
+                return
+
+            application = getattr(context, "application", None)
+            if update.message.media_group_id:
+                # Albums answer once for all their photos, refused ones included
+                self.collect_album_item(update, context.bot, application, file_id, noun)
+                return
+
+            refusal = self.admit(update)
+            if refusal is not None:
+                await update.message.reply_text(refusal)
                 return
-            
+
             # Send processing message
-            processing_msg = await update.message.reply_text("🔄 Processing your image... Please wait!")
-            
-            # Download the document
-            file = await context.bot.get_file(document.file_id)
-            
-            # Create temporary file
-            with tempfile.NamedTemporaryFile(delete=False, suffix=f'.{document.file_name.split(".")[-1]}') as temp_file:
-                await file.download_to_drive(temp_file.name)
-                temp_path = temp_file.name
-            
+            processing_msg = await update.message.reply_text(f"🔄 Processing your {noun}... Please wait!")
+            job_id = self.jobs.create(
+                update.effective_chat.id,
+                file_id,
+                kind=noun,
+                message_id=update.message.message_id,
+                status_message_id=processing_msg.message_id,
+            )
+            self.start_job(job_id, context.bot, application)
+        except Exception as e:
+            JOBS.inc(outcome="error")
+            logger.error(f"Error accepting {noun}: {str(e)}")
+            await update.message.reply_text(f"❌ An error occurred while processing your {noun}. Please try again.")
+
+    def admit(self, update):
+        """
+        Check queue capacity, then the sender's rate limit
+
+        Capacity comes first, so a photo refused because the bot is busy
+        does not spend the sender's token.
+
+        Returns:
+            The reply refusing the photo, or None once it is admitted
+        """
+        # Reject early when the queue is full
+        try:
+            self.scheduler.ensure_capacity()
+        except QueueFullError:
+            JOBS.inc(outcome="rejected")
+            return "🚦 The bot is busy right now. Please try again in a few minutes."
+
+        # Refuse floods from one user before they cost anyone else a model call
+        try:
+            self.rate_limiter.check_user(update.effective_user.id if update.effective_user else update.effective_chat.id)
+        except RateLimitExceeded as e:
+            JOBS.inc(outcome="rate_limited")
+            return f"⏳ You are sending photos too quickly. Please try again in {e.retry_after} seconds."
+        return None
+
+    def collect_album_item(self, update, bot, application, file_id, noun):
+        """
+        Journal one photo of an album and start the album once no more arrive
+
+        Telegram delivers every photo of an album as its own update, all with
+        the same media_group_id. The album is started when none has arrived
+        for ``album_wait`` seconds. Each photo is admitted on its own, but
+        refused photos are only counted; the album gets a single reply.
+        """
+        key = (update.effective_chat.id, update.message.media_group_id)
+        album = self.albums.get(key)
+        if album is None:
+            album = self.albums[key] = {"job_ids": [], "refusals": [], "message": update.message}
+            self.start_task(self.collect_album(key, bot), application)
+        album["updated"] = time.monotonic()
+
+        refusal = self.admit(update)
+        if refusal is not None:
+            album["refusals"].append(refusal)
+            return
+        album["job_ids"].append(self.jobs.create(
+            update.effective_chat.id,
+            file_id,
+            kind=noun,
+            message_id=update.message.message_id,
+            album=str(update.message.media_group_id),
+        ))
+
+    async def collect_album(self, key, bot):
+        album = self.albums[key]
+        while True:
+            remaining = album["updated"] + self.album_wait - time.monotonic()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(remaining)
+        del self.albums[key]
+
+        job_ids = album["job_ids"]
+        refusals = album["refusals"]
+        if not job_ids:
+            await album["message"].reply_text(refusals[-1])
+            return
+        # One progress message for the whole album, naming the photos left out
+        text = f"🔄 Processing your {len(job_ids)} photos... Please wait!"
+        if refusals:
+            text = (f"🔄 Processing {len(job_ids)} of your {len(job_ids) + len(refusals)} photos... Please wait!\n"
+                    f"{refusals[-1]}")
+        processing_msg = await album["message"].reply_text(text)
+        for job_id in job_ids:
+            self.jobs.update(job_id, status_message_id=processing_msg.message_id)
+        await self.run_album(job_ids, bot)
+
+    def start_task(self, coroutine, application=None):
+        """Run a coroutine in the background, tracked until it finishes"""
+        # Tasks created through the application are awaited when it stops
+        if application is not None:
+            task = application.create_task(coroutine)
+        else:
+            task = asyncio.create_task(coroutine)
+        self.job_tasks.add(task)
+        task.add_done_callback(self.job_tasks.discard)
+        return task
+
+    def start_job(self, job_id, bot, application=None):
+        """Run a journaled job in the background"""
+        return self.start_task(self.run_job(job_id, bot), application)
+
+    async def run_job(self, job_id, bot):
+        """Download, process and deliver one journaled job"""
+        job = self.jobs.get(job_id)
+        if job.status == DONE:
+            await self.deliver_job(job, bot)
+            return
+
+        processed_image, error = await self.process_job(job, bot, self.queue_position_reporter(bot, job))
+        if processed_image is None:
+            await self.notify(bot, job, error)
+            return
+        await self.deliver_job(self.jobs.get(job_id), bot, processed_image)
+
+    async def process_job(self, job, bot, on_position=None):
+        """
+        Download and process one journaled job and store its result
+
+        Returns:
+            (result bytes, None) on success, else (None, message for the user)
+        """
+        IN_FLIGHT.inc()
+        try:
+            if self.jobs.start(job.id) > self.max_job_attempts:
+                # The photo probably crashed the bot before; do not loop on it
+                JOBS.inc(outcome="failure")
+                self.jobs.fail(job.id, "too many attempts")
+                return None, f"❌ Failed to process image. Please try again with a different {job.kind}."
+
+            # Refuse oversized files before downloading them when Telegram reports the size
+            with stage("download"):
+                file = await bot.get_file(job.file_id)
+                if file.file_size and file.file_size > self.max_upload_bytes:
+                    return self.reject_too_large(job, file.file_size)
+                image_data = bytes(await file.download_as_bytearray())
+            if len(image_data) > self.max_upload_bytes:
+                return self.reject_too_large(job, len(image_data))
+
+            # Validate the image header and estimate the memory its decode needs; the
+            # pixels are only decoded in the worker
             try:
-                # Validate image
-                if not self.image_processor.validate_image(temp_path):
-                    await processing_msg.edit_text("❌ Invalid image format. Please send a valid image.")
-                    return
-                
-                # Process the image
-                processed_path = self.image_processor.process_image(temp_path)
-                
-                if processed_path and os.path.exists(processed_path):
-                    # Send the processed image as a file
-                    with open(processed_path, 'rb') as processed_file:
-                        await processing_msg.edit_text("✅ Image processed successfully!")
-                        await update.message.reply_document(
-                            document=processed_file,
-                            filename="dv_lottery_photo_600x600.png",
-                            caption="🎯 Your DV lottery photo is ready!\n\nThis photo meets all DV lottery requirements:\n• White background\n• Proper dimensions (600x600)\n• Centered face\n• Optimal brightness and contrast\n• Lossless PNG format"
-                        )
-                    
-                    # Clean up processed file
-                    os.unlink(processed_path)
-                else:
-                    await processing_msg.edit_text("❌ Failed to process image. Please try again with a different image.")
-            
-            finally:
-                # Clean up temporary file
-                if os.path.exists(temp_path):
-                    os.unlink(temp_path)
-                    
+                needed = estimate_decode_bytes(image_data, self.image_processor.decode_max_side)
+                self.memory_budget.check(needed)
+            except InvalidImageError:
+                JOBS.inc(outcome="invalid")
+                self.jobs.fail(job.id, "invalid image")
+                return None, f"❌ Invalid image format. Please send a valid {job.kind}."
+            except MemoryBudgetExceeded as e:
+                JOBS.inc(outcome="too_large")
+                self.jobs.fail(job.id, str(e))
+                return None, f"❌ This {job.kind} has too many pixels to process. Please send a smaller one."
+
+            return await self.process_download(job, bot, image_data, needed, on_position)
+
         except Exception as e:
-            logger.error(f"Error processing document: {str(e)}")
-            await update.message.reply_text("❌ An error occurred while processing your image. Please try again.")
-    
+            JOBS.inc(outcome="error")
+            logger.error(f"Error processing job {job.id}: {str(e)}")
+            self.jobs.fail(job.id, str(e))
+            return None, f"❌ An error occurred while processing your {job.kind}. Please try again."
+        finally:
+            IN_FLIGHT.dec()
+
+    async def process_download(self, job, bot, image_data, needed, on_position=None):
+        """Process downloaded image bytes, reserving ``needed`` bytes of memory, and store the result"""
+        async def compute():
+            # Only cache misses spend the Gemini quota. Every model request
+            # takes its own token in the resilience layer; a job is refused
+            # here already when the quota is booked too far ahead
+            wait = self.rate_limiter.check_global()
+            if wait >= 1:
+                await self.notify(
+                    bot, job, f"⏳ Many photos are being processed. Yours starts in about {math.ceil(wait)} seconds."
+                )
+            # Large photos wait here until enough of the memory budget is free
+            async with self.memory_budget.reserve(needed):
+                return await self.scheduler.submit(
+                    job.chat_id,
+                    self.image_processor.process_image,
+                    # Only the compressed bytes wait in the queue; the worker decodes them
+                    image_data,
+                    job.template,
+                    on_position=on_position,
+                )
+
+        # Queue the job; it runs in the worker pool so the event loop stays responsive
+        try:
+            # Resent photos are answered from the cache without calling Gemini
+            processed_image = await self.result_cache.get_or_compute(
+                image_data,
+                self.cache_template(job.template),
+                compute,
+            )
+        except RateLimitExceeded as e:
+            JOBS.inc(outcome="rate_limited")
+            self.jobs.fail(job.id, "global rate limit")
+            return None, f"🚦 The bot is at capacity right now. Please try again in {e.retry_after} seconds."
+        except QueueFullError:
+            JOBS.inc(outcome="rejected")
+            self.jobs.fail(job.id, "queue full")
+            return None, "🚦 The bot is busy right now. Please try again in a few minutes."
+        except JobTimeoutError:
+            JOBS.inc(outcome="timeout")
+            self.jobs.fail(job.id, "timed out")
+            return None, "⏱ Processing took too long. Please try again later."
+
+        if not processed_image:
+            JOBS.inc(outcome="failure")
+            self.jobs.fail(job.id, "processing failed")
+            return None, f"❌ Failed to process image. Please try again with a different {job.kind}."
+
+        # Journal the result first so a crash during the upload does not lose it
+        self.jobs.save_result(job.id, processed_image, self.image_processor.output_encoder.extension)
+        return processed_image, None
+
+    def reject_too_large(self, job, size):
+        JOBS.inc(outcome="too_large")
+        self.jobs.fail(job.id, f"file too large ({size} bytes)")
+        return None, (
+            f"❌ This file is too large ({size / (1024 * 1024):.1f} MB). "
+            f"Please send a {job.kind} smaller than {self.max_upload_bytes // (1024 * 1024)} MB."
+        )
+
+    async def deliver_job(self, job, bot, processed_image=None):
+        """Send a finished job's result; a failed delivery is retried after a restart"""
+        if processed_image is None:
+            processed_image = self.jobs.load_result(job)
+        if processed_image is None:
+            self.jobs.fail(job.id, "result missing")
+            await self.notify(bot, job, f"❌ Failed to process image. Please try again with a different {job.kind}.")
+            return
+        try:
+            await self.notify(bot, job, f"✅ {job.kind.capitalize()} processed successfully!")
+            # Send the processed image bytes as a file
+            with stage("upload"):
+                await self.send_result(
+                    bot, job.chat_id, processed_image, reply_to=job.message_id, template=job.template
+                )
+        except Exception as e:
+            logger.error(f"Delivery of job {job.id} failed, keeping the result for a retry: {str(e)}")
+            return
+        self.jobs.mark_delivered(job.id)
+        JOBS.inc(outcome="success")
+
+    async def run_album(self, job_ids, bot):
+        """
+        Process the photos of an album concurrently and reply with one media group
+
+        The photos go through the scheduler like any others, so the worker
+        pool and rate limits still apply. The album's progress message counts
+        finished photos, and the results are sent together once all are done.
+        """
+        jobs = [self.jobs.get(job_id) for job_id in job_ids]
+        # All photos of an album share the status message and reply to the first one
+        lead = jobs[0]
+        finished = 0
+
+        async def process(job):
+            nonlocal finished
+            if job.status == DONE:
+                processed_image = self.jobs.load_result(job)
+                result = (processed_image, None)
+                if processed_image is None:
+                    self.jobs.fail(job.id, "result missing")
+                    result = (None, f"❌ Failed to process image. Please try again with a different {job.kind}.")
+            else:
+                result = await self.process_job(job, bot)
+            finished += 1
+            if finished < len(jobs):
+                await self.notify(bot, lead, f"🔄 Processing your {len(jobs)} photos... {finished}/{len(jobs)} done")
+            return result
+
+        results = await asyncio.gather(*(process(job) for job in jobs))
+        delivered = [(job, processed_image) for job, (processed_image, _) in zip(jobs, results) if processed_image]
+        if not delivered:
+            await self.notify(bot, lead, results[0][1])
+            return
+
+        if len(delivered) == len(jobs):
+            text = f"✅ {len(jobs)} photos processed successfully!"
+        else:
+            failed = len(jobs) - len(delivered)
+            text = (
+                f"✅ {len(delivered)} of {len(jobs)} photos processed successfully. "
+                f"{failed} could not be processed; please try again with different photos."
+            )
+        try:
+            await self.notify(bot, lead, text)
+            with stage("upload"):
+                await self.send_album_results(
+                    bot, lead.chat_id, [image for _, image in delivered], lead.message_id, lead.template
+                )
+        except Exception as e:
+            logger.error(f"Delivery of album {lead.album} failed, keeping the results for a retry: {str(e)}")
+            return
+        for job, _ in delivered:
+            self.jobs.mark_delivered(job.id)
+            JOBS.inc(outcome="success")
+
+    async def send_album_results(self, bot, chat_id, processed_images, reply_to=None, template="dv"):
+        """Send finished photos as media groups of up to 10 documents, reusing file_ids"""
+        for start in range(0, len(processed_images), MAX_MEDIA_GROUP_SIZE):
+            chunk = processed_images[start:start + MAX_MEDIA_GROUP_SIZE]
+            if len(chunk) == 1:
+                # Telegram media groups need at least two items
+                await self.send_result(bot, chat_id, chunk[0], reply_to=reply_to, template=template)
+                continue
+
+            keys = [FileIdCache.key_for(image) for image in chunk]
+            file_ids = [self.file_ids.get(key) for key in keys]
+
+            def media(use_file_ids):
+                return [
+                    InputMediaDocument(
+                        media=file_id if use_file_ids and file_id else image,
+                        filename=self.result_filename(template, start + number),
+                        # Only the last document carries the caption, like a single result
+                        caption=self.result_caption(image, template) if number == len(chunk) else None,
+                    )
+                    for number, (image, file_id) in enumerate(zip(chunk, file_ids), start=1)
+                ]
+
+            try:
+                messages = await bot.send_media_group(
+                    chat_id, media(True), reply_to_message_id=reply_to, allow_sending_without_reply=True
+                )
+            except BadRequest as e:
+                if not any(file_ids):
+                    raise
+                logger.warning(f"Cached file_id rejected, uploading the album again: {e}")
+                for key in keys:
+                    self.file_ids.discard(key)
+                messages = await bot.send_media_group(
+                    chat_id, media(False), reply_to_message_id=reply_to, allow_sending_without_reply=True
+                )
+            for key, message in zip(keys, messages):
+                self.file_ids.put(key, message.document.file_id)
+
     async def handle_text(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle text messages"""
         await update.message.reply_text(
             "📸 Please send me a photo to process!\n\nUse /help for instructions."
         )
     
-    def run(self):
-        """Run the bot"""
-        # Create application
-        application = Application.builder().token(self.token).build()
+    async def startup(self, application: Application):
+        """Drop expired entries and start metrics export; jobs are resumed by after_start"""
+        removed = self.result_cache.purge_expired()
+        if removed:
+            logger.info(f"Removed {removed} expired result cache entries")
+        self.jobs.purge()
+        self.file_ids.start()
+        self.metrics_server = start_http_server(self.metrics_port)
+        self.metrics_reporter = LogReporter().start()
+    
+    async def after_start(self, application: Application):
+        """Resume interrupted jobs once the application is running and awaits them on stop"""
+        self.resume_jobs(application)
+    
+    def resume_jobs(self, application):
+        """
+        Restart interrupted jobs and deliver results that were never sent
+        
+        Must run while ``application`` is running, so that stop() waits for
+        the resumed jobs before post_shutdown closes the worker pool.
+        """
+        resumed = 0
+        albums = {}
+        for job in self.jobs.pending():
+            if not self.owns_chat(job.chat_id):
+                continue
+            if time.time() - job.created_at > self.job_resume_max_age:
+                self.jobs.fail(job.id, "expired before it could be resumed")
+                continue
+            if job.album is not None and job.status_message_id is not None:
+                albums.setdefault((job.chat_id, job.album), []).append(job.id)
+            elif job.album is not None:
+                # Still being collected when the bot stopped; process it alone
+                self.jobs.update(job.id, album=None)
+                self.start_job(job.id, application.bot, application)
+            else:
+                self.start_job(job.id, application.bot, application)
+            resumed += 1
+        for job_ids in albums.values():
+            self.start_task(self.run_album(job_ids, application.bot), application)
+        if resumed:
+            logger.info(f"Resuming {resumed} unfinished jobs")
+    
+    async def shutdown(self, application: Application):
+        """Stop the scheduler, metrics export and worker threads when the application stops"""
+        await self.scheduler.close()
+        self.worker_pool.shutdown(wait=False)
+        self.jobs.close()
+        self.rate_limiter.save()
+        self.file_ids.stop()
+        if self.metrics_reporter is not None:
+            self.metrics_reporter.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+    
+    def build_application(self, updater=True):
+        """
+        Create the Application with all handlers registered
+        
+        Args:
+            updater: Whether to create an Updater for polling; webhook workers
+                feed updates in themselves and pass False
+        """
+        # Updates from different chats are handled concurrently so that one
+        # busy chat never blocks another; each chat's updates stay in order
+        builder = (
+            Application.builder()
+            .application_class(ResumingApplication, kwargs={"post_start": self.after_start})
+            .token(self.token)
+            .concurrent_updates(ChatOrderedUpdateProcessor(int(os.environ.get("CONCURRENT_UPDATES", "256"))))
+            .post_init(self.startup)
+            .post_shutdown(self.shutdown)
+        )
+        # A self-hosted Bot API server (or a local stub for testing)
+        if os.environ.get("TELEGRAM_API_BASE_URL"):
+            builder = builder.base_url(os.environ["TELEGRAM_API_BASE_URL"])
+        if os.environ.get("TELEGRAM_API_BASE_FILE_URL"):
+            builder = builder.base_file_url(os.environ["TELEGRAM_API_BASE_FILE_URL"])
+        if not updater:
+            builder = builder.updater(None)
+        application = builder.build()
         
         # Add handlers
         application.add_handler(CommandHandler("start", self.start))
@@ -269,6 +826,11 @@ Send me your photo and I'll process it to meet these requirements!
         application.add_handler(MessageHandler(filters.PHOTO, self.handle_photo))
         application.add_handler(MessageHandler(filters.Document.IMAGE, self.handle_document))
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_text))
+        return application
+    
+    def run(self):
+        """Run the bot with long polling (see webhook_server.py for webhook mode)"""
+        application = self.build_application()
         
         # Start the bot
         logger.info("Starting DV Lottery Photo Corrector Bot...")
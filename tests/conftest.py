@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+# The bot is a set of top-level modules next to this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(autouse=True)
+def isolated_state(tmp_path, monkeypatch):
+    """Keep the journal, caches and rate limit state of every test out of the working directory"""
+    monkeypatch.setenv("JOB_STORE_PATH", str(tmp_path / "jobs.sqlite3"))
+    monkeypatch.setenv("JOB_RESULT_DIR", str(tmp_path / "job_results"))
+    monkeypatch.setenv("FILE_ID_CACHE_PATH", "")
+    monkeypatch.setenv("RESULT_CACHE_DIR", "")
+    monkeypatch.setenv("RATE_LIMIT_STATE_PATH", "")
@@ -0,0 +1,66 @@
+import json
+import os
+
+import pytest
+
+import batch_process
+from fake_gemini import FakeGeminiClient, synthetic_portrait
+from image_processor import ImageProcessor
+
+
+@pytest.fixture
+def client():
+    return FakeGeminiClient(latency=0)
+
+
+@pytest.fixture
+def photos(tmp_path, monkeypatch, client):
+    monkeypatch.setattr(batch_process, "ImageProcessor", lambda: ImageProcessor(client=client))
+    input_dir = tmp_path / "photos"
+    input_dir.mkdir()
+    for index in range(3):
+        (input_dir / f"{index}.jpg").write_bytes(synthetic_portrait(seed=index))
+    return input_dir, tmp_path / "results"
+
+
+def run(input_dir, output_dir, *extra):
+    batch_process.main([str(input_dir), str(output_dir), "--workers", "1", "--concurrency", "2", *extra])
+    with open(output_dir / "manifest.json", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_rerun_skips_photos_done_with_the_same_template(photos, capsys):
+    input_dir, output_dir = photos
+    manifest = run(input_dir, output_dir)
+    assert {entry["status"] for entry in manifest["files"].values()} == {"done"}
+
+    run(input_dir, output_dir)
+    assert "3 skipped" in capsys.readouterr().out
+
+
+def test_rerun_with_another_template_processes_the_photos_again(photos, client, capsys):
+    input_dir, output_dir = photos
+    run(input_dir, output_dir)
+    calls = client.calls
+    capsys.readouterr()
+
+    manifest = run(input_dir, output_dir, "--template", "us_passport")
+    assert "3 processed, 0 skipped, 0 failed" in capsys.readouterr().out
+    assert client.calls > calls
+    assert {entry["template"] for entry in manifest["files"].values()} == {"us_passport"}
+    assert {entry["status"] for entry in manifest["files"].values()} == {"done"}
+    assert manifest["template"] == "us_passport"
+
+    # The second template's results are now the ones that are skipped
+    run(input_dir, output_dir, "--template", "us_passport")
+    assert "0 processed, 3 skipped" in capsys.readouterr().out
+
+
+def test_unreadable_file_is_recorded_without_stopping_the_run(photos):
+    input_dir, output_dir = photos
+    os.symlink(input_dir / "gone.jpg", input_dir / "broken.jpg")
+
+    manifest = run(input_dir, output_dir)
+    assert manifest["files"]["broken.jpg"]["status"] == "failed"
+    assert "No such file" in manifest["files"]["broken.jpg"]["error"]
+    assert [manifest["files"][f"{index}.jpg"]["status"] for index in range(3)] == ["done"] * 3
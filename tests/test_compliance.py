@@ -0,0 +1,57 @@
+import io
+
+import pytest
+from PIL import Image, ImageFilter
+
+from compliance import ComplianceChecker
+from fake_gemini import synthetic_portrait
+from imaging import fit_output
+from local_processor import LocalProcessor
+
+
+@pytest.fixture(scope="module")
+def checker():
+    return ComplianceChecker()
+
+
+@pytest.fixture(scope="module")
+def framed():
+    """A portrait cropped to the DV framing on a white background"""
+    return LocalProcessor().process(synthetic_portrait(seed=1)).image
+
+
+def encode(img):
+    output = io.BytesIO()
+    img.save(output, "PNG")
+    return output.getvalue()
+
+
+def test_well_framed_photo_passes(checker, framed):
+    report = checker.check(framed)
+    assert report.passed, report
+    assert report.measurements["faces"] == 1
+    assert report.score > 0.9
+
+
+def test_uncropped_photo_fails_the_framing_checks(checker, framed):
+    # The whole portrait squeezed into 600x600: the head is small and too low
+    report = checker.check(fit_output(synthetic_portrait(seed=1), (600, 600)).data)
+    assert not report.passed
+    assert "head_too_small" in report.failures
+    assert "eyes_misplaced" in report.failures
+    assert report.score < checker.check(framed).score
+
+
+def test_grey_blurred_photo_fails_the_image_checks(checker, framed):
+    img = Image.open(io.BytesIO(framed)).convert("RGB")
+    grey = Image.eval(img, lambda value: value * 3 // 4).filter(ImageFilter.GaussianBlur(6))
+    report = checker.check(encode(grey))
+    assert "background_not_white" in report.failures
+    assert "blurry" in report.failures
+
+
+def test_blank_image_has_no_face_and_no_contrast(checker):
+    report = checker.check(encode(Image.new("RGB", (600, 600), "white")))
+    assert "no_face" in report.failures
+    assert "low_contrast" in report.failures
+    assert report.to_dict()["passed"] is False
@@ -0,0 +1,37 @@
+import time
+
+from file_id_cache import FileIdCache
+
+
+def test_changes_are_written_on_stop(tmp_path):
+    path = tmp_path / "file_ids.json"
+    cache = FileIdCache(path=str(path), flush_interval=3600).start()
+    cache.put("result:a", "file-a")
+    assert not path.exists()
+    cache.stop()
+
+    assert FileIdCache(path=str(path)).get("result:a") == "file-a"
+
+
+def test_changes_are_written_in_the_background(tmp_path):
+    path = tmp_path / "file_ids.json"
+    cache = FileIdCache(path=str(path), flush_interval=0.01).start()
+    cache.put("result:a", "file-a")
+    for _ in range(100):
+        if path.exists():
+            break
+        time.sleep(0.01)
+    cache.discard("result:a")
+    cache.stop()
+
+    assert FileIdCache(path=str(path)).get("result:a") is None
+
+
+def test_oldest_entries_are_dropped():
+    cache = FileIdCache(path="", max_entries=2)
+    cache.put("a", "1")
+    cache.put("b", "2")
+    cache.get("a")
+    cache.put("c", "3")
+    assert cache.get("b") is None
+    assert cache.get("a") == "1"
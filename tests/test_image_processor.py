@@ -0,0 +1,87 @@
+import io
+import threading
+
+from PIL import Image, ImageFilter
+
+from compliance import ComplianceReport
+from fake_gemini import FakeGeminiClient, synthetic_portrait
+from image_processor import ImageProcessor
+from resilience import AdaptiveLimiter, ResilientCaller
+
+
+def blurred(data):
+    output = io.BytesIO()
+    Image.open(io.BytesIO(data)).filter(ImageFilter.GaussianBlur(8)).save(output, "PNG")
+    return output.getvalue()
+
+
+def make_processor(client, candidates):
+    processor = ImageProcessor(
+        client=client,
+        resilience=ResilientCaller(limiter=AdaptiveLimiter(initial=8, adaptive=False), hedge=False),
+    )
+    processor.local_processor = None
+    processor.candidates = candidates
+    check_output = processor.check_output
+
+    # Synthetic portraits are not framed like a DV photo; judge the image quality only
+    def check_quality(image, reference):
+        report = check_output(image, reference)
+        return ComplianceReport(report.measurements, [f for f in report.failures if f == "blurry"], report.score)
+
+    processor.check_output = check_quality
+    return processor
+
+
+def test_first_passing_candidate_wins_and_the_rest_are_cancelled():
+    source = synthetic_portrait(seed=3)
+    blurry_scored = threading.Event()
+    returned = threading.Event()
+    slow_call_released = []
+
+    def latency(call):
+        if call == 1:
+            # Still running when the winner arrives; let go only once the photo is done
+            slow_call_released.append(returned.wait(5))
+        elif call == 3:
+            # The sharp candidate answers after the blurry one was scored
+            blurry_scored.wait(5)
+        return 0
+
+    client = FakeGeminiClient(
+        latency=latency,
+        outputs=lambda call, image: blurred(image) if call == 2 else image,
+        chunks=20,
+    )
+    processor = make_processor(client, candidates=3)
+    check_quality = processor.check_output
+
+    def check_and_signal(image, reference):
+        report = check_quality(image, reference)
+        if not report.passed:
+            blurry_scored.set()
+        return report
+
+    processor.check_output = check_and_signal
+
+    assert processor.process_image(source) is not None
+    returned.set()
+    # Wait until the cancelled candidate has wound down
+    processor._candidate_executor.shutdown(wait=True)
+
+    # The photo did not wait for the slow candidate
+    assert slow_call_released == [True]
+    assert client.calls == 3
+    # The blurry and the winning candidate answered; the cancelled one is not an upstream success
+    assert list(processor.resilience.breaker._outcomes) == [True, True]
+    assert processor.resilience.limiter.in_flight == 0
+
+
+def test_best_scoring_candidate_is_used_when_none_passes():
+    source = synthetic_portrait(seed=3)
+    client = FakeGeminiClient(latency=0.05, outputs=lambda call, image: blurred(image))
+    processor = make_processor(client, candidates=2)
+    processor.max_attempts = 1
+
+    assert processor.process_image(source) is not None
+    assert client.calls == 2
@@ -0,0 +1,143 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from imaging import (
+    InvalidImageError,
+    OutputEncoder,
+    estimate_decode_bytes,
+    fit_and_pad,
+    fit_output,
+    normalize_for_upload,
+)
+
+
+def encode(size, fmt, **params):
+    output = io.BytesIO()
+    Image.radial_gradient("L").convert("RGB").resize(size).save(output, fmt, **params)
+    return output.getvalue()
+
+
+@pytest.mark.parametrize("fmt", ["BMP", "TIFF", "GIF"])
+def test_formats_the_model_rejects_are_reencoded(fmt):
+    data = encode((64, 64), fmt)
+    upload, mime_type, stats = normalize_for_upload(data, max_side=1536, max_bytes=1024 * 1024)
+    assert mime_type == "image/jpeg"
+    assert Image.open(io.BytesIO(upload)).format == "JPEG"
+    assert stats["format"] == fmt
+
+
+def test_small_png_is_passed_through_when_reencoding_would_grow_it():
+    output = io.BytesIO()
+    Image.new("RGB", (16, 16), "white").save(output, "PNG")
+    data = output.getvalue()
+    upload, mime_type, _ = normalize_for_upload(data, max_side=1536, max_bytes=1024 * 1024)
+    assert mime_type == "image/png"
+    assert upload == data
+
+
+def test_original_over_the_limits_is_never_passed_through():
+    data = encode((400, 400), "PNG")
+    upload, mime_type, _ = normalize_for_upload(data, max_side=100, max_bytes=len(data) // 2)
+    assert mime_type == "image/jpeg"
+    assert max(Image.open(io.BytesIO(upload)).size) <= 100
+
+
+def test_decode_estimate_reads_only_the_header():
+    data = encode((1000, 800), "PNG")
+    assert estimate_decode_bytes(data) >= 1000 * 800 * 3
+    with pytest.raises(InvalidImageError):
+        estimate_decode_bytes(b"not an image")
+
+
+def content_box(img):
+    """Bounding box of the pixels that are not the white padding"""
+    pixels = np.asarray(img.convert("RGB")).astype(int)
+    rows, columns = np.nonzero((255 - pixels).sum(axis=2) > 30)
+    return columns.min(), rows.min(), columns.max() + 1, rows.max() + 1
+
+
+@pytest.mark.parametrize("source, size, box", [
+    ((400, 200), (600, 600), (0, 150, 600, 450)),
+    ((300, 900), (600, 600), (200, 0, 400, 600)),
+    ((1000, 1200), (413, 531), (0, 17, 413, 513)),
+    ((60, 60), (600, 600), (0, 0, 600, 600)),
+])
+def test_fit_and_pad_keeps_the_aspect_ratio(source, size, box):
+    img = Image.new("RGB", source, (200, 30, 30))
+    result = fit_and_pad(img, size)
+
+    assert result.size == size
+    left, top, right, bottom = content_box(result)
+    assert (left, top, right, bottom) == box
+    # Scaled by the same factor in both directions, up to rounding
+    assert abs((right - left) / (bottom - top) - source[0] / source[1]) < 0.01
+
+
+def test_fit_and_pad_centres_a_shape_without_stretching_it():
+    img = Image.new("RGB", (800, 400), "white")
+    img.paste((0, 0, 0), (300, 100, 500, 300))
+    result = fit_and_pad(img, (600, 600))
+
+    left, top, right, bottom = content_box(result)
+    # The 200x200 square is still square (150x150) and stays centred
+    assert abs((right - left) - (bottom - top)) <= 2
+    assert abs((left + right) / 2 - 300) <= 1
+    assert abs((top + bottom) / 2 - 300) <= 1
+
+
+def test_fit_output_returns_the_encoded_result_with_its_pixels():
+    result = fit_output(encode((640, 480), "JPEG"), (600, 600))
+    assert result.size == (600, 600)
+    assert Image.open(io.BytesIO(result.data)).size == (600, 600)
+
+
+def noise(size=(600, 600), seed=0):
+    """An image that compresses badly, so the byte budget matters"""
+    pixels = np.random.default_rng(seed).integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+    return Image.fromarray(pixels)
+
+
+@pytest.mark.parametrize("fmt", ["JPEG", "WEBP"])
+def test_encoder_uses_the_best_quality_within_the_budget(fmt):
+    img = noise()
+    encoder = OutputEncoder(format=fmt, min_quality=20)
+    # A budget halfway between the lowest and the highest quality encodings
+    smallest = len(encoder._save(img, quality=20, optimize=True))
+    largest = len(encoder._save(img, quality=95, optimize=True))
+    encoder.max_bytes = (smallest + largest) // 2
+    data = encoder.encode(img)
+
+    assert len(data) <= encoder.max_bytes
+    assert Image.open(io.BytesIO(data)).format == fmt
+    # Not settled for the lowest quality when a better one fits
+    assert len(data) > smallest
+
+
+def test_encoder_returns_the_smallest_encoding_when_the_budget_cannot_be_met():
+    img = noise()
+    encoder = OutputEncoder(format="JPEG", max_bytes=1024, min_quality=50)
+    data = encoder.encode(img)
+
+    assert len(data) > encoder.max_bytes
+    assert data == encoder._save(img, quality=50, optimize=True)
+
+
+def test_encoder_strips_metadata_unless_asked_to_keep_it():
+    img = Image.new("RGB", (64, 64), "white")
+    exif = Image.Exif()
+    exif[0x010F] = "Camera"
+    img.info["exif"] = exif.tobytes()
+
+    stripped = OutputEncoder(format="JPEG", strip_metadata=True).encode(img)
+    kept = OutputEncoder(format="JPEG", strip_metadata=False).encode(img)
+    assert not Image.open(io.BytesIO(stripped)).getexif()
+    assert Image.open(io.BytesIO(kept)).getexif()[0x010F] == "Camera"
+
+
+def test_png_output_is_lossless():
+    img = noise((64, 64))
+    data = OutputEncoder(format="PNG", max_bytes=1024).encode(img)
+    assert np.array_equal(np.asarray(Image.open(io.BytesIO(data))), np.asarray(img))
@@ -0,0 +1,72 @@
+import time
+
+from job_store import DELIVERED, DONE, FAILED, PROCESSING, RECEIVED, JobStore
+
+
+def open_store(tmp_path):
+    return JobStore(path=str(tmp_path / "jobs.sqlite3"), result_dir=str(tmp_path / "results"))
+
+
+def test_unfinished_jobs_are_pending_after_a_restart(tmp_path):
+    store = open_store(tmp_path)
+    received = store.create(1, "file-a")
+    processing = store.create(2, "file-b")
+    store.start(processing)
+    done = store.create(3, "file-c")
+    store.save_result(done, b"result", "jpg")
+    delivered = store.create(4, "file-d")
+    store.save_result(delivered, b"result", "jpg")
+    store.mark_delivered(delivered)
+    failed = store.create(5, "file-e")
+    store.fail(failed, "invalid image")
+    store.close()
+
+    restarted = open_store(tmp_path)
+    pending = {job.id: job for job in restarted.pending()}
+    assert sorted(pending) == [received, processing, done]
+    assert pending[received].status == RECEIVED
+    assert pending[processing].status == PROCESSING
+    assert pending[done].status == DONE
+    # Finished results are delivered from disk, not recomputed
+    assert restarted.load_result(pending[done]) == b"result"
+    assert restarted.get(delivered).status == DELIVERED
+    assert restarted.get(failed).status == FAILED
+
+
+def test_attempts_are_counted(tmp_path):
+    store = open_store(tmp_path)
+    job_id = store.create(1, "file-a")
+    assert store.start(job_id) == 1
+    assert store.start(job_id) == 2
+
+
+def test_delivery_removes_the_result_file(tmp_path):
+    store = open_store(tmp_path)
+    job_id = store.create(1, "file-a")
+    store.save_result(job_id, b"result", "jpg")
+    path = store.get(job_id).result_path
+    store.mark_delivered(job_id)
+    assert not (tmp_path / "results" / path.split("/")[-1]).exists()
+    assert store.get(job_id).result_path is None
+
+
+def test_in_memory_store_keeps_results_until_delivered():
+    store = JobStore(path="", result_dir="")
+    job_id = store.create(1, "file-a", album="42")
+    store.save_result(job_id, b"result")
+    job = store.get(job_id)
+    assert job.album == "42"
+    assert store.load_result(job) == b"result"
+    store.mark_delivered(job_id)
+    assert store.pending() == []
+
+
+def test_purge_keeps_recent_and_pending_jobs(tmp_path):
+    store = JobStore(path=str(tmp_path / "jobs.sqlite3"), result_dir="", retention=0.001)
+    old = store.create(1, "file-a")
+    store.fail(old, "boom")
+    pending = store.create(2, "file-b")
+    time.sleep(0.01)
+    assert store.purge() == 1
+    assert store.get(old) is None
+    assert store.get(pending) is not None
@@ -0,0 +1,60 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from fake_gemini import FakeGeminiClient, synthetic_portrait
+from image_processor import ImageProcessor
+from imaging import OutputEncoder
+from local_processor import LocalProcessor
+
+
+@pytest.fixture(scope="module")
+def local():
+    return LocalProcessor(encoder=OutputEncoder(format="JPEG", max_bytes=240 * 1024))
+
+
+def decode(data):
+    return np.asarray(Image.open(io.BytesIO(data)).convert("RGB")).astype(np.float32)
+
+
+@pytest.mark.parametrize("size", [(600, 600), (413, 531)])
+def test_clear_portrait_is_framed_on_white_with_high_confidence(local, size):
+    # The portrait sits on a light grey background
+    result = local.process(synthetic_portrait(seed=2), size, head_ratio=0.6, eye_line=0.38)
+
+    assert result.confidence >= 0.8
+    assert Image.open(io.BytesIO(result.image)).format == "JPEG"
+    assert len(result.image) <= 240 * 1024
+    assert result.decoded.size == size
+    pixels = decode(result.image)
+    assert pixels.shape[:2] == (size[1], size[0])
+    # The background touching the top edge was whitened
+    assert pixels[:10].mean() > 250
+
+
+def test_photo_without_a_face_is_left_to_the_model(local):
+    output = io.BytesIO()
+    Image.new("RGB", (800, 800), (200, 180, 160)).save(output, "JPEG")
+    assert local.process(output.getvalue()) is None
+
+
+def test_confident_local_result_skips_the_model(local):
+    client = FakeGeminiClient(latency=0)
+    processor = ImageProcessor(client=client, local_processor=local)
+
+    result = processor.process_image(synthetic_portrait(seed=2))
+
+    assert result is not None
+    assert client.calls == 0
+
+
+def test_unsure_local_result_goes_to_the_model(local):
+    client = FakeGeminiClient(latency=0)
+    processor = ImageProcessor(client=client, local_processor=local)
+    processor.local_confidence_threshold = 1.01
+    processor.max_attempts = 1
+
+    assert processor.process_image(synthetic_portrait(seed=2)) is not None
+    assert client.calls == 1
@@ -0,0 +1,47 @@
+import asyncio
+
+import pytest
+
+from memory_budget import MemoryBudget, MemoryBudgetExceeded
+
+
+def test_job_above_the_job_limit_is_refused():
+    budget = MemoryBudget(total=100, job_limit=40)
+    with pytest.raises(MemoryBudgetExceeded):
+        budget.check(41)
+    budget.check(40)
+
+
+def test_reservations_wait_for_room():
+    budget = MemoryBudget(total=100, job_limit=60)
+    order = []
+
+    async def job(name, needed, hold):
+        async with budget.reserve(needed):
+            order.append(f"{name} start")
+            await asyncio.sleep(hold)
+            order.append(f"{name} end")
+
+    async def run():
+        first = asyncio.create_task(job("a", 60, 0.05))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(job("b", 60, 0))
+        await asyncio.sleep(0.01)
+        assert budget.reserved == 60
+        await asyncio.gather(first, second)
+
+    asyncio.run(run())
+    assert order == ["a start", "a end", "b start", "b end"]
+    assert budget.reserved == 0
+
+
+def test_reservation_is_returned_on_error():
+    budget = MemoryBudget(total=100, job_limit=100)
+
+    async def run():
+        with pytest.raises(RuntimeError):
+            async with budget.reserve(50):
+                raise RuntimeError("boom")
+
+    asyncio.run(run())
+    assert budget.reserved == 0
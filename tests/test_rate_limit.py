@@ -0,0 +1,89 @@
+import threading
+
+import pytest
+
+from rate_limit import RateLimiter, RateLimitExceeded, TokenBucket
+
+
+def test_bucket_allows_a_burst_then_refuses():
+    bucket = TokenBucket(rate=1.0, capacity=3, updated_at=100.0)
+    assert [bucket.reserve(now=100.0)[0] for _ in range(3)] == [True, True, True]
+    granted, retry_after = bucket.reserve(now=100.0)
+    assert not granted
+    assert retry_after == pytest.approx(1.0)
+
+
+def test_bucket_refills_over_time_up_to_capacity():
+    bucket = TokenBucket(rate=2.0, capacity=2, tokens=0, updated_at=100.0)
+    assert bucket.reserve(now=100.5) == (True, 0.0)
+    assert bucket.is_full(now=1000.0)
+    assert bucket.tokens == 2
+
+
+def test_bucket_borrows_up_to_max_wait():
+    bucket = TokenBucket(rate=1.0, capacity=1, tokens=0, updated_at=100.0)
+    granted, wait = bucket.reserve(max_wait=2.0, now=100.0)
+    assert granted and wait == pytest.approx(1.0)
+    # The borrowed token is owed; the next caller waits behind it
+    granted, wait = bucket.reserve(max_wait=2.0, now=100.0)
+    assert granted and wait == pytest.approx(2.0)
+    granted, retry_after = bucket.reserve(max_wait=2.0, now=100.0)
+    assert not granted and retry_after == pytest.approx(1.0)
+
+
+def test_user_limit_is_per_user():
+    limiter = RateLimiter(user_per_hour=1, user_burst=2, global_per_minute=0, path="")
+    limiter.check_user(1)
+    limiter.check_user(1)
+    with pytest.raises(RateLimitExceeded) as excinfo:
+        limiter.check_user(1)
+    assert excinfo.value.scope == "user"
+    assert excinfo.value.retry_after >= 1
+    limiter.check_user(2)
+
+
+def test_global_limit_refuses_beyond_max_wait():
+    limiter = RateLimiter(user_per_hour=0, global_per_minute=60, global_burst=1, global_max_wait=0, path="")
+    assert limiter.check_global() == 0
+    assert limiter.acquire_global()
+    with pytest.raises(RateLimitExceeded):
+        limiter.check_global()
+    with pytest.raises(RateLimitExceeded):
+        limiter.acquire_global()
+
+
+def test_global_wait_is_capped_by_the_caller():
+    limiter = RateLimiter(user_per_hour=0, global_per_minute=600, global_burst=1, global_max_wait=5, path="")
+    assert limiter.acquire_global()
+    # The next token is 0.1s away: too long for a hedge, fine for a request
+    with pytest.raises(RateLimitExceeded):
+        limiter.acquire_global(max_wait=0)
+    assert limiter.acquire_global(max_wait=1)
+
+
+def test_cancelled_global_wait_gives_the_token_back():
+    limiter = RateLimiter(user_per_hour=0, global_per_minute=60, global_burst=1, global_max_wait=5, path="")
+    assert limiter.acquire_global()
+    cancel = threading.Event()
+    cancel.set()
+    assert not limiter.acquire_global(cancel_event=cancel)
+    # Only the first token is spent, so the next one is still a second away
+    assert limiter.check_global() <= 1
+
+
+def test_state_survives_a_restart(tmp_path):
+    path = str(tmp_path / "limits.json")
+    limiter = RateLimiter(user_per_hour=1, user_burst=1, global_per_minute=0, path=path)
+    limiter.check_user(7)
+    limiter.save()
+
+    restarted = RateLimiter(user_per_hour=1, user_burst=1, global_per_minute=0, path=path)
+    with pytest.raises(RateLimitExceeded):
+        restarted.check_user(7)
+
+
+def test_refunded_global_token_can_be_used_again():
+    limiter = RateLimiter(user_per_hour=0, global_per_minute=1, global_burst=1, global_max_wait=0, path="")
+    assert limiter.acquire_global()
+    limiter.refund_global()
+    assert limiter.acquire_global()
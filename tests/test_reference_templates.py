@@ -0,0 +1,51 @@
+from fake_gemini import FakeGeminiClient, synthetic_portrait
+from image_processor import ImageProcessor
+from reference_templates import TemplateRegistry
+
+
+def make_processor(client, use_context_cache=False):
+    templates = TemplateRegistry(client, "test-model", use_context_cache=use_context_cache)
+    processor = ImageProcessor(client=client, templates=templates)
+    processor.local_processor = None
+    processor.compliance_checker = None
+    return processor
+
+
+def test_reference_image_is_loaded_once_and_reused_by_every_request():
+    client = FakeGeminiClient(latency=0)
+    processor = make_processor(client)
+    # dv and us_passport share the bundled sample
+    assert processor.templates.load_count == 1
+
+    for seed, template in enumerate(["dv", "dv", "us_passport"]):
+        assert processor.process_image(synthetic_portrait(seed=seed), template) is not None
+
+    assert client.calls == 3
+    # Every request carried the same in-memory reference buffer
+    assert len(client.reference_ids) == 1
+    assert processor.templates.load_count == 1
+
+
+def test_context_cache_uploads_the_prefix_once_per_template():
+    client = FakeGeminiClient(latency=0, support_caching=True)
+    processor = make_processor(client, use_context_cache=True)
+
+    for seed in range(3):
+        assert processor.process_image(synthetic_portrait(seed=seed), "dv") is not None
+
+    assert client.cache_creates == 1
+    # Requests only carry the user's photo
+    assert client.reference_ids == set()
+    assert processor.templates.get("dv").cached_content == "cachedContents/fake-1"
+
+
+def test_refused_context_cache_falls_back_to_the_inline_prefix():
+    client = FakeGeminiClient(latency=0, support_caching=False)
+    processor = make_processor(client, use_context_cache=True)
+
+    for seed in range(2):
+        assert processor.process_image(synthetic_portrait(seed=seed), "dv") is not None
+
+    assert processor.templates.use_context_cache is False
+    assert client.calls == 2
+    assert len(client.reference_ids) == 1
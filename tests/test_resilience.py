@@ -0,0 +1,327 @@
+import threading
+import time
+
+import pytest
+
+from resilience import (
+    AdaptiveLimiter,
+    CircuitBreaker,
+    CircuitOpenError,
+    DeadlineExceededError,
+    ResilientCaller,
+)
+from rate_limit import RateLimiter, RateLimitExceeded
+
+
+class UpstreamError(Exception):
+    def __init__(self, code):
+        super().__init__(f"HTTP {code}")
+        self.code = code
+
+
+def make_caller(**kwargs):
+    kwargs.setdefault("breaker", CircuitBreaker(failure_rate=0.5, window=4, min_calls=2, cooldown=0.1))
+    kwargs.setdefault("limiter", AdaptiveLimiter(initial=2, adaptive=False))
+    kwargs.setdefault("hedge", False)
+    kwargs.setdefault("backoff_base", 0.01)
+    kwargs.setdefault("backoff_max", 0.01)
+    kwargs.setdefault("min_attempt", 0)
+    return ResilientCaller(**kwargs)
+
+
+def wait_until_idle(limiter, timeout=2.0):
+    end = time.monotonic() + timeout
+    while limiter.in_flight and time.monotonic() < end:
+        time.sleep(0.01)
+    return limiter.in_flight
+
+
+def test_breaker_opens_after_failures_and_closes_after_trial():
+    breaker = CircuitBreaker(failure_rate=0.5, window=4, min_calls=2, cooldown=0.05)
+    breaker.record(False)
+    assert breaker.state == "closed"
+    breaker.record(False)
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    # Only one trial call at a time
+    assert not breaker.allow()
+    breaker.record(True)
+    assert breaker.state == "closed"
+
+
+def test_breaker_release_keeps_it_half_open():
+    breaker = CircuitBreaker(failure_rate=0.5, window=4, min_calls=1, cooldown=0.01)
+    breaker.record(False)
+    time.sleep(0.02)
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+
+
+def test_call_retries_transient_errors():
+    caller = make_caller(max_retries=2, breaker=CircuitBreaker(failure_rate=0.9, window=10, min_calls=5))
+    attempts = []
+
+    def func(abandon):
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise UpstreamError(503)
+        return "image"
+
+    assert caller.call(func) == "image"
+    assert len(attempts) == 3
+    assert list(caller.breaker._outcomes) == [False, False, True]
+
+
+def test_call_does_not_retry_permanent_errors():
+    caller = make_caller(max_retries=2)
+    attempts = []
+
+    def func(abandon):
+        attempts.append(1)
+        raise UpstreamError(400)
+
+    with pytest.raises(UpstreamError):
+        caller.call(func)
+    assert len(attempts) == 1
+
+
+def test_call_refused_while_breaker_open():
+    caller = make_caller()
+    caller.breaker.record(False)
+    caller.breaker.record(False)
+    with pytest.raises(CircuitOpenError):
+        caller.call(lambda abandon: "image")
+    assert caller.limiter.in_flight == 0
+
+
+def test_attempt_timeout_abandons_the_call():
+    caller = make_caller(attempt_timeout=0.1, deadline=0.3, max_retries=0)
+    abandoned = threading.Event()
+
+    def func(abandon):
+        abandon.wait(2)
+        abandoned.set()
+
+    with pytest.raises(DeadlineExceededError):
+        caller.call(func)
+    assert abandoned.wait(1)
+    assert wait_until_idle(caller.limiter) == 0
+
+
+def test_cancelled_call_is_not_recorded():
+    caller = make_caller()
+    cancel = threading.Event()
+    threading.Timer(0.1, cancel.set).start()
+
+    def func(abandon):
+        abandon.wait(2)
+        return None
+
+    assert caller.call(func, cancel) is None
+    assert list(caller.breaker._outcomes) == []
+    assert wait_until_idle(caller.limiter) == 0
+
+
+def test_cancelled_trial_does_not_close_the_breaker():
+    caller = make_caller()
+    caller.breaker.record(False)
+    caller.breaker.record(False)
+    time.sleep(0.12)
+    cancel = threading.Event()
+    threading.Timer(0.05, cancel.set).start()
+
+    assert caller.call(lambda abandon: abandon.wait(2), cancel) is None
+    assert caller.breaker.state == "half_open"
+
+
+def test_hung_attempt_gives_its_slot_back_when_abandoned():
+    caller = make_caller(attempt_timeout=0.05, deadline=0.1, max_retries=0)
+    release = threading.Event()
+
+    def func(abandon):
+        # Ignores the abandon event, like a stream stuck in a read
+        release.wait(2)
+
+    with pytest.raises(DeadlineExceededError):
+        caller.call(func)
+    assert caller.limiter.in_flight == 0
+    release.set()
+
+
+def test_spent_deadline_is_not_blamed_on_the_upstream():
+    caller = make_caller(limiter=AdaptiveLimiter(initial=4), min_attempt=0.5)
+    calls = []
+
+    for _ in range(5):
+        with pytest.raises(DeadlineExceededError):
+            caller.call(lambda abandon: calls.append(True) or "image", deadline=time.monotonic() - 1)
+        with pytest.raises(DeadlineExceededError):
+            caller.call(lambda abandon: calls.append(True) or "image", deadline=time.monotonic() + 0.1)
+
+    assert calls == []
+    assert caller.limiter.limit == 4
+    assert caller.breaker.state == "closed"
+    assert caller.call(lambda abandon: "image") == "image"
+
+
+def test_attempt_cut_short_by_the_caller_deadline_is_not_recorded():
+    caller = make_caller(limiter=AdaptiveLimiter(initial=4), attempt_timeout=5, max_retries=0)
+
+    for _ in range(3):
+        with pytest.raises(DeadlineExceededError):
+            caller.call(lambda abandon: abandon.wait(2), deadline=time.monotonic() + 0.05)
+
+    assert list(caller.breaker._outcomes) == []
+    assert caller.limiter.limit == 4
+    assert wait_until_idle(caller.limiter) == 0
+
+
+def test_attempt_timeout_counts_as_an_upstream_failure():
+    caller = make_caller(limiter=AdaptiveLimiter(initial=4), attempt_timeout=0.05, max_retries=0)
+
+    with pytest.raises(DeadlineExceededError):
+        caller.call(lambda abandon: abandon.wait(2), deadline=time.monotonic() + 5)
+
+    assert list(caller.breaker._outcomes) == [False]
+    assert caller.limiter.limit == 2
+
+
+def quota(burst):
+    # Refills one token per hour, so the test sees exactly what was spent
+    return RateLimiter(user_per_hour=0, global_per_minute=1 / 60, global_burst=burst, global_max_wait=0, path="")
+
+
+def test_every_retry_takes_a_quota_token():
+    caller = make_caller(max_retries=2, rate_limiter=quota(3),
+                         breaker=CircuitBreaker(failure_rate=0.9, window=10, min_calls=5))
+    attempts = []
+
+    def func(abandon):
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise UpstreamError(503)
+        return "image"
+
+    assert caller.call(func) == "image"
+    with pytest.raises(RateLimitExceeded):
+        caller.call(func)
+    assert len(attempts) == 3
+
+
+def test_hedge_takes_a_quota_token_and_is_skipped_without_one():
+    caller = make_caller(hedge=True, hedge_min_samples=1, rate_limiter=quota(3),
+                         limiter=AdaptiveLimiter(initial=2, adaptive=False))
+    # A fast first call sets the p95, so the next one is hedged right away
+    assert caller.call(lambda abandon: "fast") == "fast"
+    calls = []
+
+    def func(abandon):
+        calls.append(1)
+        if len(calls) == 1:
+            # The first request hangs until the hedge has won
+            abandon.wait(2)
+            return "slow"
+        return "hedge"
+
+    assert caller.call(func) == "hedge"
+    assert len(calls) == 2
+
+    # The quota is used up: the next call is refused before reaching the model
+    with pytest.raises(RateLimitExceeded):
+        caller.call(func)
+    assert len(calls) == 2
+    assert wait_until_idle(caller.limiter) == 0
+
+
+def test_hedge_is_not_sent_without_a_free_quota_token():
+    rate_limiter = quota(2)
+    caller = make_caller(hedge=True, hedge_min_samples=1, rate_limiter=rate_limiter,
+                         limiter=AdaptiveLimiter(initial=2, adaptive=False))
+    assert caller.call(lambda abandon: "fast") == "fast"
+    acquire_global = rate_limiter.acquire_global
+    refused = threading.Event()
+
+    def watch(*args, **kwargs):
+        try:
+            return acquire_global(*args, **kwargs)
+        except RateLimitExceeded:
+            refused.set()
+            raise
+
+    rate_limiter.acquire_global = watch
+    calls = []
+
+    def func(abandon):
+        calls.append(1)
+        # Answer once the hedge has been refused its token
+        refused.wait(2)
+        return "slow"
+
+    assert caller.call(func) == "slow"
+    assert refused.is_set()
+    assert calls == [1]
+    assert wait_until_idle(caller.limiter) == 0
+
+
+def test_limiter_blocks_at_the_limit():
+    limiter = AdaptiveLimiter(initial=1, adaptive=False)
+    assert limiter.acquire(timeout=0)
+    assert not limiter.acquire(timeout=0.05)
+    limiter.release()
+    assert limiter.acquire(timeout=0)
+    limiter.release()
+
+
+def test_limiter_acquire_stops_on_cancel():
+    limiter = AdaptiveLimiter(initial=1, adaptive=False)
+    limiter.acquire()
+    cancel = threading.Event()
+    cancel.set()
+    assert not limiter.acquire(cancel_event=cancel)
+    limiter.release()
+
+
+def test_limiter_grows_when_saturated_and_halves_on_overload():
+    limiter = AdaptiveLimiter(initial=2, min_limit=1, max_limit=8, backoff=0.5)
+    for _ in range(4):
+        # Both slots busy: the limit is what holds calls back
+        limiter.acquire()
+        limiter.acquire()
+        limiter.release()
+        limiter.on_success(0.1)
+        limiter.release()
+    assert limiter.limit > 2
+
+    before = limiter.limit
+    limiter.on_overload("429")
+    assert limiter.limit == max(1, int(before * 0.5))
+    # A burst of errors from calls already running counts once
+    limiter.on_overload("429")
+    assert limiter.limit == max(1, int(before * 0.5))
+
+
+def test_limiter_does_not_grow_while_underused():
+    limiter = AdaptiveLimiter(initial=4, max_limit=8)
+    for _ in range(20):
+        limiter.acquire()
+        limiter.release()
+        limiter.on_success(0.1)
+    assert limiter.limit == 4
+
+
+def test_limiter_treats_latency_spikes_as_overload():
+    limiter = AdaptiveLimiter(initial=4, latency_spike=2.0)
+    limiter.on_success(0.1)
+    limiter.on_success(1.0)
+    assert limiter.limit == 2
+
+
+def test_static_limiter_never_changes():
+    limiter = AdaptiveLimiter(initial=3, adaptive=False)
+    limiter.on_overload("503")
+    assert limiter.limit == 3
@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+
+from result_cache import ResultCache
+
+
+def test_results_are_cached_per_template():
+    cache = ResultCache(disk_dir="")
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        return b"result"
+
+    async def run():
+        assert await cache.get_or_compute(b"photo", "dv", compute) == b"result"
+        assert await cache.get_or_compute(b"photo", "dv", compute) == b"result"
+        await cache.get_or_compute(b"photo", "passport", compute)
+
+    asyncio.run(run())
+    assert len(calls) == 2
+
+
+def test_disk_tier_is_off_by_default(monkeypatch):
+    monkeypatch.delenv("RESULT_CACHE_DIR", raising=False)
+    assert ResultCache().disk_dir == ""
+
+
+def test_disk_tier_survives_a_restart(tmp_path):
+    async def compute():
+        return b"result"
+
+    asyncio.run(ResultCache(disk_dir=str(tmp_path)).get_or_compute(b"photo", "dv", compute))
+
+    async def fail():
+        raise AssertionError("should be cached")
+
+    restarted = ResultCache(disk_dir=str(tmp_path))
+    assert asyncio.run(restarted.get_or_compute(b"photo", "dv", fail)) == b"result"
+
+
+def test_concurrent_requests_are_coalesced():
+    cache = ResultCache(disk_dir="")
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return b"result"
+
+    async def run():
+        return await asyncio.gather(*(cache.get_or_compute(b"photo", "dv", compute) for _ in range(3)))
+
+    assert asyncio.run(run()) == [b"result"] * 3
+    assert len(calls) == 1
+    assert cache.stats["coalesced"] == 2
+
+
+def test_waiter_takes_over_when_the_first_request_is_cancelled():
+    cache = ResultCache(disk_dir="")
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return b"result"
+
+    async def run():
+        first = asyncio.create_task(cache.get_or_compute(b"photo", "dv", compute))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(cache.get_or_compute(b"photo", "dv", compute))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(run()) == b"result"
+    assert len(calls) == 2
+
+
+def test_cancelled_waiter_is_cancelled():
+    cache = ResultCache(disk_dir="")
+
+    async def compute():
+        await asyncio.sleep(0.05)
+        return b"result"
+
+    async def run():
+        first = asyncio.create_task(cache.get_or_compute(b"photo", "dv", compute))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(cache.get_or_compute(b"photo", "dv", compute))
+        await asyncio.sleep(0.01)
+        second.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await second
+        return await first
+
+    assert asyncio.run(run()) == b"result"
@@ -0,0 +1,101 @@
+import asyncio
+import threading
+
+import pytest
+
+from scheduler import FairScheduler, QueueFullError
+from worker_pool import WorkerPool
+
+
+def make_scheduler(max_depth=100):
+    return FairScheduler(WorkerPool(max_workers=1, job_timeout=5), max_depth=max_depth)
+
+
+async def finish(scheduler):
+    """Stop the dispatchers and let the queued position reports run"""
+    await scheduler.close()
+    others = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    await asyncio.gather(*others)
+
+
+def test_jobs_are_dispatched_round_robin_across_chats():
+    scheduler = make_scheduler()
+    order = []
+
+    def job(name, cancel_event):
+        order.append(name)
+        return name
+
+    async def run():
+        # All five are queued before the single worker takes the first
+        jobs = [
+            asyncio.create_task(scheduler.submit(chat_id, job, name))
+            for chat_id, name in [(1, "a1"), (1, "a2"), (1, "a3"), (2, "b1"), (3, "c1")]
+        ]
+        await asyncio.gather(*jobs)
+        await finish(scheduler)
+
+    asyncio.run(run())
+    assert order == ["a1", "b1", "c1", "a2", "a3"]
+    scheduler.worker_pool.shutdown()
+
+
+def test_waiting_jobs_are_told_their_position_until_they_start():
+    scheduler = make_scheduler()
+    positions = {"a3": [], "c1": []}
+
+    def reporter(name):
+        async def report(position, eta):
+            positions[name].append(position)
+        return report
+
+    async def run():
+        jobs = [
+            asyncio.create_task(scheduler.submit(
+                chat_id, lambda name, cancel_event: name, name, on_position=reporter(name) if name in positions else None,
+            ))
+            for chat_id, name in [(1, "a1"), (1, "a2"), (1, "a3"), (2, "b1"), (3, "c1")]
+        ]
+        await asyncio.gather(*jobs)
+        await finish(scheduler)
+
+    asyncio.run(run())
+    # c1 goes third in the first round; a3 is pushed back as other chats join, then moves up
+    assert positions["c1"] == [3, 2, 1, 0]
+    assert positions["a3"] == [3, 4, 5, 4, 3, 2, 1, 0]
+    scheduler.worker_pool.shutdown()
+
+
+def test_full_queue_refuses_new_jobs_and_cancelled_jobs_leave_it():
+    scheduler = make_scheduler(max_depth=2)
+    release = threading.Event()
+    started = threading.Event()
+
+    def blocking(cancel_event):
+        started.set()
+        release.wait(5)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        running = asyncio.create_task(scheduler.submit(1, blocking))
+        assert await loop.run_in_executor(None, started.wait, 5)
+        waiting = [asyncio.create_task(scheduler.submit(chat_id, lambda cancel_event: None)) for chat_id in (2, 3)]
+        await asyncio.sleep(0)
+        assert scheduler.depth == 2
+
+        with pytest.raises(QueueFullError):
+            scheduler.ensure_capacity()
+        with pytest.raises(QueueFullError):
+            await scheduler.submit(4, lambda cancel_event: None)
+
+        waiting[0].cancel()
+        await asyncio.gather(waiting[0], return_exceptions=True)
+        assert scheduler.depth == 1
+        scheduler.ensure_capacity()
+
+        release.set()
+        await asyncio.gather(running, waiting[1])
+        await finish(scheduler)
+
+    asyncio.run(run())
+    scheduler.worker_pool.shutdown()
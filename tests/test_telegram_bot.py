@@ -0,0 +1,238 @@
+import asyncio
+import email
+import email.policy
+import json
+import threading
+import types
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from fake_gemini import FakeGeminiClient, synthetic_portrait
+from image_processor import ImageProcessor
+from imaging import OutputEncoder
+from job_store import DELIVERED, JobStore
+from rate_limit import RateLimiter
+from telegram_bot import DVPhotoBot
+
+
+@pytest.fixture
+def bot():
+    # The journal and file_id cache paths come from conftest's isolated_state
+    return DVPhotoBot(token="test", image_processor=ImageProcessor(client=FakeGeminiClient(latency=0)))
+
+
+def test_result_names_follow_the_template_and_encoder(bot):
+    bot.image_processor.output_encoder = OutputEncoder(format="PNG")
+    bot.image_processor.templates.get("dv").output_size = (800, 1000)
+
+    assert bot.result_filename("dv") == "dv_lottery_photo_800x1000.png"
+    assert bot.result_filename("dv", 3) == "dv_lottery_photo_800x1000_3.png"
+    caption = bot.result_caption(b"x" * 2048, "dv")
+    assert "(800x1000)" in caption
+    assert "PNG format, 2 KB" in caption
+
+
+def test_cache_namespace_changes_with_the_byte_budget(bot):
+    bot.image_processor.output_encoder = OutputEncoder(format="JPEG", max_bytes=240 * 1024)
+    small = bot.cache_template("dv")
+    bot.image_processor.output_encoder = OutputEncoder(format="JPEG", max_bytes=100 * 1024)
+    assert bot.cache_template("dv") != small
+
+
+class FakeMessage:
+    def __init__(self, message_id, replies, media_group_id=None):
+        self.message_id = message_id
+        self.media_group_id = media_group_id
+        self.replies = replies
+
+    async def reply_text(self, text):
+        self.replies.append(text)
+        return types.SimpleNamespace(message_id=1000 + len(self.replies))
+
+
+def photo_update(message_id, replies, media_group_id=None):
+    return types.SimpleNamespace(
+        message=FakeMessage(message_id, replies, media_group_id),
+        effective_user=types.SimpleNamespace(id=7),
+        effective_chat=types.SimpleNamespace(id=7),
+    )
+
+
+def send_album(bot, size, replies):
+    """Deliver an album photo by photo and return the job ids handed to run_album"""
+    started = []
+
+    async def run_album(job_ids, telegram_bot):
+        started.extend(job_ids)
+
+    bot.run_album = run_album
+    bot.album_wait = 0.01
+    context = types.SimpleNamespace(bot=None, application=None)
+
+    async def run():
+        for message_id in range(1, size + 1):
+            await bot.accept_job(photo_update(message_id, replies, "album-1"), context, f"photo-{message_id}", "photo")
+        await asyncio.gather(*bot.job_tasks)
+
+    asyncio.run(run())
+    return started
+
+
+def test_album_over_the_user_limit_gets_one_reply(bot):
+    bot.rate_limiter = RateLimiter(user_per_hour=1, user_burst=5, global_per_minute=0, path="")
+    replies = []
+
+    started = send_album(bot, 8, replies)
+
+    assert len(started) == 5
+    assert len(replies) == 1
+    assert replies[0].startswith("🔄 Processing 5 of your 8 photos")
+    assert "sending photos too quickly" in replies[0]
+
+
+def test_album_refused_entirely_gets_one_reply(bot):
+    bot.rate_limiter = RateLimiter(user_per_hour=1, user_burst=1, global_per_minute=0, path="")
+    bot.rate_limiter.check_user(7)
+    replies = []
+
+    assert send_album(bot, 4, replies) == []
+    assert len(replies) == 1
+    assert "sending photos too quickly" in replies[0]
+
+
+def test_full_queue_does_not_spend_the_user_token(bot):
+    bot.rate_limiter = RateLimiter(user_per_hour=1, user_burst=1, global_per_minute=0, path="")
+    bot.scheduler.is_full = lambda: True
+    replies = []
+
+    asyncio.run(bot.accept_job(photo_update(1, replies), None, "photo-1", "photo"))
+
+    assert replies == ["🚦 The bot is busy right now. Please try again in a few minutes."]
+    # The only token is still there for when the queue has room
+    bot.rate_limiter.check_user(7)
+
+
+class BotApiStub:
+    """
+    Local stand-in for the Telegram Bot API, served over HTTP
+
+    The bot talks to it through TELEGRAM_API_BASE_URL and
+    TELEGRAM_API_BASE_FILE_URL, so the real Application and Bot are used.
+    """
+
+    def __init__(self, files):
+        self.files = files
+        self.documents = []
+        self.texts = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                data = stub.files[self.path.rsplit("/", 1)[-1]]
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", "0")))
+                method = self.path.rsplit("/", 1)[-1]
+                result = stub.answer(method, stub.parse(self.headers.get("Content-Type", ""), body))
+                payload = json.dumps({"ok": True, "result": result}).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    @staticmethod
+    def parse(content_type, body):
+        if content_type.startswith("multipart/"):
+            message = email.message_from_bytes(
+                f"Content-Type: {content_type}\r\n\r\n".encode("utf-8") + body, policy=email.policy.HTTP
+            )
+            return {
+                part.get_param("name", header="content-disposition"): part.get_payload(decode=True)
+                for part in message.iter_parts()
+            }
+        return {key: values[0] for key, values in urllib.parse.parse_qs(body.decode("utf-8")).items()}
+
+    def answer(self, method, params):
+        message = {"message_id": len(self.documents) + len(self.texts) + 100, "date": 0,
+                   "chat": {"id": int(params.get("chat_id", 1)), "type": "private"}}
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Test", "username": "test_bot"}
+        if method == "getFile":
+            file_id = params["file_id"]
+            return {"file_id": file_id, "file_unique_id": file_id, "file_size": len(self.files[file_id]),
+                    "file_path": f"photos/{file_id}"}
+        if method == "sendDocument":
+            document = params["document"]
+            self.documents.append((int(params["chat_id"]), document))
+            return {**message, "document": {"file_id": f"sent-{len(self.documents)}", "file_unique_id": "d"}}
+        if method in ("editMessageText", "sendMessage"):
+            self.texts.append(params.get("text"))
+            return {**message, "text": params.get("text")}
+        raise AssertionError(f"Unexpected Bot API call {method}")
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def bot_api(monkeypatch):
+    stub = BotApiStub({})
+    monkeypatch.setenv("TELEGRAM_API_BASE_URL", f"{stub.url}/bot")
+    monkeypatch.setenv("TELEGRAM_API_BASE_FILE_URL", f"{stub.url}/file/bot")
+    yield stub
+    stub.close()
+
+
+def test_restart_resumes_interrupted_jobs_once_the_application_runs(bot_api):
+    journal = JobStore()
+    interrupted = journal.create(1, "photo-1", status_message_id=10)
+    journal.start(interrupted)
+    finished = journal.create(2, "photo-2", status_message_id=20)
+    journal.save_result(finished, b"stored result", "jpg")
+    journal.close()
+    bot_api.files["photo-1"] = synthetic_portrait(seed=1)
+
+    client = FakeGeminiClient(latency=0.2)
+    bot = DVPhotoBot(token="123:test", image_processor=ImageProcessor(client=client))
+    bot.image_processor.max_attempts = 1
+    bot.rate_limiter = RateLimiter(user_per_hour=0, global_per_minute=0, path="")
+    bot.image_processor.resilience.rate_limiter = bot.rate_limiter
+
+    async def run():
+        # The same sequence as a webhook worker, and as run_polling
+        application = bot.build_application(updater=False)
+        await application.initialize()
+        await bot.startup(application)
+        assert not bot.job_tasks
+        await application.start()
+        assert bot.job_tasks
+        # stop() waits for the resumed jobs before post_shutdown closes the pool
+        await application.stop()
+        await bot.shutdown(application)
+        await application.shutdown()
+
+    asyncio.run(run())
+
+    delivered = dict(bot_api.documents)
+    assert set(delivered) == {1, 2}
+    # The stored result is sent as is; only the interrupted job calls the model
+    assert delivered[2] == b"stored result"
+    assert client.calls == 1
+    journal = JobStore()
+    assert journal.get(interrupted).status == DELIVERED
+    assert journal.get(finished).status == DELIVERED
@@ -0,0 +1,41 @@
+import asyncio
+import types
+
+from telegram_bot import ChatOrderedUpdateProcessor
+
+
+def update_for(chat_id):
+    return types.SimpleNamespace(effective_chat=types.SimpleNamespace(id=chat_id))
+
+
+def test_updates_of_one_chat_run_in_order_and_chats_run_concurrently():
+    processor = ChatOrderedUpdateProcessor(8)
+    events = []
+
+    async def handle(name, delay):
+        events.append(f"{name} start")
+        await asyncio.sleep(delay)
+        events.append(f"{name} end")
+
+    async def run():
+        await asyncio.gather(
+            processor.process_update(update_for(1), handle("a1", 0.05)),
+            processor.process_update(update_for(1), handle("a2", 0)),
+            processor.process_update(update_for(2), handle("b1", 0)),
+        )
+
+    asyncio.run(run())
+    assert events.index("a1 end") < events.index("a2 start")
+    assert events.index("b1 end") < events.index("a1 end")
+    assert processor._chats == {}
+
+
+def test_updates_without_a_chat_are_processed():
+    processor = ChatOrderedUpdateProcessor(1)
+    done = []
+
+    async def handle():
+        done.append(True)
+
+    asyncio.run(processor.process_update(types.SimpleNamespace(effective_chat=None), handle()))
+    assert done == [True]
@@ -0,0 +1,84 @@
+import queue
+import threading
+
+import pytest
+
+from webhook_server import WebhookServer, chat_id_for
+
+
+@pytest.mark.parametrize("update, chat_id", [
+    ({"update_id": 1, "message": {"chat": {"id": 42}, "from": {"id": 7}}}, 42),
+    ({"update_id": 2, "edited_message": {"chat": {"id": -100}}}, -100),
+    ({"update_id": 3, "callback_query": {"from": {"id": 7}, "message": {"chat": {"id": 42}}}}, 42),
+    ({"update_id": 4, "my_chat_member": {"chat": {"id": 43}, "from": {"id": 7}}}, 43),
+    ({"update_id": 5, "inline_query": {"from": {"id": 7}, "query": "x"}}, 7),
+    ({"update_id": 6, "poll_answer": {"user": {"id": 8}}}, 8),
+    ({"update_id": 9, "poll": {"id": "p"}}, 9),
+])
+def test_updates_are_routed_by_chat_then_sender(update, chat_id):
+    assert chat_id_for(update) == chat_id
+
+
+def test_every_update_of_a_chat_goes_to_the_same_worker():
+    server = WebhookServer("token", workers=3)
+    message = {"update_id": 1, "message": {"chat": {"id": 42}}}
+    callback = {"update_id": 2, "callback_query": {"from": {"id": 7}, "message": {"chat": {"id": 42}}}}
+    assert server.route(message) == server.route(callback) == 42 % 3
+
+
+class FakeWorker:
+    """A thread standing in for a worker process that reads its update queue"""
+
+    def __init__(self, updates, consume=True):
+        self.name = "fake-worker"
+        self.updates = updates
+        self.handled = []
+        self.killed = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run if consume else self._stop.wait, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            data = self.updates.get()
+            if data is None:
+                return
+            self.handled.append(data)
+
+    def is_alive(self):
+        return self._thread.is_alive()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def kill(self):
+        self.killed = True
+        self._stop.set()
+
+
+def test_drain_lets_workers_finish_their_queued_updates():
+    server = WebhookServer("token", workers=2)
+    server.queues = [queue.Queue(10) for _ in range(2)]
+    for index, updates in enumerate(server.queues):
+        updates.put({"update_id": index})
+    server.processes = [FakeWorker(updates) for updates in server.queues]
+    server._accepting = True
+
+    server.drain(timeout=5)
+
+    assert [worker.handled for worker in server.processes] == [[{"update_id": 0}], [{"update_id": 1}]]
+    assert not any(worker.killed for worker in server.processes)
+    assert not server.dispatch({"update_id": 3, "message": {"chat": {"id": 1}}})
+
+
+def test_drain_does_not_hang_on_a_full_queue_of_a_stuck_worker():
+    server = WebhookServer("token", workers=1)
+    updates = queue.Queue(1)
+    updates.put({"update_id": 1})
+    server.queues = [updates]
+    server.processes = [FakeWorker(updates, consume=False)]
+
+    server.drain(timeout=0.2)
+
+    assert server.processes[0].killed
+    assert not server.processes[0].is_alive()
@@ -0,0 +1,141 @@
+import asyncio
+import threading
+import types
+
+import pytest
+
+from fake_gemini import FakeGeminiClient, synthetic_portrait
+from image_processor import ImageProcessor
+from resilience import AdaptiveLimiter, ResilientCaller
+from telegram_bot import DVPhotoBot
+from worker_pool import JobTimeoutError, WorkerPool
+
+
+def wait_for_cancel(seen, cancel_event):
+    seen.append(cancel_event)
+    cancel_event.wait(5)
+    return cancel_event.is_set()
+
+
+def test_job_timeout_sets_the_cancel_event_and_frees_the_slot():
+    pool = WorkerPool(max_workers=1, job_timeout=0.05)
+    seen = []
+
+    async def run():
+        with pytest.raises(JobTimeoutError):
+            await pool.run(wait_for_cancel, seen)
+        assert seen[0].is_set()
+        # The next job gets the slot once the timed out one has stopped
+        return await pool.run(lambda cancel_event: "next", timeout=5)
+
+    assert asyncio.run(run()) == "next"
+    assert pool.in_flight == 0
+    pool.shutdown()
+
+
+def test_cancelling_the_caller_cancels_the_job():
+    pool = WorkerPool(max_workers=1, job_timeout=5)
+    seen = []
+
+    async def run():
+        task = asyncio.create_task(pool.run(wait_for_cancel, seen))
+        while not seen:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert seen[0].is_set()
+        # The slot is given back once the worker thread has returned
+        while pool.in_flight:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    pool.shutdown()
+
+
+def test_commands_are_answered_while_every_worker_is_busy():
+    # The stand-in model blocks until the test lets it answer
+    answer = threading.Event()
+    started = threading.Semaphore(0)
+
+    def latency(call):
+        started.release()
+        answer.wait(5)
+        return 0
+
+    bot = DVPhotoBot(token="test", image_processor=ImageProcessor(client=FakeGeminiClient(latency=latency)))
+    bot.image_processor.local_processor = None
+    bot.image_processor.compliance_checker = None
+    bot.worker_pool = WorkerPool(max_workers=2, job_timeout=10)
+    bot.scheduler.worker_pool = bot.worker_pool
+    replies = []
+
+    async def reply_text(text):
+        replies.append(text)
+
+    update = types.SimpleNamespace(message=types.SimpleNamespace(reply_text=reply_text))
+    image = synthetic_portrait(seed=1)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        jobs = [
+            asyncio.create_task(bot.scheduler.submit(chat_id, bot.image_processor.process_image, image))
+            for chat_id in (1, 2, 3)
+        ]
+        # Both workers are inside a model call and a third job is queued
+        for _ in range(2):
+            assert await loop.run_in_executor(None, started.acquire, True, 5)
+        await bot.start(update, None)
+        await bot.help_command(update, None)
+        assert len(replies) == 2
+        assert not any(job.done() for job in jobs)
+        assert bot.worker_pool.in_flight == 2
+
+        answer.set()
+        results = await asyncio.gather(*jobs)
+        await bot.scheduler.close()
+        return results
+
+    assert all(asyncio.run(run()))
+    bot.worker_pool.shutdown()
+
+
+def test_pool_size_follows_the_model_concurrency_max(monkeypatch):
+    monkeypatch.delenv("MAX_CONCURRENT_JOBS", raising=False)
+    monkeypatch.setenv("MODEL_CONCURRENCY_MAX", "12")
+    assert WorkerPool().max_workers == 12
+    monkeypatch.setenv("MAX_CONCURRENT_JOBS", "3")
+    assert WorkerPool().max_workers == 3
+
+
+def test_model_concurrency_grows_past_the_old_job_limit(monkeypatch):
+    monkeypatch.delenv("MAX_CONCURRENT_JOBS", raising=False)
+    monkeypatch.setenv("MODEL_CONCURRENCY_MAX", "16")
+    # Only concurrency is under test, not the Gemini quota
+    monkeypatch.setenv("RATE_LIMIT_GLOBAL_PER_MINUTE", "0")
+    limiter = AdaptiveLimiter(initial=4, max_limit=16, latency_spike=1000)
+
+    def latency(call):
+        # Staggered answers, so a waiting job takes over each freed slot
+        return 0.05 + 0.01 * (call % 7)
+
+    resilience = ResilientCaller(limiter=limiter, hedge=False, min_attempt=0)
+    bot = DVPhotoBot(token="test", image_processor=ImageProcessor(
+        client=FakeGeminiClient(latency=latency), resilience=resilience,
+    ))
+    bot.image_processor.local_processor = None
+    bot.image_processor.compliance_checker = None
+    bot.image_processor.max_attempts = 1
+    assert bot.worker_pool.max_workers == 16
+    image = synthetic_portrait(size=(400, 480), seed=1)
+
+    async def run():
+        results = await asyncio.gather(*(
+            bot.scheduler.submit(chat_id, bot.image_processor.process_image, image) for chat_id in range(40)
+        ))
+        await bot.scheduler.close()
+        return results
+
+    assert all(asyncio.run(run()))
+    assert limiter.limit > 5
+    bot.worker_pool.shutdown()
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+Webhook serving mode with several bot worker processes
+
+A small HTTP front server receives Telegram webhook updates and hands each
+one to a worker process chosen by its chat id, so every message from a chat
+is handled by the same worker in the order it arrived. Each worker runs its
+own DVPhotoBot (worker pool, scheduler and cache) on a shared job journal.
+On SIGTERM/SIGINT the server stops accepting updates and lets the workers
+finish the photos they already have before exiting.
+
+Usage:
+    python webhook_server.py --workers 4 --port 8443 --url https://bot.example.com/telegram
+
+Updates can be posted by hand for local testing:
+    curl -X POST localhost:8443/telegram -H 'Content-Type: application/json' -d @update.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv('config.env')
+
+logger = logging.getLogger(__name__)
+
+# Update fields carrying a message-like object with a chat
+_CHAT_FIELDS = ("message", "edited_message", "channel_post", "edited_channel_post")
+
+# How long one attempt to queue a worker's stop signal waits for space
+_STOP_RETRY_SECONDS = 1.0
+
+
+def chat_id_for(update_data):
+    """
+    The id used to route an update: its chat, else its sender, else the update id
+    """
+    for field in _CHAT_FIELDS:
+        chat = (update_data.get(field) or {}).get("chat")
+        if chat and "id" in chat:
+            return chat["id"]
+    for field, value in update_data.items():
+        if not isinstance(value, dict):
+            continue
+        # callback_query carries the original message; most others a sender
+        chat = (value.get("message") or {}).get("chat") or value.get("chat")
+        if chat and "id" in chat:
+            return chat["id"]
+        sender = value.get("from") or value.get("user")
+        if sender and "id" in sender:
+            return sender["id"]
+    return update_data.get("update_id", 0)
+
+
+def worker_main(index, workers, updates, token, metrics_port):
+    """Entry point of a worker process"""
+    # The front server coordinates shutdown; Ctrl+C or a SIGTERM sent to the
+    # whole process group must not kill jobs mid-way
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    logging.basicConfig(
+        format=f'%(asctime)s - worker-{index} - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    asyncio.run(_serve_updates(index, workers, updates, token, metrics_port))
+
+
+async def _serve_updates(index, workers, updates, token, metrics_port):
+    # Imported here so the front process never loads the image pipeline
+    from telegram import Update
+    from telegram_bot import DVPhotoBot
+
+    bot = DVPhotoBot(token=token)
+    bot.metrics_port = metrics_port
+    # Workers share the job journal; each resumes only the chats routed to it
+    bot.owns_chat = lambda chat_id: chat_id % workers == index
+    # The Gemini quota is shared by all workers
+    bot.rate_limiter.split(workers, index)
+    application = bot.build_application(updater=False)
+    await application.initialize()
+    # post_init/post_shutdown only run automatically with run_polling
+    await bot.startup(application)
+    # Interrupted jobs are resumed here, once stop() will wait for them
+    await application.start()
+    logger.info(f"Worker {index} ready")
+
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+    finally:
+        # stop() processes the queued updates and waits for running handlers
+        logger.info(f"Worker {index} draining")
+        await application.stop()
+        await bot.shutdown(application)
+        await application.shutdown()
+        logger.info(f"Worker {index} stopped")
+
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    server_version = "DVPhotoBotWebhook"
+
+    def do_POST(self):
+        webhook = self.server.webhook
+        if self.path.split("?")[0] != webhook.path:
+            self.send_error(404)
+            return
+        if webhook.secret and self.headers.get("X-Telegram-Bot-Api-Secret-Token") != webhook.secret:
+            self.send_error(403)
+            return
+        try:
+            length = int(self.headers.get("Content-Length", "0"))
+            data = json.loads(self.rfile.read(length))
+            if not isinstance(data, dict):
+                raise ValueError("update must be a JSON object")
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+
+        # Non-2xx makes Telegram redeliver the update later
+        if not webhook.dispatch(data):
+            self.send_error(503)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path != "/healthz":
+            self.send_error(404)
+            return
+        alive = sum(process.is_alive() for process in self.server.webhook.processes)
+        body = json.dumps({"workers": len(self.server.webhook.processes), "alive": alive}).encode("utf-8")
+        self.send_response(200 if alive else 503)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class WebhookServer:
+    """
+    HTTP front end distributing webhook updates across worker processes
+
+    Args:
+        token: Telegram bot token, passed to every worker
+        workers: Number of worker processes
+        host: Interface to listen on
+        port: Port to listen on
+        path: URL path Telegram posts updates to
+        secret: Expected X-Telegram-Bot-Api-Secret-Token header, if any
+        queue_size: Updates buffered per worker before the server answers 503
+    """
+
+    def __init__(self, token, workers=2, host="0.0.0.0", port=8443, path="/telegram",
+                 secret=None, queue_size=1000):
+        self.token = token
+        self.workers = max(1, workers)
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret = secret
+        self.queue_size = queue_size
+        self.queues = []
+        self.processes = []
+        self.httpd = None
+        self._accepting = False
+
+    def route(self, update_data):
+        """Index of the worker that handles this update"""
+        return chat_id_for(update_data) % self.workers
+
+    def dispatch(self, update_data):
+        """Queue an update for its worker; False if it cannot be accepted now"""
+        if not self._accepting:
+            return False
+        try:
+            self.queues[self.route(update_data)].put(update_data, timeout=1)
+        except queue.Full:
+            logger.warning(f"Worker queue full, rejecting update {update_data.get('update_id')}")
+            return False
+        return True
+
+    def start(self, metrics_port=None):
+        """Spawn the workers and start listening"""
+        context = multiprocessing.get_context("spawn")
+        for index in range(self.workers):
+            updates = context.Queue(self.queue_size)
+            # Each worker exposes its own metrics on the ports after METRICS_PORT
+            worker_metrics_port = metrics_port + 1 + index if metrics_port else 0
+            process = context.Process(
+                target=worker_main,
+                args=(index, self.workers, updates, self.token, worker_metrics_port),
+                name=f"dvbot-worker-{index}",
+            )
+            process.start()
+            self.queues.append(updates)
+            self.processes.append(process)
+
+        self.httpd = ThreadingHTTPServer((self.host, self.port), _WebhookHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.webhook = self
+        self._accepting = True
+        threading.Thread(target=self.httpd.serve_forever, name="webhook-http", daemon=True).start()
+        logger.info(f"Webhook server listening on {self.host}:{self.httpd.server_address[1]}{self.path} "
+                    f"with {self.workers} workers")
+
+    def set_webhook(self, url):
+        """Register ``url`` with Telegram so updates are posted to this server"""
+        payload = {"url": url, "allowed_updates": json.dumps(["message", "edited_message"])}
+        if self.secret:
+            payload["secret_token"] = self.secret
+        response = requests.post(f"https://api.telegram.org/bot{self.token}/setWebhook", data=payload, timeout=30)
+        result = response.json()
+        if not result.get("ok"):
+            raise RuntimeError(f"setWebhook failed: {result.get('description')}")
+        logger.info(f"Webhook registered: {url}")
+
+    def drain(self, timeout=None):
+        """
+        Stop accepting updates and wait for the workers to finish their jobs
+
+        Each worker gets a stop signal behind the updates it already has.
+        Workers still running after ``timeout`` seconds are killed (they
+        ignore SIGTERM so that only the front server decides when to stop),
+        including a worker whose queue stayed full until then.
+        """
+        self._accepting = False
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        for updates, process in zip(self.queues, self.processes):
+            if not self._send_stop(updates, process, deadline):
+                logger.warning(f"Could not queue the stop signal for {process.name}")
+        for process in self.processes:
+            process.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f"{process.name} did not finish in time, killing it")
+                process.kill()
+                process.join()
+        logger.info("All workers stopped")
+
+    @staticmethod
+    def _send_stop(updates, process, deadline):
+        """
+        Queue the stop signal behind the worker's pending updates
+
+        A full queue frees up as the worker drains it, so keep trying while
+        the worker is alive and time is left; False if it could not be queued.
+        """
+        while process.is_alive():
+            wait = _STOP_RETRY_SECONDS
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+                if wait <= 0:
+                    return False
+            try:
+                updates.put(None, timeout=wait)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the bot through a Telegram webhook")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WEBHOOK_WORKERS", "2")),
+                        help="Worker processes (default: WEBHOOK_WORKERS or 2)")
+    parser.add_argument("--host", default=os.environ.get("WEBHOOK_HOST", "0.0.0.0"), help="Listen address")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("WEBHOOK_PORT", "8443")), help="Listen port")
+    parser.add_argument("--path", default=os.environ.get("WEBHOOK_PATH", "/telegram"), help="Webhook URL path")
+    parser.add_argument("--url", default=os.environ.get("WEBHOOK_URL"),
+                        help="Public URL to register with Telegram (skip registration if unset)")
+    parser.add_argument("--drain-timeout", type=float, default=float(os.environ.get("WEBHOOK_DRAIN_TIMEOUT", "120")),
+                        help="Seconds workers get to finish jobs on shutdown (default: 120)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    args = parse_args(argv)
+    token = os.environ.get("TELEGRAM_BOT_TOKEN")
+    if not token:
+        print("❌ TELEGRAM_BOT_TOKEN not found in environment variables")
+        return False
+
+    server = WebhookServer(
+        token,
+        workers=args.workers,
+        host=args.host,
+        port=args.port,
+        path=args.path,
+        secret=os.environ.get("WEBHOOK_SECRET") or None,
+        queue_size=int(os.environ.get("WEBHOOK_QUEUE_SIZE", "1000")),
+    )
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+    server.start(metrics_port=int(os.environ.get("METRICS_PORT", "0")))
+    try:
+        if args.url:
+            server.set_webhook(args.url)
+        stop.wait()
+    finally:
+        logger.info("Shutting down, waiting for in-flight photos...")
+        server.drain(args.drain_timeout)
+    return True
+
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
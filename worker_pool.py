@@ -0,0 +1,103 @@
+import asyncio
+import functools
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class JobTimeoutError(Exception):
+    """Raised when a job does not finish within its timeout"""
+
+
+def default_max_workers():
+    """MAX_CONCURRENT_JOBS when set, else MODEL_CONCURRENCY_MAX or 32"""
+    return int(os.environ.get("MAX_CONCURRENT_JOBS") or os.environ.get("MODEL_CONCURRENCY_MAX") or "32")
+
+
+class WorkerPool:
+    """
+    Bounded thread pool that runs blocking image processing work off the
+    asyncio event loop.
+
+    At most ``max_workers`` jobs run at once. The default follows
+    MODEL_CONCURRENCY_MAX: jobs spend most of their time waiting for Gemini,
+    and the adaptive limiter in the resilience layer, not the pool, decides
+    how many of them call it at once. The timeout of a job only starts
+    once it has a worker, so time spent waiting for a free slot is not counted.
+    Blocking functions receive a ``cancel_event`` keyword argument which is set
+    when the job times out or the awaiting coroutine is cancelled; they are
+    expected to check it between steps and stop early.
+    """
+
+    def __init__(self, max_workers=None, job_timeout=None):
+        self.max_workers = max_workers or default_max_workers()
+        self.job_timeout = job_timeout or float(os.environ.get("JOB_TIMEOUT", "120"))
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix="image-worker",
+        )
+        self._semaphore = None
+        self.in_flight = 0
+
+    def _get_semaphore(self):
+        # Created lazily so the semaphore binds to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_workers)
+        return self._semaphore
+
+    async def run(self, func, *args, timeout=None, **kwargs):
+        """
+        Run ``func(*args, cancel_event=..., **kwargs)`` in the pool
+
+        Args:
+            func: Blocking callable accepting a ``cancel_event`` keyword
+            timeout: Per-job timeout in seconds (default: ``self.job_timeout``)
+
+        Returns:
+            The return value of ``func``
+
+        Raises:
+            JobTimeoutError: If the job does not finish in time
+        """
+        timeout = self.job_timeout if timeout is None else timeout
+        semaphore = self._get_semaphore()
+        loop = asyncio.get_running_loop()
+        cancel_event = threading.Event()
+
+        await semaphore.acquire()
+        try:
+            future = self._executor.submit(
+                functools.partial(func, *args, cancel_event=cancel_event, **kwargs)
+            )
+        except BaseException:
+            semaphore.release()
+            raise
+
+        self.in_flight += 1
+
+        def _on_done(_):
+            # The slot is only freed once the worker thread has really stopped
+            loop.call_soon_threadsafe(self._release, semaphore)
+
+        future.add_done_callback(_on_done)
+
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            cancel_event.set()
+            logger.warning(f"Job {getattr(func, '__name__', func)} timed out after {timeout}s")
+            raise JobTimeoutError(f"Job did not finish within {timeout} seconds")
+        except asyncio.CancelledError:
+            cancel_event.set()
+            raise
+
+    def _release(self, semaphore):
+        self.in_flight -= 1
+        semaphore.release()
+
+    def shutdown(self, wait=True):
+        """Stop accepting work and optionally wait for running jobs"""
+        self._executor.shutdown(wait=wait, cancel_futures=True)